@@ -0,0 +1,676 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import shlex
+import signal
+import socket
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.server
+import urllib.request
+import psutil
+from cam_bench_fake import Events, EVENTS_FILENAME, LIVE_DIR, SEQ_DIR
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DAEMON_SCRIPT = os.path.join(SCRIPT_DIR, 'cam_streamer.py')
+FAKE_SCRIPT = os.path.join(SCRIPT_DIR, 'cam_bench_fake.py')
+MAIN_CFG = os.path.join(SCRIPT_DIR, 'cfg', 'main.cfg')
+
+RESULTS_FORMAT = 1
+SCENARIOS = ('startup', 'restart', 'cleaner', 'footprint')
+POLL_SECONDS = 0.1
+IDLE_SECONDS = 10
+
+log = logging.getLogger('cam_bench')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def summary(values):
+    """count, min, mean, nearest-rank percentiles and max of a list of numbers."""
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+
+    def percentile(part):
+        return values[max(math.ceil(part * len(values)) - 1, 0)]
+
+    return {'count': len(values), 'min': values[0], 'mean': sum(values) / len(values), 'p50': percentile(0.5),
+            'p90': percentile(0.9), 'p99': percentile(0.99), 'max': values[-1]}
+
+
+def histogram_summary(text, name):
+    """count, mean and percentiles (as bucket upper bounds) of an unlabeled histogram in the Prometheus text."""
+    buckets = []
+    total = 0.0
+
+    for line in text.splitlines():
+        if line.startswith(name + '_bucket{'):
+            buckets.append((float(re.search(r'le="([^"]+)"', line).group(1)), float(line.rsplit(' ', 1)[1])))
+        elif line.startswith(name + '_sum'):
+            total = float(line.rsplit(' ', 1)[1])
+
+    count = buckets[-1][1] if buckets else 0
+    if not count:
+        return {'count': 0}
+
+    def percentile(part):
+        for le, cumulative in buckets:
+            if cumulative >= part * count:
+                return le if le != float('inf') else None
+
+    return {'count': int(count), 'mean': total / count, 'p50_le': percentile(0.5), 'p90_le': percentile(0.9),
+            'p99_le': percentile(0.99), 'max_le': percentile(1)}
+
+
+def set_cfg_key(text, key, value):
+    """Replaces the single line value of key in the config text (the value is a config expression)."""
+    line = '%s: %s' % (key, value)
+    text, found = re.subn(r'^%s:.*$' % re.escape(key), lambda match: line, text, flags=re.MULTILINE)
+
+    if not found:
+        text += '\n%s\n' % line
+
+    return text
+
+
+def cfg_string(value):
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+class StreamHandler(http.server.BaseHTTPRequestHandler):
+    """cap_url of the simulated cams: /cam/NAME/mpeg.2ts answers HTTP 200 while the fake streamer of the cam is up,
+    GET streams at the streamer bitrate.
+    """
+
+    CHUNK_SECONDS = 0.1
+
+    def bitrate(self):
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        return self.server.simulation.live_bitrate(parts[-2]) if len(parts) >= 2 else None
+
+    def do_HEAD(self):
+        if self.bitrate() is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/MP2T')
+        self.end_headers()
+
+    def do_GET(self):
+        bitrate = self.bitrate()
+        if bitrate is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/MP2T')
+        self.end_headers()
+
+        chunk = b'\x47' * max(int(bitrate * 1000 / 8 * self.CHUNK_SECONDS), 1)
+        next_time = time.time()
+
+        while self.bitrate() is not None:
+            try:
+                self.wfile.write(chunk)
+                self.wfile.flush()
+            except OSError:
+                return
+
+            next_time += self.CHUNK_SECONDS
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def log_message(self, *args):
+        pass
+
+
+class Simulation:
+    """A cam_streamer.py run with simulated cams in its own directory: fake streamer and capturer commands, a local
+    HTTP server in place of cap_url and a generated config (cfg/main.cfg with overrides).
+    """
+
+    def __init__(self, run_dir, args, crash_rate=0.0, capturer_crash_rate=0.0):
+        self.run_dir = run_dir
+        self.args = args
+        self.crash_rate = crash_rate
+        self.capturer_crash_rate = capturer_crash_rate
+        self.cams = ['bench%03i' % (i + 1) for i in range(args.cams)]
+        self.cfg_dir = os.path.join(run_dir, 'cfg')
+        self.events = Events(os.path.join(run_dir, EVENTS_FILENAME))
+        self.server = None
+        self.process = None
+        self.metrics_port = free_port()
+        self.shutdown_timeout = 10
+
+        for name in ('cfg', 'store', 'log', 'pid', LIVE_DIR, SEQ_DIR):
+            os.makedirs(os.path.join(run_dir, name), exist_ok=True)
+
+    def live_bitrate(self, cam):
+        try:
+            pid, bitrate = open(os.path.join(self.run_dir, LIVE_DIR, os.path.basename(cam))).read().split()
+            os.kill(int(pid), 0)
+        except (OSError, ValueError):
+            return None
+
+        return float(bitrate)
+
+    def fake_cmd(self, role, cam, crash_rate, *options):
+        words = [sys.executable, FAKE_SCRIPT, role, '-cam', cam, '-run_dir', self.run_dir,
+                 '-seed', str(self.args.seed), '-crash_rate', str(crash_rate)] + list(options)
+        return 'exec ' + ' '.join(shlex.quote(word) for word in words)
+
+    def write_configs(self, port):
+        text = open(MAIN_CFG).read()
+        overrides = [
+            ('log_dir', cfg_string(os.path.join(self.run_dir, 'log'))),
+            ('pid_dir', cfg_string(os.path.join(self.run_dir, 'pid'))),
+            ('cap_dir', cfg_string(os.path.join(self.run_dir, 'store'))),
+            ('log_level', cfg_string(self.args.log_level)),
+            ('metrics_listen', cfg_string('127.0.0.1:%i' % self.metrics_port)),
+            ('cap_url', cfg_string('http://127.0.0.1:%i/cam/[cam_name]/mpeg.2ts' % port)),
+            ('cap_cmd', cfg_string(self.fake_cmd('capturer', '[cam_name]', self.capturer_crash_rate,
+                                                 '-url', 'http://127.0.0.1:%i/cam/[cam_name]/mpeg.2ts' % port,
+                                                 '-output', os.path.join(self.run_dir, 'store', '[cam_name]',
+                                                                         '[cam_name]_%Y-%m-%d_%H-%M-%S.ts'),
+                                                 '-segment_seconds', str(self.args.segment_seconds)))),
+            ('catalog_file', cfg_string(os.path.join(self.run_dir, 'catalog.sqlite'))),
+            ('adopt_processes', 'False'),
+            ('config_watch', 'False'),
+            ('cleaner_store_max_gb', '0'),
+            ('cleaner_store_keep_free_gb', '0'),
+        ]
+
+        for key, value in overrides:
+            text = set_cfg_key(text, key, value)
+
+        for override in self.args.set:
+            key, value = override.split('=', 1)
+            text = set_cfg_key(text, key.strip(), value.strip())
+
+        match = re.search(r'^shutdown_timeout_seconds:\s*(\d+)', text, re.MULTILINE)
+        if match is not None:
+            self.shutdown_timeout = int(match.group(1))
+
+        open(os.path.join(self.cfg_dir, 'main.cfg'), 'w').write(text)
+
+        # cmd is not a subject of the [cam_name] replacement
+        for cam in self.cams:
+            streamer_cmd = self.fake_cmd('streamer', cam, self.crash_rate,
+                                         '-start_delay', str(self.args.start_delay), '-bitrate', str(self.args.bitrate))
+            open(os.path.join(self.cfg_dir, cam + '.cfg'), 'w').write(
+                'name: %s\nactive: True\n\ncmd: %s\n\nmax_start_seconds: %i\n' %
+                (cfg_string(cam), cfg_string(streamer_cmd), self.args.max_start_seconds))
+
+    def start(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StreamHandler)
+        self.server.daemon_threads = True
+        self.server.simulation = self
+        threading.Thread(target=self.server.serve_forever, name='stream', daemon=True).start()
+
+        self.write_configs(self.server.server_address[1])
+
+        env = dict(os.environ, CFG_DIR=self.cfg_dir, CFG_FILENAME='main.cfg')
+        output = open(os.path.join(self.run_dir, 'daemon.out'), 'w')
+        start_time = time.time()
+        self.process = subprocess.Popen([sys.executable, DAEMON_SCRIPT], env=env, stdout=output,
+                                        stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+        output.close()
+        return start_time
+
+    def metrics(self):
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%i/metrics' % self.metrics_port, timeout=5) as response:
+                return response.read().decode('utf-8')
+        except OSError as e:
+            log.warning('Failed to read metrics: %s', e)
+            return ''
+
+    def loop_results(self):
+        text = self.metrics()
+        return {'iteration_seconds': histogram_summary(text, 'cam_streamer_loop_iteration_seconds'),
+                'lag_seconds': histogram_summary(text, 'cam_streamer_loop_lag_seconds')}
+
+    def stop(self):
+        """Stops the daemon, returns its shutdown time. Fakes left running are killed."""
+        stop_seconds = None
+
+        if self.process is not None and self.process.poll() is None:
+            stop_time = time.time()
+            self.process.terminate()
+
+            try:
+                self.process.wait(self.shutdown_timeout + 10)
+                stop_seconds = time.time() - stop_time
+            except subprocess.TimeoutExpired:
+                log.warning('Daemon has not stopped in time, kill it')
+                self.process.kill()
+                self.process.wait()
+
+        for process in psutil.process_iter(['cmdline']):
+            cmdline = process.info['cmdline'] or []
+            if FAKE_SCRIPT in cmdline and self.run_dir in cmdline:
+                log.warning('Kill the fake left running: %s', ' '.join(cmdline[2:6]))
+                try:
+                    process.kill()
+                except psutil.Error:
+                    pass
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+        return stop_seconds
+
+    def wait_events(self, condition, timeout):
+        """Reads the events until condition(events) is true or timeout. Returns all events read."""
+        events = []
+        end_time = time.time() + timeout
+
+        while True:
+            events.extend(self.events.read())
+            if condition(events) or time.time() >= end_time:
+                return events
+
+            if self.process.poll() is not None:
+                raise RuntimeError('Daemon has exited with code %s, see: %s' %
+                                   (self.process.returncode, os.path.join(self.run_dir, 'daemon.out')))
+
+            time.sleep(POLL_SECONDS)
+
+
+def recording_cams(events):
+    return set(event['cam'] for event in events if event['role'] == 'capturer' and event['event'] == 'ready')
+
+
+def bench_startup(args, run_dir):
+    """Time from the daemon launch to the first segment data of every cam, with no crashes."""
+    sim = Simulation(run_dir, args)
+    log.info('Startup: %i cams', args.cams)
+
+    try:
+        start_time = sim.start()
+        events = sim.wait_events(lambda e: len(recording_cams(e)) == len(sim.cams), args.timeout)
+        loop = sim.loop_results()
+    finally:
+        stop_seconds = sim.stop()
+
+    launch_times = [event['time'] for event in events if event['role'] == 'streamer']
+    cam_seconds = {}
+    for event in events:
+        if event['role'] == 'capturer' and event['event'] == 'ready' and event['cam'] not in cam_seconds:
+            cam_seconds[event['cam']] = event['time'] - start_time
+
+    return {
+        'cams': len(sim.cams),
+        'cams_recording': len(cam_seconds),
+        'first_launch_seconds': min(launch_times) - start_time if launch_times else None,
+        'all_recording_seconds': max(cam_seconds.values()) if len(cam_seconds) == len(sim.cams) else None,
+        'cam_recording_seconds': summary(list(cam_seconds.values())),
+        'loop': loop,
+        'stop_seconds': stop_seconds,
+    }
+
+
+def recovered(events, crash):
+    return any(event['cam'] == crash['cam'] and event['role'] == 'capturer' and event['event'] == 'ready' and
+               event['time'] > crash['time'] for event in events)
+
+
+def recoveries(events, role):
+    """Seconds from every crash of the role to the next start of the role and to the next capturer data of
+    the cam. events are ordered by time.
+    """
+    relaunch = []
+    recording = []
+    lost = 0
+
+    for i, crash in enumerate(events):
+        if crash['role'] != role or crash['event'] != 'crash':
+            continue
+
+        later = events[i + 1:]
+        start = next((event for event in later if event['cam'] == crash['cam'] and event['role'] == role and
+                      event['event'] == 'start'), None)
+        ready = next((event for event in later if event['cam'] == crash['cam'] and event['role'] == 'capturer' and
+                      event['event'] == 'ready'), None)
+
+        if start is not None:
+            relaunch.append(start['time'] - crash['time'])
+        if ready is not None:
+            recording.append(ready['time'] - crash['time'])
+        else:
+            lost += 1
+
+    return {'relaunch_seconds': summary(relaunch), 'recording_seconds': summary(recording), 'not_recovered': lost}
+
+
+def bench_restart(args, run_dir):
+    """Time to restart after the fake crashes of a steady run of duration seconds."""
+    sim = Simulation(run_dir, args, args.crash_rate, args.capturer_crash_rate)
+    log.info('Restart: %i cams, %.3f streamer and %.3f capturer crashes per second for %i seconds',
+             args.cams, args.crash_rate, args.capturer_crash_rate, args.duration)
+
+    try:
+        sim.start()
+        events = sim.wait_events(lambda e: len(recording_cams(e)) == len(sim.cams), args.timeout)
+        events += sim.wait_events(lambda e: False, args.duration)
+        end_time = time.time()
+        crashes = [event for event in events if event['event'] == 'crash']
+
+        # The crashes of the run are given up to timeout to recover, the later ones are not counted
+        events += sim.wait_events(lambda e: all(recovered(events + e, crash) for crash in crashes), args.timeout)
+        loop = sim.loop_results()
+    finally:
+        sim.stop()
+
+    events = sorted((event for event in events if event['event'] != 'crash' or event['time'] < end_time),
+                    key=lambda event: event['time'])
+
+    return {
+        'cams': len(sim.cams),
+        'duration_seconds': args.duration,
+        'streamer_crashes': sum(1 for e in events if e['role'] == 'streamer' and e['event'] == 'crash'),
+        'capturer_crashes': sum(1 for e in events if e['role'] == 'capturer' and e['event'] == 'crash'),
+        'streamer_crash': recoveries(events, 'streamer'),
+        'capturer_crash': recoveries(events, 'capturer'),
+        'loop': loop,
+    }
+
+
+def store_steps(files):
+    steps = []
+    step = 1000
+
+    while step < files:
+        steps.append(step)
+        step *= 10
+
+    return steps + [files]
+
+
+def fill_store(store_dir, cams, first, last, segment_bytes, segment_seconds, base_time):
+    """Creates sparse segment files first..last-1, spread over the cams, one segment_seconds apart per cam."""
+    for i in range(first, last):
+        cam = 'bench%03i' % (i % cams + 1)
+        mtime = base_time + (i // cams) * segment_seconds
+        path = os.path.join(store_dir, cam, '%s_%s.ts' % (cam, time.strftime('%Y-%m-%d_%H-%M-%S',
+                                                                             time.localtime(mtime))))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, segment_bytes)
+        finally:
+            os.close(fd)
+        os.utime(path, (mtime, mtime))
+
+
+def bench_cleaner(args, run_dir):
+    """Store index build time and cleaner run time and throughput as the store grows."""
+    from cam_store import StoreIndex, Cleaner
+
+    # Per file remove log lines would measure logging instead of the store paths
+    logging.getLogger('cam_store').setLevel(logging.WARNING)
+
+    store_dir = os.path.join(run_dir, 'store')
+    for i in range(args.store_cams):
+        os.makedirs(os.path.join(store_dir, 'bench%03i' % (i + 1)), exist_ok=True)
+
+    segment_bytes = int(args.segment_mb * 1024 * 1024)
+    steps = store_steps(args.store_files)
+    base_time = time.time() - (steps[-1] // args.store_cams + 1) * args.segment_seconds * 2
+    process = psutil.Process()
+    results = []
+    created = 0
+    next_file = 0
+
+    for step in steps:
+        create_time = time.time()
+        fill_store(store_dir, args.store_cams, next_file, next_file + step - created, segment_bytes,
+                   args.segment_seconds, base_time)
+        next_file += step - created
+        create_seconds = time.time() - create_time
+
+        rss = process.memory_info().rss
+        index = StoreIndex(store_dir, StoreIndex.MODE_SCAN)
+        index_time = time.time()
+        index.start()
+        index.load()
+        index_seconds = time.time() - index_time
+        index_rss = process.memory_info().rss - rss
+
+        update_time = time.time()
+        index.update()
+        update_seconds = time.time() - update_time
+
+        store_bytes = index.size_bytes()
+        cleaner = Cleaner(index, int(store_bytes * (1 - args.clean_percent / 100.0)), 0)
+        clean_time = time.time()
+        cleaner.clean()
+        clean_seconds = time.time() - clean_time
+        index.stop()
+
+        created = len(index)
+        log.info('Cleaner: %i files indexed in %.3f seconds, %i removed in %.3f seconds',
+                 step, index_seconds, cleaner.removes_total, clean_seconds)
+
+        results.append({
+            'files': step,
+            'cams': args.store_cams,
+            'store_bytes': store_bytes,
+            'create_seconds': create_seconds,
+            'index_seconds': index_seconds,
+            'index_files_per_second': step / index_seconds if index_seconds else None,
+            'index_rss_bytes': index_rss,
+            'update_seconds': update_seconds,
+            'clean_seconds': clean_seconds,
+            'removed_files': cleaner.removes_total,
+            'removed_bytes': cleaner.removed_bytes_total,
+            'removes_per_second': cleaner.removes_total / clean_seconds if clean_seconds else None,
+        })
+
+    return results
+
+
+# Runs a command from a small forked process: a child of the bench would start with the bench RSS as its max RSS
+LAUNCHER = """import os, sys, time
+pid = os.fork()
+if pid == 0:
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    os.execv(sys.argv[1], sys.argv[1:])
+start_time = time.time()
+_, status, usage = os.wait4(pid, 0)
+print(time.time() - start_time, usage.ru_maxrss, os.waitstatus_to_exitcode(status))
+"""
+
+
+def run_measured(cmd, env):
+    """Runs cmd, returns its wall time, max RSS (Mb) and exit code."""
+    output = subprocess.check_output([sys.executable, '-S', '-c', LAUNCHER] + cmd, env=env,
+                                     stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+    seconds, max_rss, code = output.split()
+    return float(seconds), int(max_rss) / 1024.0, int(code)
+
+
+def imported_modules(cmd, env):
+    """Number of modules imported by the python command cmd."""
+    output = subprocess.run(cmd[:1] + ['-X', 'importtime'] + cmd[1:], env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, stdin=subprocess.DEVNULL).stderr.decode('utf-8', 'replace')
+    return len(re.findall(r'^import time:\s+\d+', output, re.MULTILINE))
+
+
+def measure_command(cmd, env, repeat, prepare=None):
+    seconds, rss = [], []
+
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+
+        run_seconds, run_rss, code = run_measured(cmd, env)
+        seconds.append(run_seconds)
+        rss.append(run_rss)
+
+    return {'seconds': summary(seconds), 'max_rss_mb': summary(rss), 'exit_code': code,
+            'modules': imported_modules(cmd, env)}
+
+
+def bench_footprint(args, run_dir):
+    """Wall time and max RSS of the command line runs (-h, -daemon status with a cold and a warm config cache,
+    -daemon stop) and the idle footprint of the daemon with N recording cams.
+    """
+    from cam_config import ConfigCache
+
+    sim = Simulation(run_dir, args)
+    cache = ConfigCache(sim.cfg_dir, 'main.cfg')
+    python = [sys.executable, '-c', 'pass']
+    status = [sys.executable, DAEMON_SCRIPT, '-daemon', 'status']
+    log.info('Footprint: %i cams, %i runs of a command', args.cams, args.repeat)
+
+    try:
+        start_time = sim.start()
+        events = sim.wait_events(lambda e: len(recording_cams(e)) == len(sim.cams), args.timeout)
+        recording_seconds = max(event['time'] for event in events
+                                if event['role'] == 'capturer' and event['event'] == 'ready') - start_time
+        env = dict(os.environ, CFG_DIR=sim.cfg_dir, CFG_FILENAME='main.cfg')
+
+        process = psutil.Process(sim.process.pid)
+        cpu_times = process.cpu_times()
+        time.sleep(IDLE_SECONDS)
+        cpu_seconds = sum(process.cpu_times()[:2]) - sum(cpu_times[:2])
+        daemon = {'rss_mb': process.memory_info().rss / 1024.0 / 1024.0, 'threads': process.num_threads(),
+                  'cpu_percent': 100.0 * cpu_seconds / IDLE_SECONDS}
+
+        def remove_cache():
+            if os.path.exists(cache.path):
+                os.remove(cache.path)
+
+        # The daemon has written the config cache, a cold run is a run without it
+        cache_text = open(cache.path).read()
+        commands = {
+            'python': measure_command(python, env, args.repeat),
+            'help': measure_command([sys.executable, DAEMON_SCRIPT, '-h'], env, args.repeat),
+            'status_cold': measure_command(status, env, args.repeat, remove_cache),
+        }
+        open(cache.path, 'w').write(cache_text)
+        commands['status'] = measure_command(status, env, args.repeat)
+
+        stop_seconds, stop_rss, stop_code = run_measured([sys.executable, DAEMON_SCRIPT, '-daemon', 'stop'], env)
+        sim.process.wait(sim.shutdown_timeout + 10)
+        commands['stop'] = {'seconds': stop_seconds, 'max_rss_mb': stop_rss, 'exit_code': stop_code}
+    finally:
+        sim.stop()
+
+    return {
+        'cams': len(sim.cams),
+        'all_recording_seconds': recording_seconds,
+        'daemon_idle': daemon,
+        'commands': commands,
+    }
+
+
+def version():
+    try:
+        git = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=SCRIPT_DIR,
+                                      stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        git = None
+
+    return {'git': git, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def main(args):
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise SystemExit('Unknown scenario: %s (known: %s)' % (scenario, ', '.join(SCENARIOS)))
+
+    run_dir = os.path.abspath(args.run_dir) if args.run_dir else tempfile.mkdtemp(prefix='cam_bench_')
+    run = {
+        'format': RESULTS_FORMAT,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'version': version(),
+        'params': dict((key, value) for key, value in vars(args).items() if key not in ('output', 'run_dir')),
+        'results': {},
+    }
+    log.info('Run directory: %s', run_dir)
+
+    try:
+        for scenario in scenarios:
+            scenario_dir = os.path.join(run_dir, scenario)
+            if os.path.exists(scenario_dir):
+                shutil.rmtree(scenario_dir)
+            os.makedirs(scenario_dir)
+
+            scenario_time = time.time()
+            if scenario == 'startup':
+                run['results'][scenario] = bench_startup(args, scenario_dir)
+            elif scenario == 'restart':
+                run['results'][scenario] = bench_restart(args, scenario_dir)
+            elif scenario == 'cleaner':
+                run['results'][scenario] = bench_cleaner(args, scenario_dir)
+            elif scenario == 'footprint':
+                run['results'][scenario] = bench_footprint(args, scenario_dir)
+            log.info('Scenario "%s" is done in %.1f seconds', scenario, time.time() - scenario_time)
+    finally:
+        if not args.run_dir:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    text = json.dumps(run, indent=2, sort_keys=True)
+    if args.output:
+        open(args.output, 'w').write(text + '\n')
+        log.info('Results are written to: %s', args.output)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='cam_streamer benchmark with simulated cams. Results are printed as JSON (or written to -output)')
+    parser.add_argument('-scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated: %s (default: all)' % ', '.join(SCENARIOS))
+    parser.add_argument('-cams', type=int, default=8, help='Simulated cams number')
+    parser.add_argument('-start_delay', type=float, default=1, help='Fake streamer start delay, seconds')
+    parser.add_argument('-bitrate', type=float, default=500, help='Fake stream bitrate, kbit/s')
+    parser.add_argument('-segment_seconds', type=int, default=60, help='Segment duration')
+    parser.add_argument('-crash_rate', type=float, default=0.02,
+                        help='restart: fake streamer crashes per second of running')
+    parser.add_argument('-capturer_crash_rate', type=float, default=0.0,
+                        help='restart: fake capturer crashes per second of running')
+    parser.add_argument('-duration', type=int, default=60, help='restart: steady run seconds')
+    parser.add_argument('-max_start_seconds', type=int, default=30, help='Cam config max_start_seconds')
+    parser.add_argument('-timeout', type=int, default=120, help='Seconds to wait for all cams to record')
+    parser.add_argument('-store_files', type=int, default=100000,
+                        help='cleaner: store files at the last step (steps: 1000, 10000, ... up to it)')
+    parser.add_argument('-store_cams', type=int, default=10, help='cleaner: cam directories of the store')
+    parser.add_argument('-segment_mb', type=float, default=64, help='cleaner: (sparse) segment file size, Mb')
+    parser.add_argument('-clean_percent', type=float, default=10, help='cleaner: part of the store to remove')
+    parser.add_argument('-repeat', type=int, default=10, help='footprint: runs of a measured command')
+    parser.add_argument('-seed', default='1', help='Seed of the fake crashes')
+    parser.add_argument('-set', action='append', default=[], metavar='KEY=VALUE',
+                        help='Override a main.cfg key of the daemon (VALUE is a config expression)')
+    parser.add_argument('-log_level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Daemon log level')
+    parser.add_argument('-run_dir', help='Keep the simulation files in this directory (default: a temporary one)')
+    parser.add_argument('-output', help='Results JSON file')
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, stream=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda s, frame: sys.exit(1))
+    main(parser.parse_args())
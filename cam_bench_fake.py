@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import json
+import random
+import signal
+import argparse
+
+# The fakes are started for every simulated cam, so only light modules are imported here
+EVENTS_FILENAME = 'events.jsonl'
+LIVE_DIR = 'live'
+SEQ_DIR = 'seq'
+READ_BYTES = 16384
+
+
+class Events:
+    """Append-only JSON lines file of the fake process events, shared by all fakes of a simulation.
+
+    A line is appended by a single O_APPEND write, so lines of concurrent writers are never mixed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def write(self, cam, role, event, **fields):
+        record = {'time': time.time(), 'cam': cam, 'role': role, 'event': event, 'pid': os.getpid()}
+        record.update(fields)
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """Returns the events appended since the last call."""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        # A line could be still incomplete
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+
+        return [json.loads(line) for line in data[:end].splitlines() if line]
+
+
+def fake_random(run_dir, cam, role, seed):
+    """Returns a random generator, which depends on the seed, the cam, the role and the number of previous starts
+    of the fake, so a simulation replays the same crashes on every run.
+    """
+    seq_file = os.path.join(run_dir, SEQ_DIR, '%s_%s' % (cam, role))
+
+    try:
+        seq = int(open(seq_file).read())
+    except (OSError, ValueError):
+        seq = 0
+
+    open(seq_file, 'w').write(str(seq + 1))
+    return random.Random('%s:%s:%s:%i' % (seed, cam, role, seq))
+
+
+def lifetime(rng, crash_rate):
+    """Seconds to a crash for crash_rate crashes per second, None - never."""
+    if crash_rate <= 0:
+        return None
+
+    return rng.expovariate(crash_rate)
+
+
+def fake_streamer(args, events):
+    """Stands in for a gst-launch streamer: after start_delay the stream of the cam is served by the simulation
+    HTTP server at bitrate, until the fake crashes or is stopped.
+    """
+    live_file = os.path.join(args.run_dir, LIVE_DIR, args.cam)
+    rng = fake_random(args.run_dir, args.cam, 'streamer', args.seed)
+
+    def stop(s, frame):
+        if os.path.exists(live_file):
+            os.remove(live_file)
+        events.write(args.cam, 'streamer', 'exit', signal=s)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    events.write(args.cam, 'streamer', 'start')
+
+    time.sleep(args.start_delay)
+    open(live_file, 'w').write('%i %s' % (os.getpid(), args.bitrate))
+    events.write(args.cam, 'streamer', 'ready')
+
+    seconds = lifetime(rng, args.crash_rate)
+    if seconds is None:
+        while True:
+            signal.pause()
+
+    time.sleep(seconds)
+    os.remove(live_file)
+    events.write(args.cam, 'streamer', 'crash')
+    os._exit(1)
+
+
+def fake_capturer(args, events):
+    """Stands in for an ffmpeg capturer: reads the cam stream from url and writes it into segment files named by
+    the strftime() output pattern. Exits, when the stream ends, like ffmpeg does.
+    """
+    import urllib.request
+
+    rng = fake_random(args.run_dir, args.cam, 'capturer', args.seed)
+
+    def stop(s, frame):
+        events.write(args.cam, 'capturer', 'exit', signal=s)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    events.write(args.cam, 'capturer', 'start')
+
+    try:
+        response = urllib.request.urlopen(args.url, timeout=5)
+    except OSError as e:
+        events.write(args.cam, 'capturer', 'exit', error=str(e))
+        sys.exit(1)
+
+    seconds = lifetime(rng, args.crash_rate)
+    crash_time = time.time() + seconds if seconds is not None else None
+    segment = None
+    segment_end_time = 0
+    ready_flag = False
+
+    while True:
+        try:
+            data = response.read1(READ_BYTES)
+        except OSError as e:
+            events.write(args.cam, 'capturer', 'exit', error=str(e))
+            sys.exit(1)
+
+        if not data:
+            events.write(args.cam, 'capturer', 'exit', error='stream end')
+            sys.exit(1)
+
+        now = time.time()
+
+        if now >= segment_end_time:
+            if segment is not None:
+                segment.close()
+
+            path = time.strftime(args.output, time.localtime(now))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            segment = open(path, 'ab')
+            segment_end_time = now + args.segment_seconds
+
+        segment.write(data)
+
+        if not ready_flag:
+            ready_flag = True
+            events.write(args.cam, 'capturer', 'ready')
+
+        if crash_time is not None and now >= crash_time:
+            events.write(args.cam, 'capturer', 'crash')
+            os._exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated cam processes of the cam_bench.py benchmark')
+    parser.add_argument('role', choices=['streamer', 'capturer'])
+    parser.add_argument('-cam', required=True)
+    parser.add_argument('-run_dir', required=True, help='Simulation directory')
+    parser.add_argument('-seed', default='1')
+    parser.add_argument('-crash_rate', type=float, default=0, help='Crashes per second of running')
+    parser.add_argument('-start_delay', type=float, default=0, help='Streamer: seconds before the stream is up')
+    parser.add_argument('-bitrate', type=float, default=500, help='Streamer: stream bitrate, kbit/s')
+    parser.add_argument('-url', help='Capturer: stream URL')
+    parser.add_argument('-output', help='Capturer: strftime() pattern of the segment files')
+    parser.add_argument('-segment_seconds', type=float, default=60, help='Capturer: segment duration')
+    args = parser.parse_args()
+
+    fake_events = Events(os.path.join(args.run_dir, EVENTS_FILENAME))
+
+    if args.role == 'streamer':
+        fake_streamer(args, fake_events)
+    else:
+        fake_capturer(args, fake_events)
@@ -0,0 +1,358 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+TS_PACKET_SIZE = 188
+TS_READ_PACKETS = 8192
+TS_CLOCK = 90000.0
+TS_PTS_MODULO = 1 << 33
+
+# A packet, which starts a PES and has an adaptation field with the random access indicator set (a keyframe).
+# Matches at positions, which are not packet starts, are skipped
+TS_KEYFRAME_RE = re.compile(b'\x47[\x40-\x7f].[\x30-\x3f][\x01-\xb7][\x40-\x7f\xc0-\xff]', re.DOTALL)
+
+SEGMENT_TIME_RE = re.compile(r'(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})')
+SEGMENT_TIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d_%H-%M-%S', '%Y-%m-%dT%H:%M:%S')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS segments (
+    path TEXT PRIMARY KEY,
+    cam TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    size INTEGER NOT NULL,
+    keyframes TEXT
+);
+CREATE INDEX IF NOT EXISTS segments_cam_time ON segments (cam, start_time);
+'''
+
+
+class CatalogError(Exception):
+    pass
+
+
+class Segment:
+    def __init__(self, path, cam, start_time, end_time, size, keyframes=None):
+        self.path = path
+        self.cam = cam
+        self.start_time = start_time
+        self.end_time = end_time
+        self.duration = end_time - start_time
+        self.size = size
+        # [(seconds from start_time, byte offset)] or None, if the segment is not scanned yet
+        self.keyframes = keyframes
+
+
+def parse_time(text):
+    """Local time in one of TIME_FORMATS or a Unix timestamp."""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    for time_format in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(text, time_format))
+        except ValueError:
+            pass
+
+    raise CatalogError('Unknown time format: %s (use "YYYY-mm-dd HH:MM:SS")' % text)
+
+
+def ts_sync_offset(data):
+    for offset in range(min(TS_PACKET_SIZE, len(data) - TS_PACKET_SIZE)):
+        if data[offset] == 0x47 and data[offset + TS_PACKET_SIZE] == 0x47:
+            return offset
+
+    return None
+
+
+def ts_pts(packet):
+    """PTS of a video PES, which starts in the packet, or None."""
+    pes = packet[5 + packet[4]:]
+    if len(pes) < 14 or pes[:3] != b'\x00\x00\x01' or not 0xe0 <= pes[3] <= 0xef or not pes[7] & 0x80:
+        return None
+
+    return ((pes[9] >> 1) & 0x07) << 30 | pes[10] << 22 | (pes[11] >> 1) << 15 | pes[12] << 7 | pes[13] >> 1
+
+
+def scan_keyframes(path, interval_seconds):
+    """Returns [(seconds from the first keyframe, byte offset)] of the video keyframes of an MPEG-TS file,
+    at least interval_seconds apart. Returns [] for other files.
+
+    The file is read in large blocks and searched by a regular expression, so only the keyframe packets are
+    handled in Python.
+    """
+    keyframes = []
+    first_pts = None
+
+    with open(path, 'rb') as f:
+        offset = ts_sync_offset(f.read(TS_PACKET_SIZE * 2))
+        if offset is None:
+            return keyframes
+
+        f.seek(offset)
+
+        while True:
+            data = f.read(TS_PACKET_SIZE * TS_READ_PACKETS)
+            if not data:
+                break
+
+            for match in TS_KEYFRAME_RE.finditer(data):
+                pos = match.start()
+                if pos % TS_PACKET_SIZE:
+                    continue
+
+                pts = ts_pts(data[pos:pos + TS_PACKET_SIZE])
+                if pts is None:
+                    continue
+
+                if first_pts is None:
+                    first_pts = pts
+
+                seconds = ((pts - first_pts) % TS_PTS_MODULO) / TS_CLOCK
+                if not keyframes or seconds - keyframes[-1][0] >= interval_seconds:
+                    keyframes.append((seconds, offset + pos))
+
+            offset += len(data)
+
+    return keyframes
+
+
+def ts_tables(f):
+    """Returns the PAT and PMT packets from the head of an MPEG-TS file, a cut, which starts at a keyframe in the
+    middle of a segment, is prefixed with them, so it is playable at once.
+    """
+    f.seek(0)
+    data = f.read(TS_PACKET_SIZE * 64)
+    offset = ts_sync_offset(data)
+    if offset is None:
+        return b''
+
+    packets = [data[pos:pos + TS_PACKET_SIZE]
+               for pos in range(offset, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE)]
+    tables = {}
+    pmt_pids = set()
+
+    for packet in packets:
+        pid = (packet[1] & 0x1f) << 8 | packet[2]
+        if not packet[1] & 0x40 or pid in tables:
+            continue
+
+        payload = 4 + (1 + packet[4] if packet[3] & 0x20 else 0)
+        if payload >= TS_PACKET_SIZE or payload + 1 + packet[payload] + 8 > TS_PACKET_SIZE:
+            continue
+        section = payload + 1 + packet[payload]
+
+        if pid == 0:
+            tables[pid] = packet
+            section_length = (packet[section + 1] & 0x0f) << 8 | packet[section + 2]
+            for pos in range(section + 8, min(section + 3 + section_length - 4, TS_PACKET_SIZE - 3), 4):
+                if packet[pos] << 8 | packet[pos + 1]:
+                    pmt_pids.add((packet[pos + 2] & 0x1f) << 8 | packet[pos + 3])
+        elif pid in pmt_pids:
+            tables[pid] = packet
+
+        if 0 in tables and pmt_pids and pmt_pids <= set(tables):
+            break
+
+    return b''.join(tables[pid] for pid in sorted(tables))
+
+
+def copy_range(f, out, begin, end):
+    """Copies [begin, end) bytes of f to out, in the kernel where possible."""
+    out.flush()
+
+    while begin < end:
+        try:
+            sent = os.sendfile(out.fileno(), f.fileno(), begin, end - begin)
+        except OSError:
+            break
+        if sent == 0:
+            return
+        begin += sent
+
+    f.seek(begin)
+    while begin < end:
+        data = f.read(min(end - begin, 1024 * 1024))
+        if not data:
+            return
+        out.write(data)
+        begin += len(data)
+
+
+class Catalog:
+    """SQLite catalog of the recorded segments: cam, start and end time, size and the byte offsets of the
+    keyframes at a coarse interval, which are enough to cut a time range out of the MPEG-TS segments by copying
+    byte ranges, with no re-encode.
+
+    A segment is indexed, when its capturer closes it. Segment files are scanned in the catalog thread, the
+    connection is shared under a lock, so the cleaner thread removes its rows directly.
+    """
+
+    def __init__(self, path, keyframe_interval_seconds=10):
+        self.path = path
+        self.keyframe_interval_seconds = keyframe_interval_seconds
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalog')
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(SCHEMA)
+
+    @staticmethod
+    def segment_start_time(path, st):
+        match = SEGMENT_TIME_RE.search(os.path.basename(path))
+        if match is not None:
+            try:
+                return time.mktime(time.strptime(match.group(1), SEGMENT_TIME_FORMAT))
+            except ValueError:
+                pass
+
+        return st.st_mtime
+
+    def add(self, path, cam, scan_flag=True):
+        """Adds or updates the segment. Without scan_flag keyframes are left to be scanned on the first export."""
+        try:
+            st = os.stat(path)
+            keyframes = scan_keyframes(path, self.keyframe_interval_seconds) if scan_flag else None
+        except OSError as e:
+            log.debug('Catalog: failed to read "%s": %s', path, e)
+            return None
+
+        start_time = self.segment_start_time(path, st)
+        segment = Segment(path, cam, start_time, max(st.st_mtime, start_time), st.st_size, keyframes)
+
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?)',
+                            (path, cam, segment.start_time, segment.end_time, segment.size,
+                             json.dumps(keyframes) if keyframes is not None else None))
+
+        return segment
+
+    def index(self, path, cam):
+        """Returns a future with the Segment, the file is scanned in the catalog thread."""
+        return self.executor.submit(self.add, path, cam)
+
+    def discard(self, path):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM segments WHERE path = ?', (path,))
+
+    def sync(self, files):
+        """Returns a future with (added, removed) numbers of rows.
+
+        files: {path: cam} of the closed segments in the store (or a callable, which returns it in the catalog
+        thread). Segments, which are not indexed yet, are added (scanned on the first export), rows of the removed
+        files are deleted.
+        """
+        return self.executor.submit(self.sync_files, files)
+
+    def sync_files(self, files):
+        if callable(files):
+            files = files()
+
+        with self.lock:
+            paths = set(row[0] for row in self.db.execute('SELECT path FROM segments'))
+
+        removed = [path for path in paths if path not in files and not os.path.exists(path)]
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM segments WHERE path = ?', ((path,) for path in removed))
+
+        added = 0
+        for path, cam in files.items():
+            if path not in paths and self.add(path, cam, scan_flag=False) is not None:
+                added += 1
+
+        return added, len(removed)
+
+    def segments(self, cam, start_time, end_time):
+        """Returns the segments of the cam, which overlap [start_time, end_time), by start time."""
+        with self.lock:
+            rows = self.db.execute('SELECT path, cam, start_time, end_time, size, keyframes FROM segments '
+                                   'WHERE cam = ? AND start_time < ? AND end_time > ? ORDER BY start_time',
+                                   (cam, end_time, start_time)).fetchall()
+
+        return [Segment(path, cam, segment_start_time, segment_end_time, size,
+                        [tuple(keyframe) for keyframe in json.loads(keyframes)] if keyframes is not None else None)
+                for path, cam, segment_start_time, segment_end_time, size, keyframes in rows]
+
+    def ranges(self, cam, start_time, end_time):
+        """Returns [(path, begin, end)] byte ranges, which cover the time range, cut at the nearest keyframes
+        outside of it.
+        """
+        ranges = []
+
+        for segment in self.segments(cam, start_time, end_time):
+            if segment.keyframes is None:
+                segment = self.add(segment.path, segment.cam) or segment
+
+            begin = 0
+            end = segment.size
+
+            for seconds, offset in segment.keyframes or ():
+                if segment.start_time + seconds <= start_time:
+                    begin = offset
+                elif segment.start_time + seconds >= end_time:
+                    end = offset
+                    break
+
+            if end > begin:
+                ranges.append((segment.path, begin, end))
+
+        return ranges
+
+    def export(self, cam, start_time, end_time, output):
+        """Writes the time range of the cam to output. A .ts output is a copy of the byte ranges, other formats
+        are remuxed by 'ffmpeg -c copy'. Returns the number of bytes copied from the segments.
+        """
+        ranges = self.ranges(cam, start_time, end_time)
+        if not ranges:
+            raise CatalogError('No recordings of "%s" from %s to %s' %
+                               (cam, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)),
+                                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time))))
+
+        if output.endswith('.ts'):
+            with open(output, 'wb') as out:
+                self.copy_ranges(ranges, out)
+        else:
+            try:
+                ffmpeg = subprocess.Popen(['ffmpeg', '-loglevel', 'warning', '-y', '-f', 'mpegts', '-i', 'pipe:0',
+                                           '-c', 'copy', output], stdin=subprocess.PIPE)
+            except OSError as e:
+                raise CatalogError('Failed to run ffmpeg: %s' % e)
+
+            try:
+                self.copy_ranges(ranges, ffmpeg.stdin)
+            finally:
+                ffmpeg.stdin.close()
+
+            if ffmpeg.wait() != 0:
+                raise CatalogError('ffmpeg exited with code: %s' % ffmpeg.returncode)
+
+        return sum(end - begin for _, begin, end in ranges)
+
+    @staticmethod
+    def copy_ranges(ranges, out):
+        for path, begin, end in ranges:
+            with open(path, 'rb') as f:
+                if begin:
+                    out.write(ts_tables(f))
+                copy_range(f, out, begin, end)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
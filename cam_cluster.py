@@ -0,0 +1,156 @@
+import time
+import bisect
+import struct
+import socket
+import sqlite3
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    node TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    cam TEXT PRIMARY KEY,
+    node TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+'''
+
+# Rows of dead nodes are shown by status() for this number of seconds
+DEAD_NODE_KEEP_SECONDS = 3600
+
+
+def ring_hash(key):
+    return struct.unpack('>Q', hashlib.md5(key.encode('utf-8')).digest()[:8])[0]
+
+
+class HashRing:
+    """Consistent hashing of cams to nodes. Every node has vnodes points on the ring, a cam belongs to the node of
+    the first point after the cam hash. A joining node takes about 1/N of the cams, all from the other nodes, and
+    no cam moves between the old nodes.
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        self.points = sorted((ring_hash('%s#%i' % (node, i)), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+
+        return self.points[bisect.bisect(self.hashes, ring_hash(key)) % len(self.points)][1]
+
+
+class ClusterView:
+    def __init__(self, nodes, owned, release):
+        # Live nodes, cams with the lease held by this node, cams to stop and hand over to their ring owners
+        self.nodes = nodes
+        self.owned = owned
+        self.release = release
+
+
+class Cluster:
+    """Cam sharding between cam_streamer instances through a coordination store, a SQLite file shared by the nodes.
+
+    Every heartbeat a node extends its own row in nodes and its cam leases by lease_seconds. Cams are assigned by
+    a HashRing of the live nodes; a cam is run by the node, which holds its lease, so a cam is never run twice.
+    A cam leaves a node, which is not its ring owner anymore, only after its processes have exited, then the lease
+    is released for the new owner. Leases of a dead node expire together with its node row, so the survivors take
+    its cams over within lease_seconds + heartbeat. Clocks of the nodes have to be synchronized (NTP).
+
+    The store is accessed from a single worker thread, since a network file system could block.
+    """
+
+    def __init__(self, path, node=None, lease_seconds=10, vnodes=64):
+        self.path = path
+        self.node = node or socket.gethostname()
+        self.lease_seconds = lease_seconds
+        self.vnodes = vnodes
+        self.started = time.time()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cluster')
+        # Rollback journal: WAL needs shared memory, which a network file system does not provide
+        self.db = sqlite3.connect(path, timeout=lease_seconds / 2.0, isolation_level=None, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def tick(self, cams, running):
+        """Returns a future with the ClusterView. cams: names of the configured cams, running: cams, which
+        processes are not stopped yet.
+        """
+        return self.executor.submit(self.heartbeat, list(cams), set(running))
+
+    def heartbeat(self, cams, running):
+        now = time.time()
+        expires = now + self.lease_seconds
+        owned = set()
+        release = set()
+
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)', (self.node, self.started, expires))
+            self.db.execute('DELETE FROM nodes WHERE expires < ?', (now - DEAD_NODE_KEEP_SECONDS,))
+            nodes = [row[0] for row in self.db.execute('SELECT node FROM nodes WHERE expires > ? ORDER BY node',
+                                                       (now,))]
+            ring = HashRing(nodes, self.vnodes)
+            leases = dict((cam, (node, lease_expires)) for cam, node, lease_expires in
+                          self.db.execute('SELECT cam, node, expires FROM leases'))
+
+            for cam in cams:
+                node, lease_expires = leases.get(cam, (None, 0))
+
+                if ring.owner(cam) == self.node:
+                    if node is None or node == self.node or lease_expires <= now:
+                        self.db.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)', (cam, self.node, expires))
+                        owned.add(cam)
+                elif node == self.node:
+                    if cam in running:
+                        # Kept until the cam processes have exited
+                        self.db.execute('UPDATE leases SET expires = ? WHERE cam = ?', (expires, cam))
+                        release.add(cam)
+                    else:
+                        self.db.execute('DELETE FROM leases WHERE cam = ? AND node = ?', (cam, self.node))
+
+            # Leases of the cams, which are not configured anymore
+            for cam, (node, _) in leases.items():
+                if node == self.node and cam not in cams and cam not in running:
+                    self.db.execute('DELETE FROM leases WHERE cam = ? AND node = ?', (cam, self.node))
+
+            self.db.execute('COMMIT')
+        except BaseException:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            raise
+
+        return ClusterView(nodes, owned, release)
+
+    def leave(self):
+        """Releases the leases and the node row, so the other nodes take the cams over at once."""
+        self.executor.shutdown(wait=True)
+
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('DELETE FROM leases WHERE node = ?', (self.node,))
+            self.db.execute('DELETE FROM nodes WHERE node = ?', (self.node,))
+            self.db.execute('COMMIT')
+        except sqlite3.Error as e:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            log.warning('Cluster: failed to leave, leases expire in %s seconds: %s', self.lease_seconds, e)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def status(self):
+        """Returns [(node, expires, [cams])] of the nodes and the lease holders."""
+        now = time.time()
+        nodes = dict((node, (expires, [])) for node, expires in self.db.execute('SELECT node, expires FROM nodes'))
+
+        for cam, node in self.db.execute('SELECT cam, node FROM leases WHERE expires > ? ORDER BY cam', (now,)):
+            nodes.setdefault(node, (0, []))[1].append(cam)
+
+        return [(node, expires, cams) for node, (expires, cams) in sorted(nodes.items())]
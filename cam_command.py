@@ -0,0 +1,128 @@
+import os
+import re
+import glob
+import shlex
+
+SHELL_OPERATOR_CHARS = set('();<>|&')
+SED_SUBSTITUTE_RE = re.compile(r'^s(.)(.*?)\1(.*?)\1(g?)$')
+
+
+class CommandError(Exception):
+    pass
+
+
+def substitute(text):
+    """Evaluates a command substitution natively, without a shell.
+
+    Supported: 'ls GLOB...' (matched paths), 'readlink PATH' (PATH could be a glob), each optionally piped to
+    "sed 's/REGEX/REPLACEMENT/[g]'" stages.
+    """
+    stages = [stage.strip() for stage in text.split('|')]
+
+    try:
+        words = shlex.split(stages[0])
+    except ValueError as e:
+        raise CommandError('Failed to parse `%s`: %s' % (text, e))
+
+    if len(words) >= 2 and words[0] == 'ls' and not any(word.startswith('-') for word in words[1:]):
+        paths = []
+
+        for pattern in words[1:]:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise CommandError('No such file: %s' % pattern)
+            paths.extend(matches)
+
+        output = ' '.join(paths)
+    elif len(words) == 2 and words[0] == 'readlink':
+        matches = sorted(glob.glob(words[1])) or [words[1]]
+
+        try:
+            output = os.readlink(matches[0])
+        except OSError as e:
+            raise CommandError('Failed to read link %s: %s' % (words[1], e))
+    else:
+        raise CommandError('Command substitution is not supported in exec mode: `%s`' % text)
+
+    for stage in stages[1:]:
+        try:
+            words = shlex.split(stage)
+        except ValueError as e:
+            raise CommandError('Failed to parse `%s`: %s' % (text, e))
+
+        match = SED_SUBSTITUTE_RE.match(words[1]) if len(words) == 2 and words[0] == 'sed' else None
+        if match is None:
+            raise CommandError('Command substitution is not supported in exec mode: `%s`' % text)
+
+        replacement = re.sub(r'(?<!\\)&', r'\\g<0>', match.group(3))
+        output = re.sub(match.group(2), replacement, output, count=0 if match.group(4) else 1)
+
+    return output.strip()
+
+
+def expand(cmd):
+    """Replaces the backtick command substitutions of cmd by their output, quoted for its place in cmd."""
+    cmd = cmd.replace('\\\n', '')
+    result = []
+    quote = None
+    pos = 0
+
+    while pos < len(cmd):
+        char = cmd[pos]
+
+        if char == '\\' and quote != "'":
+            result.append(cmd[pos:pos + 2])
+            pos += 2
+            continue
+
+        if char == '`' and quote != "'":
+            end = cmd.find('`', pos + 1)
+            if end < 0:
+                raise CommandError('Unterminated command substitution')
+
+            output = substitute(cmd[pos + 1:end])
+            if quote == '"':
+                result.append(re.sub(r'([\\"$`])', r'\\\1', output))
+            else:
+                result.append(shlex.quote(output))
+
+            pos = end + 1
+            continue
+
+        if char in ('"', "'"):
+            if quote is None:
+                quote = char
+            elif quote == char:
+                quote = None
+
+        result.append(char)
+        pos += 1
+
+    return ''.join(result)
+
+
+def argv(cmd):
+    """Returns the argv of a shell command line to be executed without a shell.
+
+    Command substitutions are evaluated by substitute(), a leading 'exec' is dropped. Pipes, redirections and
+    other shell operators require a shell, so CommandError is raised for them.
+    """
+    lexer = shlex.shlex(expand(cmd), posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+
+    try:
+        words = list(lexer)
+    except ValueError as e:
+        raise CommandError('Failed to parse command: %s' % e)
+
+    for word in words:
+        if word and set(word) <= SHELL_OPERATOR_CHARS:
+            raise CommandError('Shell operator "%s" is not supported in exec mode' % word)
+
+    if words and words[0] == 'exec':
+        words = words[1:]
+
+    if not words:
+        raise CommandError('Command is empty')
+
+    return words
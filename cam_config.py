@@ -0,0 +1,79 @@
+import os
+import json
+import glob
+import logging
+
+log = logging.getLogger(__name__)
+
+# Changes, when the cached form changes
+CACHE_FORMAT = 1
+
+
+class ConfigDict(dict):
+    """Evaluated values of a config. A missing key raises AttributeError, as config.Config does."""
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            raise AttributeError(key)
+
+
+def plain(value):
+    """Evaluates a config.Config value: expressions are computed, mappings and sequences become dicts and lists."""
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+
+    if hasattr(value, 'keys'):
+        return dict((key, plain(value[key])) for key in value.keys())
+
+    return [plain(item) for item in value]
+
+
+class ConfigCache:
+    """The main and the merged cam configs in a JSON file next to the main config.
+
+    It is valid while the main config and the files of its cam_cfg_mask have the same names, sizes and mtimes, so
+    a run with unchanged configs reads one JSON file instead of parsing every config with the config library.
+    """
+
+    def __init__(self, cfg_dir, cfg_filename):
+        self.cfg_dir = cfg_dir
+        self.cfg_file = os.path.join(cfg_dir, cfg_filename)
+        self.path = os.path.join(cfg_dir, '.%s.cache.json' % cfg_filename)
+
+    def files_state(self, cam_cfg_mask):
+        """Returns {path: [mtime ns, size]} of the config files."""
+        state = {}
+
+        for path in set(glob.glob(os.path.join(self.cfg_dir, cam_cfg_mask), recursive=True)) | {self.cfg_file}:
+            stat = os.stat(path)
+            state[path] = [stat.st_mtime_ns, stat.st_size]
+
+        return state
+
+    def load(self):
+        """Returns (main config, cam configs) or None, when the cache is missing or stale."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+
+            if data['format'] != CACHE_FORMAT or data['files'] != self.files_state(data['main']['cam_cfg_mask']):
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        return ConfigDict(data['main']), [ConfigDict(cam) for cam in data['cams']]
+
+    def save(self, main, cams, state):
+        """state: files_state() taken before the configs were parsed. Nothing is saved, if a file has changed since."""
+        try:
+            if self.files_state(main['cam_cfg_mask']) != state:
+                log.debug('Configs have changed while parsed, the cache is not written')
+                return
+
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'format': CACHE_FORMAT, 'files': state, 'main': main, 'cams': cams}, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            log.debug('Config cache "%s" is not written: %s', self.path, e)
@@ -0,0 +1,212 @@
+import os
+import json
+import socket
+import logging
+import threading
+import http.client
+import http.server
+import concurrent.futures
+from cam_metrics import ThreadingUnixHTTPServer
+
+log = logging.getLogger(__name__)
+
+CAM_ACTIONS = ('start', 'stop', 'restart', 'reset')
+
+
+class ControlError(Exception):
+    def __init__(self, message, status=409):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ControlModel:
+    """In-memory state of the daemon and its cams, which the supervisor updates on every change. Queries read it
+    from the server threads, they never touch the supervisor, the process table or the disk.
+
+    A cam entry is replaced as a whole, never changed in place, so a reader sees a consistent entry.
+    """
+
+    def __init__(self):
+        self.cams = {}
+        self.daemon = {}
+        # name: callback, a section is read at query time (cheap attribute reads of other threads' counters)
+        self.sections = {}
+
+    def set_daemon(self, daemon):
+        self.daemon = daemon
+
+    def set_cam(self, name, status):
+        self.cams[name] = status
+
+    def set_cams(self, cams):
+        self.cams = cams
+
+    def cam(self, name):
+        return self.cams.get(name)
+
+    def cam_list(self):
+        return [dict(status, name=name) for name, status in sorted(list(self.cams.items()))]
+
+    def snapshot(self):
+        # A copy, the supervisor could add a cam while the snapshot is encoded
+        snapshot = {'daemon': self.daemon, 'cams': dict(self.cams)}
+
+        for name, callback in self.sections.items():
+            try:
+                snapshot[name] = callback()
+            except Exception as e:
+                log.debug('Control section "%s" failed: %s', name, e)
+
+        return snapshot
+
+
+class ControlHandler(http.server.BaseHTTPRequestHandler):
+    """GET  /state                  - full snapshot
+    GET  /cams                   - cams with their state
+    GET  /cams/CAM               - a cam
+    POST /cams/CAM/ACTION        - start, stop, restart or reset a cam
+    POST /cleaner/run            - run the cleaner now
+    """
+
+    def do_GET(self):
+        model = self.server.control.model
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+
+        if parts == ['state']:
+            self.reply(200, model.snapshot())
+        elif parts == ['cams']:
+            self.reply(200, {'cams': model.cam_list()})
+        elif len(parts) == 2 and parts[0] == 'cams' and model.cam(parts[1]) is not None:
+            self.reply(200, dict(model.cam(parts[1]), name=parts[1]))
+        else:
+            self.reply(404, {'error': 'Not found: %s' % self.path})
+
+    def do_POST(self):
+        control = self.server.control
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+
+        if len(parts) == 3 and parts[0] == 'cams' and parts[2] in CAM_ACTIONS:
+            action = (control.cam_action, parts[1], parts[2])
+        elif parts == ['cleaner', 'run']:
+            action = (control.cleaner_action,)
+        else:
+            self.reply(404, {'error': 'Not found: %s' % self.path})
+            return
+
+        try:
+            self.reply(200, control.call(*action))
+        except ControlError as e:
+            self.reply(e.status, {'error': str(e)})
+        except Exception as e:
+            log.error('Control action %s failed: %s', self.path, e)
+            self.reply(500, {'error': str(e)})
+
+    def reply(self, status, data):
+        body = (json.dumps(data, indent=2, sort_keys=True) + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ControlServer:
+    """Local control API: JSON over HTTP on 'unix:/path/to/socket' (owner only) or 'host:port'.
+
+    Queries are answered by the server threads from the model. Actions are run by the supervisor loop:
+    cam_action(cam, action) and cleaner_action() are called there and return a JSON-able result or raise
+    ControlError.
+    """
+
+    ACTION_TIMEOUT_SECONDS = 30
+
+    def __init__(self, listen, loop, model, cam_action, cleaner_action):
+        self.listen = listen
+        self.loop = loop
+        self.model = model
+        self.cam_action = cam_action
+        self.cleaner_action = cleaner_action
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.listen.startswith('unix:'):
+            path = self.listen[len('unix:'):]
+            if os.path.exists(path):
+                os.remove(path)
+
+            umask = os.umask(0o077)
+            try:
+                self.server = ThreadingUnixHTTPServer(path, ControlHandler)
+            finally:
+                os.umask(umask)
+        else:
+            host, port = self.listen.rsplit(':', 1)
+            self.server = http.server.ThreadingHTTPServer((host, int(port)), ControlHandler)
+            self.server.daemon_threads = True
+
+        self.server.control = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='control', daemon=True)
+        self.thread.start()
+        log.info('Control API is served on: %s', self.listen)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+            if self.listen.startswith('unix:') and os.path.exists(self.listen[len('unix:'):]):
+                os.remove(self.listen[len('unix:'):])
+
+            self.server = None
+
+    def call(self, callback, *args):
+        """Runs callback(*args) in the supervisor loop and waits for its result."""
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                future.set_result(callback(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+
+        try:
+            return future.result(timeout=self.ACTION_TIMEOUT_SECONDS)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ControlError('Supervisor did not answer within %s seconds' % self.ACTION_TIMEOUT_SECONDS, 503)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(listen, method, path, timeout=ControlServer.ACTION_TIMEOUT_SECONDS + 5):
+    """Client of the control API. Returns (HTTP status, decoded JSON)."""
+    if listen.startswith('unix:'):
+        connection = UnixHTTPConnection(listen[len('unix:'):], timeout)
+    else:
+        host, port = listen.rsplit(':', 1)
+        connection = http.client.HTTPConnection(host, int(port), timeout=timeout)
+
+    try:
+        connection.request(method, path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+    finally:
+        connection.close()
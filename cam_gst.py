@@ -0,0 +1,129 @@
+import time
+import logging
+
+try:
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+except (ImportError, ValueError):
+    Gst = None
+
+log = logging.getLogger(__name__)
+
+
+class PipelineError(Exception):
+    pass
+
+
+def gst_available():
+    return Gst is not None
+
+
+def pipeline_description(video, audio=None, stream_sink=None, record_flag=True):
+    """Returns the gst-launch description of a cam pipeline.
+
+    The encoded video (and audio) branches are split by tees into flvmux ! stream_sink and into the splitmuxsink
+    named 'rec', which writes the segments.
+    """
+    branches = [('vtee', video, 'rec.video')]
+    if audio:
+        branches.append(('atee', audio, 'rec.audio_0'))
+
+    parts = []
+    for tee, branch, rec_pad in branches:
+        parts.append('%s ! tee name=%s' % (branch.strip(), tee))
+
+        if stream_sink:
+            parts.append('%s. ! queue ! smux.' % tee)
+
+        if record_flag:
+            parts.append('%s. ! queue ! %s' % (tee, rec_pad))
+
+    if stream_sink:
+        parts.append('flvmux name=smux streamable=true ! %s' % stream_sink)
+
+    if record_flag:
+        parts.append('splitmuxsink name=rec muxer-factory=mpegtsmux')
+
+    return ' '.join(parts)
+
+
+class Pipeline:
+    """In-process GStreamer pipeline of a cam, which replaces both the streamer and the capturer processes.
+
+    The bus is read through its poll fd from the supervisor loop, no GLib main loop is needed. read_messages()
+    returns the messages, which drive the cam supervision: (KIND_PLAYING, None), (KIND_SEGMENT, closed segment
+    path), (KIND_ERROR, text), (KIND_EOS, None).
+    """
+
+    KIND_PLAYING = 'playing'
+    KIND_SEGMENT = 'segment'
+    KIND_ERROR = 'error'
+    KIND_EOS = 'eos'
+
+    def __init__(self, name, description, segment_location=None, segment_seconds=0):
+        if Gst is None:
+            raise PipelineError('PyGObject with GStreamer 1.0 is not installed')
+
+        if not Gst.is_initialized():
+            Gst.init(None)
+
+        self.name = name
+        self.segment_location = segment_location
+
+        try:
+            self.pipeline = Gst.parse_launch(description)
+        except Exception as e:
+            raise PipelineError('Failed to build pipeline: %s' % e)
+
+        self.pipeline.set_name(name)
+        rec = self.pipeline.get_by_name('rec')
+
+        if rec is not None:
+            rec.set_property('max-size-time', int(segment_seconds * Gst.SECOND))
+            rec.connect('format-location', self.on_format_location)
+
+        self.bus = self.pipeline.get_bus()
+        self.fd = self.bus.get_pollfd().fd
+
+    def on_format_location(self, splitmux, fragment_id):
+        # Called from a streaming thread: segments are named by their start time like the capturer ones
+        return time.strftime(self.segment_location)
+
+    def fileno(self):
+        return self.fd
+
+    def start(self):
+        if self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+            self.stop()
+            raise PipelineError('Failed to start pipeline')
+
+    def stop(self):
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline = None
+
+    def read_messages(self):
+        messages = []
+
+        while self.pipeline is not None:
+            message = self.bus.pop()
+            if message is None:
+                break
+
+            if message.type == Gst.MessageType.ERROR:
+                error, debug = message.parse_error()
+                log.debug('Pipeline "%s" error details: %s', self.name, debug)
+                messages.append((self.KIND_ERROR, '%s: %s' % (message.src.get_name(), error.message)))
+            elif message.type == Gst.MessageType.EOS:
+                messages.append((self.KIND_EOS, None))
+            elif message.type == Gst.MessageType.STATE_CHANGED and message.src == self.pipeline:
+                _, new_state, _ = message.parse_state_changed()
+                if new_state == Gst.State.PLAYING:
+                    messages.append((self.KIND_PLAYING, None))
+            elif message.type == Gst.MessageType.ELEMENT:
+                structure = message.get_structure()
+                if structure is not None and structure.get_name() == 'splitmuxsink-fragment-closed':
+                    messages.append((self.KIND_SEGMENT, structure.get_string('location')))
+
+        return messages
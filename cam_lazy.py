@@ -0,0 +1,20 @@
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module, which is imported on the first attribute access, so a run, which does not use a
+    subsystem (-daemon stop, a cam with no motion detection), does not pay for its import and memory.
+
+    The import itself is thread safe. An attribute is cached in the instance once it is read.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._name), attr)
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
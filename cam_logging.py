@@ -0,0 +1,176 @@
+import json
+import time
+import queue
+import logging
+import datetime
+import threading
+import logging.handlers
+
+# Arguments of these types could be formatted later by the writer thread, others could change before that
+SCALAR_TYPES = (str, int, float, bool, type(None))
+# extra of a message, which is a repeat, when it differs in numbers only (a counter, a rate): it is not the case
+# for PIDs, exit codes or ports
+ANY_NUMBERS = {'repeat_any_numbers': True}
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Puts the records to a bounded queue and never waits: records are dropped and counted, when it is full.
+
+    Messages are formatted by the writer thread, unless an argument is not a scalar.
+    """
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.args and (isinstance(record.args, dict) or
+                            not all(isinstance(arg, SCALAR_TYPES) for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(threading.Thread):
+    """Background writer of the queued records to the real handlers, so supervision never waits for a slow disk.
+
+    A message repeated more than repeat_burst times within repeat_window_seconds is suppressed, then summarized
+    once the window is over. Messages are the same, when their format and arguments are the same. A message logged
+    with extra=ANY_NUMBERS ignores its numeric arguments: 'Attempt "%s": [%i/%i]' of one cam is a repeat, of another
+    cam is not.
+    """
+
+    FLUSH_SECONDS = 1
+    STOP = object()
+
+    def __init__(self, handlers, queue_size=10000, repeat_burst=3, repeat_window_seconds=60):
+        threading.Thread.__init__(self, name='log', daemon=True)
+        self.handlers = handlers
+        self.queue = queue.Queue(queue_size)
+        self.handler = QueueHandler(self.queue)
+        self.repeat_burst = repeat_burst
+        self.repeat_window_seconds = repeat_window_seconds
+        # key: [window start time, records, suppressed records, last suppressed record]
+        self.repeats = {}
+        self.suppressed = 0
+        self.reported_dropped = 0
+        self.flush_time = 0
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.FLUSH_SECONDS)
+            except queue.Empty:
+                record = None
+
+            if record is self.STOP:
+                break
+
+            try:
+                now = time.time()
+
+                if record is not None and self.admit(record, now):
+                    self.write(record)
+
+                if now >= self.flush_time:
+                    self.flush(now)
+            except Exception:
+                # The writer has to outlive any broken record
+                pass
+
+        self.flush(None)
+
+    def stop(self, timeout=5):
+        """Writes the queued records and the pending summaries."""
+        try:
+            self.queue.put(self.STOP, timeout=timeout)
+        except queue.Full:
+            pass
+
+        self.join(timeout)
+
+    def admit(self, record, now):
+        if not self.repeat_burst:
+            return True
+
+        args = record.args if isinstance(record.args, tuple) else ()
+        if getattr(record, 'repeat_any_numbers', False):
+            args = tuple(arg for arg in args if not isinstance(arg, (int, float)) or isinstance(arg, bool))
+        key = (record.name, record.levelno, record.msg, args)
+        entry = self.repeats.get(key)
+
+        if entry is None or now - entry[0] >= self.repeat_window_seconds:
+            if entry is not None:
+                self.summarize(entry, now)
+            entry = self.repeats[key] = [now, 0, 0, None]
+
+        entry[1] += 1
+        if entry[1] <= self.repeat_burst:
+            return True
+
+        entry[2] += 1
+        entry[3] = record
+        self.suppressed += 1
+        return False
+
+    def summarize(self, entry, now):
+        window_start_time, _, suppressed, record = entry
+        if not suppressed:
+            return
+
+        now = now or time.time()
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = '%s [repeated %i more times in %.0f seconds]' % (record.getMessage(), suppressed,
+                                                                       now - window_start_time)
+        summary.args = None
+        # Stamped when it is written, not at the first suppressed record
+        summary.relativeCreated = record.relativeCreated + (now - record.created) * 1000
+        summary.created = now
+        summary.msecs = (now - int(now)) * 1000
+        self.write(summary)
+
+    def flush(self, now):
+        """Summarizes the finished repeat windows (all, if now is None) and reports the dropped records."""
+        self.flush_time = (now or 0) + self.FLUSH_SECONDS
+
+        for key, entry in list(self.repeats.items()):
+            if now is None or now - entry[0] >= self.repeat_window_seconds:
+                self.summarize(entry, now)
+                del self.repeats[key]
+
+        dropped = self.handler.dropped
+        if dropped != self.reported_dropped:
+            self.write(logging.makeLogRecord({
+                'name': 'log', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': 'Log queue is full, records dropped: %i', 'args': (dropped - self.reported_dropped,)}))
+            self.reported_dropped = dropped
+
+    def write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, thread, message and exception."""
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(data)
@@ -0,0 +1,305 @@
+import os
+import time
+import heapq
+import signal
+import select
+import socket
+import logging
+import itertools
+import selectors
+import collections
+from cam_lazy import LazyModule
+
+log = logging.getLogger(__name__)
+
+# Needed for adopted processes and without pidfd only
+psutil = LazyModule('psutil')
+
+
+class Timer:
+    def __init__(self, when, seq, callback, args):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def wait_pid(pid, timeout):
+    """Waits for a process, not necessarily a child, to exit. Returns False on timeout."""
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        # No pidfd: psutil polls with a growing sleep
+        try:
+            psutil.Process(pid).wait(timeout)
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.TimeoutExpired:
+            return False
+
+        return True
+
+    try:
+        return bool(select.select([pidfd], [], [], timeout)[0])
+    finally:
+        os.close(pidfd)
+
+
+class AdoptedProcess:
+    """Popen like handle of a running process, which is not a child of this one (adopted after a restart).
+
+    It could not be reaped here, so its exit code is unknown: returncode is -1 once the process is gone.
+    """
+
+    adopted_flag = True
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.pid = proc.pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                alive_flag = self.proc.is_running() and self.proc.status() != psutil.STATUS_ZOMBIE
+            except psutil.Error:
+                alive_flag = False
+
+            if not alive_flag:
+                self.returncode = -1
+
+        return self.returncode
+
+
+class EventLoop:
+    """A minimal single threaded event loop of the supervisor.
+
+    It waits in one select() call for:
+    - timers (monotonic time)
+    - readable file descriptors
+    - child process exits (a pidfd per child, or SIGCHLD + waitid() where pidfd is not supported)
+    - signals (delivered through the wakeup socket, so handlers run in the loop, not in a signal context)
+    - callbacks posted from other threads
+    """
+
+    WAKEUP_BYTE = b'\0'
+    ADOPTED_POLL_SECONDS = 1
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.seq = itertools.count()
+        self.pending = collections.deque()
+        self.signal_handlers = {}
+        self.children = {}
+        self.pidfd_flag = hasattr(os, 'pidfd_open')
+        self.busy_seconds = 0.0
+        # Delay of the most late timer run by the last iteration, None - no timer was due
+        self.lag_seconds = None
+
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.add_reader(self.wakeup_r.fileno(), self.on_wakeup)
+        signal.set_wakeup_fd(self.wakeup_w.fileno(), warn_on_full_buffer=False)
+
+    @staticmethod
+    def time():
+        return time.monotonic()
+
+    def add_reader(self, fd, callback, *args):
+        self.selector.register(fd, selectors.EVENT_READ, (callback, args))
+
+    def remove_reader(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, next(self.seq), callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.pending.append((callback, args))
+
+        try:
+            self.wakeup_w.send(self.WAKEUP_BYTE)
+        except (BlockingIOError, OSError):
+            pass
+
+    def add_signal_handler(self, sig, callback):
+        self.signal_handlers[sig] = callback
+        signal.signal(sig, self.signal_noop)
+
+    @staticmethod
+    def signal_noop(s, frame):
+        pass
+
+    def watch_child(self, popen, callback, *args):
+        """Calls callback(popen, *args) from the loop, once the child has exited and has been reaped.
+
+        An AdoptedProcess is watched through its pidfd as well, or polled where pidfd is not supported,
+        as no SIGCHLD is sent for it.
+        """
+        pidfd = None
+
+        if self.pidfd_flag:
+            try:
+                pidfd = os.pidfd_open(popen.pid)
+            except OSError as e:
+                log.warning('pidfd is not supported (%s). Fall back to SIGCHLD', e)
+                self.pidfd_flag = False
+
+        if not self.pidfd_flag and signal.SIGCHLD not in self.signal_handlers:
+            self.add_signal_handler(signal.SIGCHLD, self.on_sigchld)
+
+        self.children[popen.pid] = (popen, pidfd, callback, args)
+
+        if pidfd is not None:
+            self.add_reader(pidfd, self.on_child_exit, popen.pid)
+        elif getattr(popen, 'adopted_flag', False):
+            self.poll_child(popen.pid)
+        elif popen.poll() is not None:
+            self.call_soon_threadsafe(self.on_child_exit, popen.pid)
+
+    def watch_pid(self, pid, callback, *args):
+        """Calls callback(*args) from the loop once the process (any, not only a child) has exited.
+        Returns False where pidfd is not supported.
+        """
+        if not self.pidfd_flag:
+            return False
+
+        try:
+            pidfd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            self.call_soon_threadsafe(callback, *args)
+            return True
+        except OSError:
+            return False
+
+        self.add_reader(pidfd, self.on_pid_exit, pidfd, callback, args)
+        return True
+
+    def on_pid_exit(self, pidfd, callback, args):
+        self.remove_reader(pidfd)
+        os.close(pidfd)
+        callback(*args)
+
+    def unwatch_child(self, pid):
+        child = self.children.pop(pid, None)
+
+        if child is not None and child[1] is not None:
+            self.remove_reader(child[1])
+            os.close(child[1])
+
+        return child
+
+    def on_child_exit(self, pid):
+        child = self.children.get(pid)
+        if child is None:
+            return
+
+        popen = child[0]
+        if popen.poll() is None:
+            return
+
+        _, _, callback, args = self.unwatch_child(pid)
+        callback(popen, *args)
+
+    def poll_child(self, pid):
+        child = self.children.get(pid)
+        if child is None:
+            return
+
+        if child[0].poll() is None:
+            self.call_later(self.ADOPTED_POLL_SECONDS, self.poll_child, pid)
+        else:
+            self.on_child_exit(pid)
+
+    def on_sigchld(self):
+        while True:
+            try:
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            except ChildProcessError:
+                break
+
+            if info is None or info.si_pid == 0:
+                break
+
+            if info.si_pid in self.children:
+                self.on_child_exit(info.si_pid)
+            else:
+                # Not a watched child, reap it here, otherwise waitid() returns it forever
+                try:
+                    os.waitpid(info.si_pid, os.WNOHANG)
+                except ChildProcessError:
+                    pass
+
+    def on_wakeup(self):
+        try:
+            data = self.wakeup_r.recv(4096)
+        except BlockingIOError:
+            return
+
+        for sig in set(data):
+            if sig and sig in self.signal_handlers:
+                self.signal_handlers[sig]()
+
+    def run_once(self):
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+
+        if self.pending:
+            timeout = 0
+        elif self.timers:
+            timeout = max(self.timers[0].when - self.time(), 0)
+        else:
+            timeout = None
+
+        events = self.selector.select(timeout)
+        busy_start_time = self.time()
+
+        # Signals first: a shutdown must be seen before the exits of the children it has been sent to as well
+        events.sort(key=lambda event: event[0].fd != self.wakeup_r.fileno())
+
+        for key, _ in events:
+            callback, args = key.data
+            callback(*args)
+
+        now = self.time()
+        self.lag_seconds = None
+        while self.timers and self.timers[0].when <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.lag_seconds = max(self.lag_seconds or 0.0, self.time() - timer.when)
+                timer.callback(*timer.args)
+
+        while self.pending:
+            callback, args = self.pending.popleft()
+            callback(*args)
+
+        self.busy_seconds = self.time() - busy_start_time
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+
+        for pid in list(self.children):
+            self.unwatch_child(pid)
+
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
@@ -0,0 +1,232 @@
+import os
+import bisect
+import logging
+import threading
+import socketserver
+import http.server
+
+log = logging.getLogger(__name__)
+
+
+class Metric:
+    """Base of a metric family. Updates are plain attribute and dict operations, so they are cheap enough for
+    the supervisor loop, and the scrape thread only reads the values.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def labels_text(self, key, extra=None):
+        pairs = list(zip(self.label_names, key))
+        if extra is not None:
+            pairs.append(extra)
+
+        if not pairs:
+            return ''
+
+        return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                                 for name, value in pairs)
+
+    def remove(self, **labels):
+        self.values.pop(self.key(labels), None)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.metric_type)]
+
+        for key, value in list(self.values.items()):
+            lines.append('%s%s %s' % (self.name, self.labels_text(key), float_text(value)))
+
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+
+class CallbackMetric(Metric):
+    """Value(s) are read at scrape time: callback returns a number or a list of (labels dict, number)."""
+
+    def __init__(self, name, documentation, callback, metric_type='gauge', label_names=()):
+        Metric.__init__(self, name, documentation, label_names)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.metric_type)]
+
+        try:
+            values = self.callback()
+        except Exception as e:
+            log.debug('Metric "%s" callback failed: %s', self.name, e)
+            return lines
+
+        if not isinstance(values, list):
+            values = [({}, values)]
+
+        for labels, value in values:
+            lines.append('%s%s %s' % (self.name, self.labels_text(self.key(labels)), float_text(value)))
+
+        return lines
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        data = self.values.get(key)
+
+        if data is None:
+            # [bucket counts..., +Inf count], sum
+            data = [[0] * (len(self.buckets) + 1), 0.0]
+            self.values[key] = data
+
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.metric_type)]
+
+        for key, data in list(self.values.items()):
+            counts = list(data[0])
+            cumulative = 0
+
+            for bucket, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %i' %
+                             (self.name, self.labels_text(key, ('le', float_text(bucket))), cumulative))
+
+            lines.append('%s_sum%s %s' % (self.name, self.labels_text(key), float_text(data[1])))
+            lines.append('%s_count%s %i' % (self.name, self.labels_text(key), cumulative))
+
+        return lines
+
+
+def float_text(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    if isinstance(value, bool):
+        value = int(value)
+
+    if isinstance(value, int):
+        return str(value)
+
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.add(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.add(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.add(Histogram(name, documentation, label_names, buckets))
+
+    def callback(self, name, documentation, callback, metric_type='gauge', label_names=()):
+        return self.add(CallbackMetric(name, documentation, callback, metric_type, label_names))
+
+    def render(self):
+        lines = []
+
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        return request, ('unix', 0)
+
+
+class MetricsServer:
+    """Serves the registry in the Prometheus text format on 'host:port' or 'unix:/path/to/socket'
+    from its own threads, so scrapes never block the supervisor loop.
+    """
+
+    def __init__(self, registry, listen):
+        self.registry = registry
+        self.listen = listen
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.listen.startswith('unix:'):
+            path = self.listen[len('unix:'):]
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = ThreadingUnixHTTPServer(path, MetricsHandler)
+        else:
+            host, port = self.listen.rsplit(':', 1)
+            self.server = http.server.ThreadingHTTPServer((host, int(port)), MetricsHandler)
+            self.server.daemon_threads = True
+
+        self.server.registry = self.registry
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        log.info('Metrics are served on: %s', self.listen)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+            if self.listen.startswith('unix:') and os.path.exists(self.listen[len('unix:'):]):
+                os.remove(self.listen[len('unix:'):])
+
+            self.server = None
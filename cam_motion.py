@@ -0,0 +1,71 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class MotionError(Exception):
+    pass
+
+
+def numpy_available():
+    return numpy is not None
+
+
+class MotionDetector:
+    """Frame differencing of the raw 8-bit grayscale frames of a cam (width * height bytes each).
+
+    A pixel is changed, when its brightness differs from the previous frame by more than threshold. There is
+    motion, when the changed pixels are at least min_area_percent of the pixels outside the mask. mask: rectangles
+    [x, y, width, height] in percents of the frame, which are ignored (trees, clocks on the picture).
+    The buffers are allocated once, a 160x120 frame takes well below a millisecond.
+    """
+
+    def __init__(self, width, height, threshold=25, min_area_percent=1.0, mask=()):
+        if not numpy_available():
+            raise MotionError('Motion detection requires NumPy')
+
+        if width <= 0 or height <= 0:
+            raise MotionError('Wrong frame size: %sx%s' % (width, height))
+
+        self.width = width
+        self.height = height
+        self.frame_size = width * height
+        self.threshold = threshold
+        self.min_area_percent = min_area_percent
+        self.previous = None
+        self.diff = numpy.empty((height, width), numpy.int16)
+        self.changed = numpy.empty((height, width), bool)
+        self.mask = numpy.ones((height, width), bool)
+
+        for rect in mask:
+            try:
+                x, y, w, h = [float(value) for value in rect]
+            except (TypeError, ValueError):
+                raise MotionError('Wrong mask rectangle, [x, y, width, height] expected: %s' % list(rect))
+
+            self.mask[int(height * y / 100):int(round(height * (y + h) / 100)),
+                      int(width * x / 100):int(round(width * (x + w) / 100))] = False
+
+        self.pixels = int(numpy.count_nonzero(self.mask))
+        if not self.pixels:
+            raise MotionError('The mask covers the whole frame')
+
+    def update(self, frame):
+        """Takes the next frame (bytes), returns the changed pixels percent (0 for the first frame)."""
+        current = numpy.frombuffer(frame, numpy.uint8).reshape(self.height, self.width)
+        previous = self.previous
+        self.previous = current
+
+        if previous is None:
+            return 0.0
+
+        numpy.subtract(current, previous, out=self.diff, dtype=numpy.int16)
+        numpy.abs(self.diff, out=self.diff)
+        numpy.greater(self.diff, self.threshold, out=self.changed)
+        numpy.logical_and(self.changed, self.mask, out=self.changed)
+
+        return 100.0 * int(numpy.count_nonzero(self.changed)) / self.pixels
+
+    def motion(self, changed_percent):
+        return changed_percent >= self.min_area_percent
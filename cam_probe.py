@@ -0,0 +1,75 @@
+import time
+import logging
+import requests
+import requests.adapters
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class ProbeResult:
+    def __init__(self, url, http_code=0, latency=0.0, error=None, received_bytes=0, duration=0.0):
+        self.url = url
+        self.http_code = http_code
+        self.latency = latency
+        self.error = error
+        self.received_bytes = received_bytes
+        self.duration = duration
+
+
+class Prober:
+    """Runs HTTP HEAD probes of the streamer endpoints concurrently.
+
+    Probes are executed by a bounded thread pool over one keep-alive session, so a slow or dead endpoint
+    delays neither the main loop nor the probes of other cams.
+    """
+
+    def __init__(self, max_workers=8):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='probe')
+
+    def head(self, url, timeout):
+        start_time = time.time()
+
+        try:
+            http_code = self.session.head(url, timeout=timeout).status_code
+        except requests.exceptions.RequestException as e:
+            return ProbeResult(url, latency=time.time() - start_time, error=e)
+
+        return ProbeResult(url, http_code=http_code, latency=time.time() - start_time)
+
+    def get(self, url, timeout, duration):
+        """Reads the stream for duration seconds to measure its throughput."""
+        start_time = time.time()
+        received_bytes = 0
+
+        try:
+            with self.session.get(url, timeout=timeout, stream=True) as response:
+                latency = time.time() - start_time
+
+                if response.status_code == 200:
+                    for chunk in response.iter_content(chunk_size=16384):
+                        received_bytes += len(chunk)
+                        if time.time() - start_time - latency >= duration:
+                            break
+        except requests.exceptions.RequestException as e:
+            return ProbeResult(url, latency=time.time() - start_time, error=e, received_bytes=received_bytes,
+                               duration=time.time() - start_time)
+
+        return ProbeResult(url, http_code=response.status_code, latency=latency, received_bytes=received_bytes,
+                           duration=time.time() - start_time - latency)
+
+    def probe(self, url, timeout):
+        """Returns a future with the ProbeResult."""
+        return self.executor.submit(self.head, url, timeout)
+
+    def throughput(self, url, timeout, duration):
+        """Returns a future with the ProbeResult."""
+        return self.executor.submit(self.get, url, timeout, duration)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,113 @@
+import time
+import logging
+import collections
+import psutil
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class Sample:
+    def __init__(self, sample_time, cpu_percent, rss_bytes, fds, threads, processes):
+        self.time = sample_time
+        self.cpu_percent = cpu_percent
+        self.rss_bytes = rss_bytes
+        self.fds = fds
+        self.threads = threads
+        self.processes = processes
+
+
+class ResourceSampler:
+    """Collects CPU, RSS, open fds and threads of process trees (a root PID and all its descendants).
+
+    One pass reads the process table once to build the parent map and then a few /proc files per process, so
+    its cost grows with the number of processes, not with the number of passes per process. Passes run in the
+    sampler thread. Samples are kept in a rolling window per key.
+    """
+
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self.processes = {}
+        self.windows = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='resources')
+
+    def submit(self, targets):
+        """targets: list of (key, root PID). Returns a future with {key: Sample}."""
+        return self.executor.submit(self.sample, targets)
+
+    def process(self, pid):
+        proc = self.processes.get(pid)
+
+        if proc is None:
+            proc = psutil.Process(pid)
+            # The first cpu_percent() call of a process returns 0, it is a starting point
+            proc.cpu_percent()
+            self.processes[pid] = proc
+
+        return proc
+
+    def sample(self, targets):
+        children = collections.defaultdict(list)
+        for proc in psutil.process_iter(['ppid']):
+            children[proc.info['ppid']].append(proc.pid)
+
+        now = time.time()
+        seen = set()
+        samples = {}
+
+        for key, root_pid in targets:
+            cpu_percent = 0.0
+            rss_bytes = 0
+            fds = 0
+            threads = 0
+            processes = 0
+
+            tree = [root_pid]
+            while tree:
+                pid = tree.pop()
+                tree.extend(children.get(pid, ()))
+
+                try:
+                    proc = self.process(pid)
+                    with proc.oneshot():
+                        cpu_percent += proc.cpu_percent()
+                        rss_bytes += proc.memory_info().rss
+                        fds += proc.num_fds()
+                        threads += proc.num_threads()
+                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                    self.processes.pop(pid, None)
+                    continue
+
+                seen.add(pid)
+                processes += 1
+
+            sample = Sample(now, cpu_percent, rss_bytes, fds, threads, processes)
+            samples[key] = sample
+
+            window = self.windows.setdefault(key, collections.deque())
+            window.append(sample)
+            while window and now - window[0].time > self.window_seconds:
+                window.popleft()
+
+        for pid in [pid for pid in self.processes if pid not in seen]:
+            del self.processes[pid]
+
+        for key in [key for key in self.windows if key not in samples]:
+            del self.windows[key]
+
+        return samples
+
+    def breached(self, key, attr, threshold, seconds):
+        """True, when every sample of the last seconds is above threshold and the window covers the seconds."""
+        window = self.windows.get(key)
+        if not window or window[-1].time - window[0].time < seconds:
+            return False
+
+        since = window[-1].time - seconds
+        return all(getattr(sample, attr) > threshold for sample in window if sample.time >= since)
+
+    def forget(self, key):
+        self.windows.pop(key, None)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,656 @@
+import os
+import sys
+import time
+import struct
+import ctypes
+import logging
+import threading
+from sortedcontainers import SortedList
+
+log = logging.getLogger(__name__)
+
+
+class Inotify:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is available on Linux only')
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.inotify_init1.argtypes = [ctypes.c_int]
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'inotify_init1: %s' % os.strerror(errno))
+
+        self.wd_path = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'inotify_add_watch "%s": %s' % (path, os.strerror(errno)))
+
+        self.wd_path[wd] = path
+        return wd
+
+    def read_events(self):
+        events = []
+
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            if not buf:
+                break
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, name_len = self.EVENT_HEADER.unpack_from(buf, offset)
+                offset += self.EVENT_HEADER.size
+                name = buf[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+
+                dir_path = self.wd_path.get(wd)
+                if mask & self.IN_IGNORED:
+                    self.wd_path.pop(wd, None)
+
+                path = None
+                if dir_path is not None:
+                    path = os.path.join(dir_path, os.fsdecode(name)) if name else dir_path
+
+                events.append((mask, path))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.wd_path.clear()
+
+
+class StoreIndex:
+    """Incrementally maintained index of the files under cap_dir.
+
+    Files are kept in age ordered lists (whole store and per cam, where cam is the first level directory under
+    cap_dir), so the oldest file is found in O(log n), and running byte totals make a size check O(1).
+    The index follows the file system with inotify where available and falls back to a cheap rescan, which
+    lists only the directories whose mtime has changed.
+    """
+
+    MODE_AUTO = 'auto'
+    MODE_INOTIFY = 'inotify'
+    MODE_SCAN = 'scan'
+
+    # A directory modified less than this number of seconds ago is listed again on the next scan,
+    # since a coarse mtime resolution can hide a second change within the same tick
+    DIR_MTIME_SETTLE_SECONDS = 2
+
+    def __init__(self, root, mode=MODE_AUTO):
+        self.root = os.path.normpath(root)
+        self.mode = mode
+        self.lock = threading.RLock()
+        self.inotify = None
+
+        self.files = {}
+        self.by_age = SortedList()
+        self.cam_by_age = {}
+        self.cam_bytes = {}
+        self.total_bytes = 0
+        self.hot = set()
+        self.dirs = {}
+        # Paths of the segments closed since the last take_closed() call, None - not collected
+        self.closed = None
+        # Set, when the initial scan of load() is done
+        self.ready = threading.Event()
+
+    def start(self):
+        if self.mode in (self.MODE_AUTO, self.MODE_INOTIFY):
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                if self.mode == self.MODE_INOTIFY:
+                    raise
+                log.warning('Store index: inotify is unavailable (%s). Fall back to scan', e)
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def load(self):
+        """The initial full scan. It may take minutes on a large store, so the cleaner thread runs it."""
+        load_time = time.time()
+
+        with self.lock:
+            self.rescan(full=True)
+
+        self.ready.set()
+        log.info('Store index (%s): %i files, %.3f Gb, seconds: %.3f', 'inotify' if self.inotify else 'scan',
+                 len(self.files), 1.0 * self.total_bytes / 1024 / 1024 / 1024, time.time() - load_time)
+
+    def stop(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def fileno(self):
+        if self.inotify is None:
+            return None
+        return self.inotify.fileno()
+
+    def cam_of(self, path):
+        head = os.path.relpath(path, self.root).split(os.sep, 1)
+
+        if len(head) == 1:
+            return ''
+        return head[0]
+
+    def add(self, path, st=None):
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.discard(path)
+                return
+
+        entry = self.files.get(path)
+        if entry is not None:
+            cam, mtime, size = entry
+            if mtime == st.st_mtime and size == st.st_size:
+                return
+            self.by_age.remove((mtime, path))
+            self.cam_by_age[cam].remove((mtime, path))
+            self.cam_bytes[cam] -= size
+            self.total_bytes -= size
+        else:
+            cam = self.cam_of(path)
+            dir_entry = self.dirs.get(os.path.dirname(path))
+            if dir_entry is not None:
+                dir_entry[1].add(path)
+
+        self.files[path] = (cam, st.st_mtime, st.st_size)
+        self.by_age.add((st.st_mtime, path))
+        self.cam_by_age.setdefault(cam, SortedList()).add((st.st_mtime, path))
+        self.cam_bytes[cam] = self.cam_bytes.get(cam, 0) + st.st_size
+        self.total_bytes += st.st_size
+
+    def discard(self, path):
+        entry = self.files.pop(path, None)
+        self.hot.discard(path)
+
+        if entry is not None:
+            cam, mtime, size = entry
+            self.by_age.remove((mtime, path))
+            self.cam_by_age[cam].remove((mtime, path))
+            self.cam_bytes[cam] -= size
+            self.total_bytes -= size
+
+            dir_entry = self.dirs.get(os.path.dirname(path))
+            if dir_entry is not None:
+                dir_entry[1].discard(path)
+
+    def discard_dir(self, dir_path):
+        dir_entry = self.dirs.pop(dir_path, None)
+        if dir_entry is None:
+            return
+
+        _, files, sub_dirs = dir_entry
+        for path in list(files):
+            self.discard(path)
+
+        for sub_dir in list(sub_dirs):
+            self.discard_dir(sub_dir)
+
+        parent_entry = self.dirs.get(os.path.dirname(dir_path))
+        if parent_entry is not None:
+            parent_entry[2].discard(dir_path)
+
+    def scan_dir(self, dir_path, recursive):
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime
+        except OSError:
+            self.discard_dir(dir_path)
+            return
+
+        dir_entry = self.dirs.get(dir_path)
+        if dir_entry is None:
+            # [mtime of the last listing, files, sub directories]
+            dir_entry = [None, set(), set()]
+            self.dirs[dir_path] = dir_entry
+
+            parent_entry = self.dirs.get(os.path.dirname(dir_path))
+            if parent_entry is not None and dir_path != self.root:
+                parent_entry[2].add(dir_path)
+
+            if self.inotify is not None:
+                try:
+                    self.inotify.add_watch(dir_path)
+                except OSError as e:
+                    log.warning('Store index: %s', e)
+
+        listed_mtime = dir_entry[0]
+        dir_entry[0] = dir_mtime
+
+        if listed_mtime == dir_mtime and time.time() - dir_mtime > self.DIR_MTIME_SETTLE_SECONDS:
+            if recursive:
+                for sub_dir in list(dir_entry[2]):
+                    self.scan_dir(sub_dir, recursive)
+            return
+
+        present_files = set()
+        present_dirs = set()
+        newest = None
+
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        present_dirs.add(entry.path)
+                        if recursive or entry.path not in self.dirs:
+                            self.scan_dir(entry.path, recursive)
+                    elif entry.is_file(follow_symlinks=False):
+                        if entry.path not in self.files:
+                            try:
+                                self.add(entry.path, entry.stat(follow_symlinks=False))
+                            except OSError:
+                                continue
+
+                        present_files.add(entry.path)
+                        mtime = self.files[entry.path][1]
+                        if newest is None or mtime > newest[0]:
+                            newest = (mtime, entry.path)
+        except OSError as e:
+            log.warning('Store index: failed to list "%s": %s', dir_path, e)
+            return
+
+        for path in dir_entry[1] - present_files:
+            self.discard(path)
+
+        for sub_dir in dir_entry[2] - present_dirs:
+            self.discard_dir(sub_dir)
+
+        # The newest file of a directory is a segment being written by a capturer
+        if newest is not None:
+            for path in [path for path in dir_entry[1] if path in self.hot and path != newest[1]]:
+                self.close(path)
+            self.hot.add(newest[1])
+
+    def rescan(self, full=False):
+        if full:
+            self.discard_dir(self.root)
+
+        self.scan_dir(self.root, recursive=True)
+
+    def apply_events(self, events):
+        for mask, path in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                log.warning('Store index: inotify queue overflow. Rescan')
+                self.rescan(full=True)
+                continue
+
+            if path is None:
+                continue
+
+            if mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self.scan_dir(path, recursive=True)
+                elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    self.discard_dir(path)
+            elif mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+                if path == self.root:
+                    log.warning('Store index: store directory is gone: %s', path)
+                self.discard_dir(path)
+            elif mask & Inotify.IN_CREATE:
+                self.add(path)
+                self.hot.add(path)
+            elif mask & Inotify.IN_MOVED_TO:
+                self.add(path)
+            elif mask & Inotify.IN_CLOSE_WRITE:
+                self.add(path)
+                self.close(path)
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self.discard(path)
+
+    def close(self, path):
+        self.hot.discard(path)
+
+        if self.closed is not None and path in self.files:
+            self.closed.append(path)
+
+    def take_closed(self):
+        # The loop thread does not wait for the initial scan, the segments are collected till it is done
+        if not self.ready.is_set():
+            return []
+
+        with self.lock:
+            closed = self.closed
+            self.closed = []
+
+        return closed or []
+
+    def closed_files(self):
+        """Returns {path: cam} of the files, which are not being written."""
+        with self.lock:
+            return dict((path, entry[0]) for path, entry in self.files.items() if path not in self.hot)
+
+    def update(self):
+        with self.lock:
+            if self.inotify is not None:
+                self.apply_events(self.inotify.read_events())
+            else:
+                self.rescan()
+
+            # Only segments being written change in size, so just they are stat-ed on every update
+            for path in list(self.hot):
+                self.add(path)
+
+    def oldest(self, cam=None):
+        with self.lock:
+            if cam is None:
+                by_age = self.by_age
+            else:
+                by_age = self.cam_by_age.get(cam)
+
+            if by_age:
+                return by_age[0]
+            return None
+
+    def size_bytes(self, cam=None):
+        if cam is None:
+            return self.total_bytes
+        return self.cam_bytes.get(cam, 0)
+
+    def cams(self):
+        # Called by the cleaner thread, while the loop thread could add a cam
+        if not self.ready.is_set():
+            return []
+
+        with self.lock:
+            return [cam for cam, by_age in self.cam_by_age.items() if by_age]
+
+    def __len__(self):
+        return len(self.files)
+
+
+class CamPolicy:
+    """Retention settings of a single cam store directory. 0 means no limit."""
+
+    def __init__(self, max_bytes=0, max_age_seconds=0, min_keep_seconds=0):
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.min_keep_seconds = min_keep_seconds
+
+
+class Cleaner(threading.Thread):
+    """Background worker, which removes the oldest store files until the store thresholds are met.
+
+    Cam quotas (store_max_gb, store_max_days) are enforced first. Then the number of bytes to free is computed from
+    the store index and the file system free space and is taken from the cams fairly: the next file is removed from
+    the cam, which uses the largest part of its share. Files younger than min_keep_hours are only removed when
+    the free space is below cleaner_store_keep_free_gb and nothing else is left.
+    Removes are throttled by an optional I/O budget, so a slow disk never stalls the main loop.
+    """
+
+    def __init__(self, store_index, store_max_bytes, keep_free_bytes, force_remove_file_less_bytes=0,
+                 io_max_bytes_per_second=0, io_max_removes_per_second=0, cam_policies=None, catalog=None,
+                 on_index_ready=None):
+        threading.Thread.__init__(self, name='cleaner', daemon=True)
+        self.store_index = store_index
+        self.store_max_bytes = store_max_bytes
+        self.keep_free_bytes = keep_free_bytes
+        self.force_remove_file_less_bytes = force_remove_file_less_bytes
+        self.io_max_bytes_per_second = io_max_bytes_per_second
+        self.io_max_removes_per_second = io_max_removes_per_second
+        self.cam_policies = cam_policies or {}
+        self.catalog = catalog
+        # Called in the cleaner thread, when the store index is loaded
+        self.on_index_ready = on_index_ready
+        self.default_policy = CamPolicy()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.active_flag = True
+        self.start_time = 0
+        self.removed_bytes = 0
+        self.removes = 0
+        self.runs_total = 0
+        self.run_seconds_total = 0.0
+        self.last_run_seconds = 0.0
+        self.removes_total = 0
+        self.removed_bytes_total = 0
+
+    def trigger(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.active_flag = False
+        self.stopped.set()
+        self.wakeup.set()
+
+    def run(self):
+        if not self.store_index.ready.is_set():
+            try:
+                self.store_index.load()
+            except Exception:
+                log.exception('Store index failed to load, cleaner is stopped')
+                return
+
+            if self.on_index_ready is not None:
+                self.on_index_ready()
+
+        while self.active_flag:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            if not self.active_flag:
+                break
+
+            try:
+                self.clean()
+            except Exception:
+                log.exception('Cleaner failed')
+
+    def free_bytes(self):
+        store_stat = os.statvfs(self.store_index.root)
+        return store_stat.f_bavail * store_stat.f_frsize
+
+    def policy(self, cam):
+        return self.cam_policies.get(cam, self.default_policy)
+
+    def share(self, cam):
+        policy = self.policy(cam)
+        if policy.max_bytes:
+            return policy.max_bytes
+
+        # Cams without own quota share the configured store size (or an equal unit) evenly
+        if self.store_max_bytes:
+            return 1.0 * self.store_max_bytes / max(len(self.store_index.cam_by_age), 1)
+        return 1.0
+
+    def bytes_to_free(self):
+        need = 0
+
+        if self.store_max_bytes:
+            store_bytes = self.store_index.size_bytes()
+            log.debug('Store files: %i, size, Gb: %f', len(self.store_index), 1.0 * store_bytes / 1024 / 1024 / 1024)
+
+            if store_bytes > self.store_max_bytes:
+                log.info('Current store size / Configured max store size, Gb: %.3f/%.3f',
+                         1.0 * store_bytes / 1024 / 1024 / 1024, 1.0 * self.store_max_bytes / 1024 / 1024 / 1024)
+                need = max(need, store_bytes - self.store_max_bytes)
+
+        if self.keep_free_bytes:
+            free_bytes = self.free_bytes()
+            log.debug('Store free space, Gb: %f', 1.0 * free_bytes / 1024 / 1024 / 1024)
+
+            if free_bytes < self.keep_free_bytes:
+                log.info('Current store free space / Configured keep store free space, Gb: %.3f/%.3f',
+                         1.0 * free_bytes / 1024 / 1024 / 1024, 1.0 * self.keep_free_bytes / 1024 / 1024 / 1024)
+                need = max(need, self.keep_free_bytes - free_bytes)
+
+        return need
+
+    def throttle(self):
+        delay = 0
+
+        if self.io_max_bytes_per_second:
+            delay = max(delay, 1.0 * self.removed_bytes / self.io_max_bytes_per_second)
+
+        if self.io_max_removes_per_second:
+            delay = max(delay, 1.0 * self.removes / self.io_max_removes_per_second)
+
+        delay -= time.time() - self.start_time
+        if delay > 0:
+            self.stopped.wait(delay)
+
+    def evictable(self, cam, now, ignore_min_keep=False):
+        """Returns the oldest (mtime, path) of the cam, which is allowed to be removed, or None."""
+        oldest = self.store_index.oldest(cam)
+        if oldest is None or oldest[1] in self.store_index.hot:
+            return None
+
+        min_keep_seconds = self.policy(cam).min_keep_seconds
+        if not ignore_min_keep and min_keep_seconds and now - oldest[0] < min_keep_seconds:
+            return None
+
+        return oldest
+
+    def remove(self, file_name):
+        with self.store_index.lock:
+            entry = self.store_index.files.get(file_name)
+        if entry is None:
+            return 0
+
+        self.throttle()
+        file_size = entry[2]
+        log.info('Remove file: %s', file_name)
+
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            log.debug('File already removed: %s', file_name)
+            file_size = 0
+        except OSError as e:
+            # Dropped from the index, so the next victim is taken instead of failing on this one every run
+            log.error('Failed to remove "%s", skip it: %s', file_name, e)
+
+            with self.store_index.lock:
+                self.store_index.discard(file_name)
+
+            return 0
+        else:
+            self.removed_bytes += file_size
+            self.removes += 1
+            self.removed_bytes_total += file_size
+            self.removes_total += 1
+
+            if file_size <= self.force_remove_file_less_bytes:
+                log.warning('Removed "%s" file with the "%s" bytes size', file_name, file_size)
+
+        with self.store_index.lock:
+            self.store_index.discard(file_name)
+
+        if self.catalog is not None:
+            self.catalog.discard(file_name)
+
+        return file_size
+
+    def clean_cam_quotas(self, now):
+        for cam in self.store_index.cams():
+            policy = self.policy(cam)
+
+            if policy.max_age_seconds:
+                while self.active_flag:
+                    with self.store_index.lock:
+                        oldest = self.evictable(cam, now)
+                    if oldest is None or now - oldest[0] <= policy.max_age_seconds:
+                        break
+                    log.debug('Cam "%s" file is older than the store max days', cam)
+                    self.remove(oldest[1])
+
+            if policy.max_bytes:
+                while self.active_flag and self.store_index.size_bytes(cam) > policy.max_bytes:
+                    with self.store_index.lock:
+                        oldest = self.evictable(cam, now)
+                    if oldest is None:
+                        log.warning('Cam "%s" is over its store max size, but nothing is allowed to remove', cam)
+                        break
+                    log.debug('Cam "%s" store size is over the limit', cam)
+                    self.remove(oldest[1])
+
+    def pick_victim(self, now, ignore_min_keep=False):
+        victim = None
+        victim_usage = None
+
+        with self.store_index.lock:
+            for cam in self.store_index.cams():
+                oldest = self.evictable(cam, now, ignore_min_keep)
+                if oldest is None:
+                    continue
+
+                usage = self.store_index.size_bytes(cam) / self.share(cam)
+                if victim is None or usage > victim_usage:
+                    victim = oldest
+                    victim_usage = usage
+
+        return victim
+
+    def clean(self):
+        log.debug('Cleaner started')
+        self.store_index.update()
+
+        now = time.time()
+        self.start_time = now
+        self.removed_bytes = 0
+        self.removes = 0
+
+        self.clean_cam_quotas(now)
+
+        need = self.bytes_to_free()
+        if need:
+            log.info('Clean is active, bytes to free: %i', need)
+
+        freed = 0
+        while freed < need and self.active_flag:
+            victim = self.pick_victim(now)
+
+            if victim is None and self.keep_free_bytes and self.free_bytes() < self.keep_free_bytes:
+                log.warning('Store free space is low, remove files protected by min_keep_hours')
+                victim = self.pick_victim(now, ignore_min_keep=True)
+
+            if victim is None:
+                log.warning('Nothing to remove, bytes still to free: %i', need - freed)
+                break
+
+            freed += self.remove(victim[1])
+
+        self.runs_total += 1
+        self.last_run_seconds = time.time() - self.start_time
+        self.run_seconds_total += self.last_run_seconds
+
+        if self.removes:
+            log.info('Cleaner finished, removed files: %i, bytes: %i, seconds: %.3f',
+                     self.removes, self.removed_bytes, time.time() - self.start_time)
+        else:
+            log.debug('Cleaner finished')
@@ -2,40 +2,353 @@
 
 import os
 import sys
-from config import Config, ConfigMerger
-from sortedcontainers import SortedDict
 import logging.handlers
 import signal
-import glob2
-import psutil
 import time
-import subprocess
-import requests
 import traceback
-import schedule
-import daemon
+import functools
+import collections
+import random
+import json
+import re
+import shlex
 import argparse
+import atexit
+from cam_lazy import LazyModule
+from cam_config import ConfigCache, ConfigDict, plain
+
+# Imported on the first use: -daemon stop and -daemon status do not need them
+config = LazyModule('config')
+glob2 = LazyModule('glob2')
+psutil = LazyModule('psutil')
+daemon = LazyModule('daemon')
+subprocess = LazyModule('subprocess')
+hashlib = LazyModule('hashlib')
+shutil = LazyModule('shutil')
+futures = LazyModule('concurrent.futures')
+cam_store = LazyModule('cam_store')
+cam_probe = LazyModule('cam_probe')
+cam_loop = LazyModule('cam_loop')
+cam_command = LazyModule('cam_command')
+cam_gst = LazyModule('cam_gst')
+cam_catalog = LazyModule('cam_catalog')
+cam_motion = LazyModule('cam_motion')
+cam_cluster = LazyModule('cam_cluster')
+cam_control = LazyModule('cam_control')
+cam_metrics = LazyModule('cam_metrics')
+cam_logging = LazyModule('cam_logging')
+cam_resources = LazyModule('cam_resources')
 
 CFG_DIR = os.getenv('CFG_DIR', 'cfg')
 CFG_FILENAME = os.getenv('CFG_FILENAME', 'main.cfg')
 
 
+class ConfigError(Exception):
+    pass
+
+
+def newest_file(dir_path):
+    """Returns (mtime, path) of the newest file of the directory or None."""
+    newest = None
+
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+                if newest is None or mtime > newest[0]:
+                    newest = (mtime, entry.path)
+
+    return newest
+
+
+SHELL_EXPANSION_RE = re.compile(r'[`$*?\[\]{}~;&|<>]')
+
+
+def cmdline_matches(cmd, cmdline):
+    """True, when cmdline of a running process could be started by the shell command cmd (or by the argv list).
+
+    A process started by 'sh -c cmd' is matched by cmd itself. A process, which has replaced the shell
+    ('exec program ...'), is matched by the program name and by the words of cmd without shell expansions,
+    which have to be found in its arguments in the same order.
+    """
+    if not cmdline:
+        return False
+
+    if isinstance(cmd, list):
+        return cmdline == cmd
+
+    if len(cmdline) >= 3 and os.path.basename(cmdline[0]) in ('sh', 'bash', 'dash') and cmdline[1] == '-c':
+        return cmdline[2].strip() == cmd.strip()
+
+    try:
+        words = shlex.split(cmd)
+    except ValueError:
+        return False
+
+    if words and words[0] == 'exec':
+        words = words[1:]
+
+    if not words or os.path.basename(words[0]) != os.path.basename(cmdline[0]):
+        return False
+
+    args = iter(cmdline[1:])
+    return all(any(arg == word for arg in args) for word in words[1:] if not SHELL_EXPANSION_RE.search(word))
+
+
+class CamRunner:
+    """State machine of a single cam.
+
+    stopped  -> starting: streamer is launched, cap_url is probed until HTTP 200 or max_start_seconds
+    starting -> running:  HTTP 200, capturer is launched
+    running  -> starting: capturer is dead, cap_url is probed again before the capturer restart
+    any      -> backoff:  streamer is dead or start is time outed (processes are killed and cam is reset),
+                          the streamer is started again after an exponential delay with jitter
+    running  -> backoff:  recorded segment (or HTTP stream) growth is below stall_min_bytes_per_second
+                          for stall_seconds
+    any      -> parked:   restart budget is exhausted, a single start is retried every restart_park_seconds
+                          and the cam leaves this state once it stays running for restart_stable_seconds
+
+    With motion detection a running cam records fully (cap_cmd) or idle (idle_cap_cmd, False - paused), the motion
+    tap process feeds the frames of the detector.
+    """
+
+    STATE_STOPPED = 'stopped'
+    STATE_STARTING = 'starting'
+    STATE_RUNNING = 'running'
+    STATE_BACKOFF = 'backoff'
+    STATE_PARKED = 'parked'
+
+    def __init__(self, index, cfg, streamer_pid_file, capturer_pid_file, cap_cmd, cap_dir,
+                 pipeline_description=None, segment_location=None, motion_cmd=None, motion_pid_file=None,
+                 motion_detector=None, idle_cap_cmd=None, spool_dir=None):
+        self.index = index
+        self.cfg = cfg
+        self.name = cfg['name']
+        self.streamer_pid_file = streamer_pid_file
+        self.capturer_pid_file = capturer_pid_file
+        self.cap_cmd = cap_cmd
+        self.cap_dir = cap_dir
+        self.pipeline_description = pipeline_description
+        self.segment_location = segment_location
+        self.motion_cmd = motion_cmd
+        self.motion_pid_file = motion_pid_file
+        self.motion_detector = motion_detector
+        self.idle_cap_cmd = idle_cap_cmd
+        self.spool_dir = spool_dir
+        self.state = self.STATE_STOPPED
+        self.state_time = time.time()
+        self.streamer = None
+        self.capturer = None
+        self.pipeline = None
+        self.start_time = 0
+        self.probe = None
+        self.probe_timer = None
+        self.start_timer = None
+        self.restart_timer = None
+        self.stable_timer = None
+        self.stall_timer = None
+        self.stall_probe = None
+        self.stall_segment = None
+        self.stall_segment_size = 0
+        self.stall_dir_mtime = None
+        self.stall_check_time = 0
+        self.stall_since = None
+        self.restarts = 0
+        self.restart_times = collections.deque()
+        self.failures = 0
+        self.half_open_flag = False
+        self.last_reason = None
+        self.launch_time = None
+        self.recycle_reason = None
+        self.recycle_since = 0
+        self.recycle_segment = None
+        self.recording_seconds = None
+        self.streamer_create_time = None
+        self.capturer_create_time = None
+        self.motion_tap = None
+        self.motion_buffer = None
+        self.motion_timer = None
+        self.motion_tap_timer = None
+        self.motion_time = 0
+        self.motion_frame_time = 0
+        self.motion_idle_flag = False
+        self.spool_capturer = None
+
+    def cancel_timers(self):
+        for timer in (self.probe_timer, self.start_timer, self.restart_timer, self.stable_timer, self.stall_timer):
+            if timer is not None:
+                timer.cancel()
+
+        self.probe_timer = None
+        self.start_timer = None
+        self.restart_timer = None
+        self.stable_timer = None
+        self.stall_timer = None
+        self.probe = None
+        self.stall_probe = None
+
+    def segment_growth(self):
+        """Returns bytes written to the current segment since the previous call, or None if it is unknown.
+
+        The cam store directory is listed only when its mtime changes (a new segment), otherwise a single stat of
+        the current segment is enough.
+        """
+        try:
+            dir_mtime = os.stat(self.cap_dir).st_mtime
+        except OSError:
+            return None
+
+        previous_segment = self.stall_segment
+        previous_size = self.stall_segment_size
+
+        if dir_mtime != self.stall_dir_mtime or self.stall_segment is None:
+            self.stall_dir_mtime = dir_mtime
+            newest = newest_file(self.cap_dir)
+
+            if newest is None:
+                return None
+            self.stall_segment = newest[1]
+
+        try:
+            self.stall_segment_size = os.stat(self.stall_segment).st_size
+        except OSError:
+            self.stall_segment = None
+            return None
+
+        if previous_segment is None:
+            return None
+        if previous_segment != self.stall_segment:
+            return self.stall_segment_size
+
+        return self.stall_segment_size - previous_size
+
+    def restart_delay(self):
+        delay = min(float(self.cfg['restart_backoff_min_seconds']) *
+                    float(self.cfg['restart_backoff_factor']) ** max(self.failures - 1, 0),
+                    float(self.cfg['restart_backoff_max_seconds']))
+        jitter = float(self.cfg['restart_backoff_jitter'])
+
+        return delay * random.uniform(1 - jitter, 1 + jitter)
+
+    def effective(self):
+        """Settings, which change requires a restart of the cam processes."""
+        effective = (self.cfg.get('cmd', '').strip(), self.cap_cmd, self.streamer_pid_file, self.capturer_pid_file,
+                     self.pipeline_description, self.segment_location)
+
+        if self.motion_cmd is not None:
+            effective += (self.motion_cmd, self.motion_pid_file, self.idle_cap_cmd, self.spool_dir)
+
+        return effective
+
+    def fingerprint(self):
+        return hashlib.sha1(json.dumps(self.effective()).encode('utf-8')).hexdigest()
+
+    def update(self, runner):
+        self.index = runner.index
+        self.cfg = runner.cfg
+        self.streamer_pid_file = runner.streamer_pid_file
+        self.capturer_pid_file = runner.capturer_pid_file
+        self.cap_cmd = runner.cap_cmd
+        self.cap_dir = runner.cap_dir
+        self.pipeline_description = runner.pipeline_description
+        self.segment_location = runner.segment_location
+        self.motion_cmd = runner.motion_cmd
+        self.motion_pid_file = runner.motion_pid_file
+        self.idle_cap_cmd = runner.idle_cap_cmd
+        self.spool_dir = runner.spool_dir
+        # Detector settings apply at once, the tap keeps running
+        self.motion_detector = runner.motion_detector
+
+    def snapshot(self):
+        return {
+            'state': self.state,
+            'streamer_pid': self.streamer.pid if self.streamer is not None else None,
+            'capturer_pid': self.capturer.pid if self.capturer is not None else None,
+            'start_time': self.start_time,
+            'restarts': self.restarts,
+            'failures': self.failures,
+            'restart_times': list(self.restart_times),
+            'last_reason': self.last_reason,
+            'streamer_create_time': self.streamer_create_time if self.streamer is not None else None,
+            'capturer_create_time': self.capturer_create_time if self.capturer is not None else None,
+            'fingerprint': self.fingerprint()
+        }
+
+    def status(self):
+        """Public state of the cam for the control API."""
+        return {
+            'state': self.state,
+            'state_time': self.state_time,
+            'engine': self.cfg['engine'],
+            'streamer_pid': self.streamer.pid if self.streamer is not None else None,
+            'capturer_pid': self.capturer.pid if self.capturer is not None else None,
+            'start_time': self.start_time,
+            'restarts': self.restarts,
+            'failures': self.failures,
+            'last_reason': self.last_reason,
+            'motion_idle': self.motion_idle_flag
+        }
+
+    def restore(self, saved):
+        """Restores the restart counters of the previous daemon run from its snapshot."""
+        self.restarts = saved.get('restarts', 0)
+        self.failures = saved.get('failures', 0)
+        self.restart_times = collections.deque(saved.get('restart_times', []))
+        self.last_reason = saved.get('last_reason')
+
+
 class Cam:
-    cfg = Config()
+    SHUTDOWN_POLL_SECONDS = 0.05
+    MOTION_TAP_RESTART_SECONDS = 10
+    MOTION_READ_BYTES = 65536
+
+    cfg = None
     cam_cfg = []
+    config_cache = None
     cam_cfg_resolver_dict = {}
-    cam_streamer = []
-    cam_streamer_pid = []
-    cam_streamer_start_time = []
-    cam_streamer_start_flag = []
-    cam_streamer_poll_flag = []
-    cam_capturer = []
-    cam_capturer_pid = []
-    cam_capturer_start_flag = []
-    cam_capturer_check_flag = []
+    cams = []
     log = logging.getLogger()
     log_handler_file = None
+    log_handlers = []
+    log_writer = None
     main_loop_active_flag = True
+    loop = None
+    store_index = None
+    cleaner = None
+    cleaner_timer = None
+    catalog = None
+    catalog_timer = None
+    state_file = None
+    metrics = None
+    metrics_server = None
+    resource_sampler = None
+    resources_timer = None
+    startup_queue = []
+    startup_wave = set()
+    startup_time = 0
+    startup_timer = None
+    startup_cpu_timer = None
+    startup_cpu_percent = 0.0
+    config_watch = None
+    reload_timer = None
+    prober = None
+    # Moves the pre-roll to the cam store: a move to another file system is a copy, it never runs in the loop
+    spool_executor = None
+    kills = {}
+    shutdown_pending = None
+    shutdown_time = 0
+    shutdown_timer = None
+    shutdown_poll_timer = None
+    cluster = None
+    cluster_timer = None
+    cluster_tick_flag = False
+    cluster_renew_time = 0
+    cluster_nodes = []
+    cluster_owned = set()
+    cluster_stopping = {}
+    cluster_leave_flag = True
+    control_model = None
+    control_server = None
     signals_name = {}
 
     def __init__(self, config_dir, config_filename, log_level=None):
@@ -48,18 +361,55 @@ class Cam:
         self.create_dirs()
         self.setup_logging()
         self.pid_file = os.path.join(self.cfg['pid_dir'], self.cfg['pid_filename'])
+        self.state_file = os.path.join(self.cfg['pid_dir'], self.cfg.get('state_filename', 'state.json'))
 
         for sig in dir(signal):
             if sig.startswith('SIG') and not sig.startswith('SIG_'):
                 self.signals_name[getattr(signal, sig)] = sig
 
     def read_main_config(self):
-        if os.path.isfile(self.cfg_file):
-            self.cfg.load(open(self.cfg_file))
-        else:
+        if not os.path.isfile(self.cfg_file):
             print('Failed to open the file: %s' % self.cfg_file)
             sys.exit(1)
 
+        self.config_cache = ConfigCache(self.cfg_dir, self.cfg_filename)
+        cached = self.config_cache.load()
+
+        if cached is not None:
+            self.cfg = cached[0]
+        else:
+            self.cfg = ConfigDict(plain(config.Config(open(self.cfg_file))))
+
+    def load_configs(self):
+        """Returns the main config and the active cam configs merged with it.
+
+        The configs are read from the config cache, while no config file has changed since it was written. Otherwise
+        they are parsed and evaluated, and the cache is written.
+        """
+        cached = self.config_cache.load()
+        if cached is not None:
+            self.log.debug('Configs are read from the cache: %s', self.config_cache.path)
+            return cached
+
+        # Taken before parsing, a file changed meanwhile makes the cache stale
+        state = self.config_cache.files_state(self.cfg['cam_cfg_mask'])
+
+        try:
+            cfg = config.Config(open(self.cfg_file))
+        except Exception as e:
+            raise ConfigError('Failed to read main config "%s": %s' % (self.cfg_file, e))
+
+        cam_cfg = self.read_cam_configs(cfg)
+
+        try:
+            cfg = ConfigDict(plain(cfg))
+            cam_cfg = [ConfigDict(plain(cam)) for cam in cam_cfg]
+        except Exception as e:
+            raise ConfigError('Failed to evaluate configs: %s' % e)
+
+        self.config_cache.save(cfg, cam_cfg, state)
+        return cfg, cam_cfg
+
     def create_dirs(self):
         if not os.path.exists(self.cfg['log_dir']):
             os.makedirs(self.cfg['log_dir'])
@@ -98,149 +448,511 @@ class Cam:
         self.log_handler_file = logging.handlers.TimedRotatingFileHandler(
             filename=str(os.path.join(self.cfg['log_dir'], self.cfg['log_filename'])),
             when='midnight')
-        self.log_handler_file.setFormatter(logging_formatter)
+        if self.cfg.get('log_format', 'text') == 'json':
+            self.log_handler_file.setFormatter(cam_logging.JsonFormatter())
+        else:
+            self.log_handler_file.setFormatter(logging_formatter)
         self.log_handler_file.setLevel(self.log_level)
 
-        self.log.addHandler(log_handler_stream)
-        self.log.addHandler(self.log_handler_file)
+        self.log_handlers = [log_handler_stream, self.log_handler_file]
+        for handler in self.log_handlers:
+            self.log.addHandler(handler)
 
         logging.getLogger('requests').setLevel(logging.WARNING)
-        logging.getLogger('schedule').setLevel(logging.WARNING)
+        logging.getLogger('urllib3').setLevel(logging.WARNING)
         sys.excepthook = self.exception_handler
 
-    def write_main_pid(self):
+    def start_log_writer(self):
+        """Moves the log writes to a background thread, the loop only puts the records to a queue.
+
+        Started in the daemon process, since a thread does not survive the daemon fork.
+        """
+        self.log_writer = cam_logging.LogWriter(self.log_handlers, self.cfg['log_queue_size'],
+                                                self.cfg['log_repeat_burst'], self.cfg['log_repeat_window_seconds'])
+
+        for handler in self.log_handlers:
+            self.log.removeHandler(handler)
+
+        self.log.addHandler(self.log_writer.handler)
+        self.log_writer.start()
+        atexit.register(self.stop_log_writer)
+
+    def stop_log_writer(self):
+        if self.log_writer is None:
+            return
+
+        self.log.removeHandler(self.log_writer.handler)
+        self.log_writer.stop()
+        self.log_writer = None
+
+        for handler in self.log_handlers:
+            self.log.addHandler(handler)
+
+    def setup_metrics(self):
+        self.metrics = cam_metrics.Registry()
+        m = self.metrics
+
+        m.streamer_up = m.gauge('cam_streamer_streamer_up', 'Streamer process is running', ['cam'])
+        m.capturer_up = m.gauge('cam_streamer_capturer_up', 'Capturer process is running', ['cam'])
+        m.restarts = m.counter('cam_streamer_restarts_total', 'Cam restarts by reason', ['cam', 'reason'])
+        m.start_seconds = m.histogram('cam_streamer_start_seconds', 'Time from a streamer launch to HTTP 200',
+                                      ['cam'], buckets=(1, 2, 5, 10, 20, 30, 60, 90, 120, 180, 300))
+        m.probe_seconds = m.histogram('cam_streamer_probe_seconds', 'Streamer HTTP probe latency', ['cam'])
+        m.probes = m.counter('cam_streamer_probes_total', 'Streamer HTTP probes by result', ['cam', 'code'])
+        m.callback('cam_streamer_cam_state', 'Current cam state',
+                   lambda: [({'cam': cam.name, 'state': cam.state}, 1) for cam in self.cams],
+                   label_names=['cam', 'state'])
+        m.startup_seconds = m.gauge('cam_streamer_startup_seconds', 'Time from the daemon start to cam recording',
+                                    ['cam'])
+        m.data_rate = m.gauge('cam_streamer_data_bytes_per_second', 'Recorded segment (or HTTP stream) growth rate',
+                              ['cam'])
+        m.cpu_percent = m.gauge('cam_streamer_process_cpu_percent', 'CPU usage of a process tree', ['cam', 'role'])
+        m.rss_bytes = m.gauge('cam_streamer_process_rss_bytes', 'Resident memory of a process tree', ['cam', 'role'])
+        m.open_fds = m.gauge('cam_streamer_process_open_fds', 'Open file descriptors of a process tree',
+                             ['cam', 'role'])
+        m.threads = m.gauge('cam_streamer_process_threads', 'Threads of a process tree', ['cam', 'role'])
+        m.loop_seconds = m.histogram('cam_streamer_loop_iteration_seconds', 'Supervisor loop iteration busy time',
+                                     buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+        m.loop_lag_seconds = m.histogram('cam_streamer_loop_lag_seconds', 'Supervisor loop timers delay',
+                                         buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+        m.motion_idle = m.gauge('cam_streamer_motion_idle', 'Cam records idle, no motion', ['cam'])
+        m.motion_changed_percent = m.gauge('cam_streamer_motion_changed_percent', 'Changed pixels of the last frame',
+                                           ['cam'])
+        m.motion_detect_seconds = m.histogram('cam_streamer_motion_detect_seconds', 'Motion detection time of a frame',
+                                              buckets=(0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05))
+
+        if self.log_writer is not None:
+            m.callback('cam_streamer_log_dropped_total', 'Log records dropped on a full queue',
+                       lambda: self.log_writer.handler.dropped if self.log_writer else 0, 'counter')
+            m.callback('cam_streamer_log_suppressed_total', 'Repeated log records suppressed',
+                       lambda: self.log_writer.suppressed if self.log_writer else 0, 'counter')
+
+        if self.cfg['cluster_store']:
+            m.callback('cam_streamer_cluster_nodes', 'Live cluster nodes', lambda: len(self.cluster_nodes))
+            m.callback('cam_streamer_cluster_owned_cams', 'Cams leased by this node', lambda: len(self.cluster_owned))
+
+        if self.store_index is not None:
+            m.callback('cam_streamer_store_bytes', 'Store files size',
+                       lambda: [({'cam': cam}, self.store_index.size_bytes(cam)) for cam in self.store_index.cams()],
+                       label_names=['cam'])
+            m.callback('cam_streamer_store_files', 'Store files number', lambda: len(self.store_index))
+            m.callback('cam_streamer_store_free_bytes', 'Store file system free space', self.cleaner.free_bytes)
+            m.callback('cam_streamer_cleaner_runs_total', 'Cleaner runs',
+                       lambda: self.cleaner.runs_total, 'counter')
+            m.callback('cam_streamer_cleaner_run_seconds_total', 'Cleaner runs duration',
+                       lambda: self.cleaner.run_seconds_total, 'counter')
+            m.callback('cam_streamer_cleaner_last_run_seconds', 'Last cleaner run duration',
+                       lambda: self.cleaner.last_run_seconds)
+            m.callback('cam_streamer_cleaner_removed_files_total', 'Files removed by the cleaner',
+                       lambda: self.cleaner.removes_total, 'counter')
+            m.callback('cam_streamer_cleaner_removed_bytes_total', 'Bytes removed by the cleaner',
+                       lambda: self.cleaner.removed_bytes_total, 'counter')
+
+        try:
+            listen = self.cfg['metrics_listen']
+        except AttributeError:
+            listen = None
+
+        if listen:
+            self.metrics_server = cam_metrics.MetricsServer(self.metrics, listen)
+
+            # Recording goes on without the metrics endpoint
+            try:
+                self.metrics_server.start()
+            except OSError as e:
+                self.log.error('Metrics are turned off, failed to listen on "%s": %s', listen, e)
+                self.metrics_server = None
+
+    def running_pid(self):
+        """Returns the PID of the running daemon or None."""
         if os.path.isfile(self.pid_file):
             pid_file_content = open(self.pid_file, 'r').read()
 
             if len(pid_file_content.strip()):
                 pid = int(pid_file_content)
 
-                if psutil.pid_exists(pid):
-                    print('Error. Already running, PID: %i' % pid)
-                    sys.exit(1)
+                if self.pid_exists(pid):
+                    return pid
+
+        return None
+
+    def write_main_pid(self):
+        pid = self.running_pid()
+        if pid is not None:
+            self.log.critical('Already running, PID: %i. Exit', pid)
+            sys.exit(1)
 
         open(self.pid_file, 'w').write(str(os.getpid()))
 
-    def exit_handler(self, s, frame, log_signal=True, exit_code=0):
+    def exit_handler(self, s, frame, log_signal=True, exit_code=0, kill_cams_flag=True):
         if log_signal:
-            self.log.warning('Caught signal: %s' % self.signals_name[s])
+            self.log.warning('Caught signal: %s', self.signals_name[s])
+
+        if self.shutdown_pending is not None:
+            self.log.info('Shutdown is in progress, cams left: %i', len(self.shutdown_pending))
+            return
+
+        self.main_loop_active_flag = False
+        # The leases are kept for the next start, which adopts the cams
+        self.cluster_leave_flag = kill_cams_flag
+        # Cam processes are signaled first, the loop keeps running until they are gone, then finish_exit() is called
+        stop_cams_flag = kill_cams_flag and exit_code == 0 and self.loop is not None
+
+        if stop_cams_flag:
+            self.stop_cams()
 
-        self.kill_cams_process()
+        if self.cleaner is not None:
+            self.cleaner.stop()
 
-        self.log.debug('Remove own PID file: %s' % self.pid_file)
+        if self.catalog_timer is not None:
+            self.catalog_timer.cancel()
+
+        if self.catalog is not None:
+            self.catalog.shutdown()
+
+        if self.prober is not None:
+            self.prober.shutdown()
+
+        # The running moves are finished before the exit
+        if self.spool_executor is not None:
+            self.spool_executor.shutdown(wait=False)
+
+        if self.cleaner_timer is not None:
+            self.cleaner_timer.cancel()
+
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+        if self.control_server is not None:
+            self.control_server.stop()
+
+        if self.resources_timer is not None:
+            self.resources_timer.cancel()
+
+        for timer in (self.startup_timer, self.startup_cpu_timer, self.cluster_timer):
+            if timer is not None:
+                timer.cancel()
+
+        if self.resource_sampler is not None:
+            self.resource_sampler.shutdown()
+
+        if stop_cams_flag:
+            return
+
+        if kill_cams_flag:
+            self.kill_cams_process()
+            self.finish_kills()
+        else:
+            self.log.info('Leave cam processes running, they are adopted by the next start')
+
+        self.finish_exit(exit_code)
+
+    def remove_main_pid(self):
+        self.log.debug('Remove own PID file: %s', self.pid_file)
         if os.path.isfile(self.pid_file):
             os.remove(self.pid_file)
         else:
-            self.log.warning('PID file not found: %s' % self.pid_file)
+            self.log.warning('PID file not found: %s', self.pid_file)
 
-        if exit_code == 0:
-            self.main_loop_active_flag = False
-        else:
+    def finish_exit(self, exit_code=0):
+        self.remove_main_pid()
+
+        self.write_state()
+
+        if self.cluster is not None:
+            if self.cluster_leave_flag:
+                self.cluster.leave()
+            else:
+                self.cluster.shutdown()
+
+        if exit_code != 0:
             sys.exit(exit_code)
 
-    def exit_child(self, s, frame, log_signal=True):
-        while True:
-            try:
-                pid, status = os.waitpid(-1, os.WNOHANG)
-
-                if pid != 0:
-                    logging.warning('Received "%s" signal for "%s" PID with "%s" status' %
-                                    (self.signals_name[s], pid, status))
-
-                    for iterator, cam in enumerate(self.cam_cfg):
-                        # Streamer alive check
-                        if self.cam_streamer[iterator].poll() is None:
-                            self.log.debug('Streamer "%s" is alive' % cam['name'])
-                        else:
-                            self.log.warning('Streamer "%s" is dead (exit code: %s)' %
-                                             (cam['name'], self.cam_streamer[iterator].returncode))
-                            self.cam_streamer_start_flag[iterator] = True
-                        # End Streamer alive check
-
-                        # Capturer alive check
-                        if self.cam_capturer_check_flag[iterator]:
-                            if self.cam_capturer[iterator].poll() is None:
-                                self.log.debug('Capturer "%s" is alive' % cam['name'])
-                            else:
-                                self.log.warning('Capturer "%s" is dead (exit code: %s)' %
-                                                 (cam['name'], self.cam_capturer[iterator].returncode))
-                                self.cam_streamer_poll_flag[iterator] = True
-                                self.cam_capturer_check_flag[iterator] = False
-                        # End Capturer alive check
-                else:
-                    break
-            except ChildProcessError:
-                self.log.debug('ChildProcessError: No child processes')
-                break
+    def stop_cams(self):
+        """Shutdown coordinator: signals the processes of all cams at once and waits for their exits in the loop.
+
+        Exits are seen through pidfds, groups left by an exited leader are polled. SIGKILL is sent to the groups
+        alive after kill_timeout_seconds, the shutdown is finished after shutdown_timeout_seconds at most.
+        """
+        self.shutdown_time = self.loop.time()
+        self.shutdown_pending = {}
+
+        for cam in self.cams:
+            pids = self.kill_cam_processes(cam.index)
+            cam.state = CamRunner.STATE_STOPPED
+            kills = dict((pid, self.kills[pid]) for pid in pids if pid in self.kills)
+
+            if kills:
+                self.shutdown_pending[cam.name] = kills
+
+            for pid in kills:
+                if not self.loop.watch_pid(pid, self.check_shutdown):
+                    self.shutdown_poll_timer = self.shutdown_poll_timer or self.loop.call_later(
+                        self.SHUTDOWN_POLL_SECONDS, self.on_shutdown_poll)
+
+        self.log.info('Shutdown: %i cams are signaled', len(self.shutdown_pending))
+
+        # No exit to wait for (all cams are in backoff, parked or stopped), check_shutdown() is never called
+        if not self.shutdown_pending:
+            self.finish_exit()
+            return
+
+        self.shutdown_timer = self.loop.call_later(self.cfg['shutdown_timeout_seconds'], self.on_shutdown_timeout)
+        self.check_shutdown()
+
+    def check_shutdown(self):
+        if not self.shutdown_pending:
+            return
+
+        poll_flag = self.shutdown_poll_timer is not None
+
+        for name, kills in list(self.shutdown_pending.items()):
+            for pid, (proc, group_flag) in list(kills.items()):
+                if self.process_alive(proc):
+                    continue
+
+                if group_flag and self.group_alive(pid):
+                    poll_flag = True
+                    continue
+
+                del kills[pid]
+
+            if not kills:
+                del self.shutdown_pending[name]
+                self.log.info('Cam "%s" is stopped in %.3f seconds', name, self.loop.time() - self.shutdown_time)
+
+        if not self.shutdown_pending:
+            self.shutdown_timer.cancel()
+            self.log.info('Shutdown: cams are stopped in %.3f seconds', self.loop.time() - self.shutdown_time)
+            self.finish_exit()
+        elif poll_flag and self.shutdown_poll_timer is None:
+            self.shutdown_poll_timer = self.loop.call_later(self.SHUTDOWN_POLL_SECONDS, self.on_shutdown_poll)
+
+    def on_shutdown_poll(self):
+        self.shutdown_poll_timer = None
+        self.check_shutdown()
+
+    def on_shutdown_timeout(self):
+        for name, kills in self.shutdown_pending.items():
+            self.log.warning('Cam "%s" is not stopped within %s seconds, PIDs: %s',
+                             name, self.cfg['shutdown_timeout_seconds'], ', '.join(map(str, kills)))
+
+        self.shutdown_pending = {}
+
+        if self.shutdown_poll_timer is not None:
+            self.shutdown_poll_timer.cancel()
+
+        self.finish_exit()
 
     def exception_handler(self, *exception_data):
         self.log.critical('Unhandled exception:\n%s', ''.join(traceback.format_exception(*exception_data)))
         self.exit_handler(None, None, log_signal=False, exit_code=1)
 
-    def kill_process(self, pid_file, remove_pid_file):
+    @staticmethod
+    def pid_exists(pid):
+        if pid <= 0:
+            return False
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        return True
+
+    @staticmethod
+    def group_leader(pid):
+        try:
+            return os.getpgid(pid) == pid
+        except OSError:
+            return False
+
+    @staticmethod
+    def group_alive(pgid):
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        # Zombies stay in the group until their new parent reaps them, they do not count
+        for proc in psutil.process_iter(['status']):
+            if proc.info['status'] != psutil.STATUS_ZOMBIE:
+                try:
+                    if os.getpgid(proc.pid) == pgid:
+                        return True
+                except OSError:
+                    pass
+
+        return False
+
+    def signal_process(self, pid, sig, group_flag):
+        try:
+            if group_flag:
+                os.killpg(pid, sig)
+            else:
+                os.kill(pid, sig)
+        except OSError as e:
+            self.log.warning('Failed to kill process: %i (%s)', pid, e)
+            return False
+
+        return True
+
+    def kill_process(self, pid_file, remove_pid_file, sig=signal.SIGTERM, group_flag=True):
+        """Signals the process of the pid file, or its whole process group if it leads one.
+
+        SIGTERM is escalated to SIGKILL, if the process (or any process of its group) is alive after
+        kill_timeout_seconds. The exits of the children are reaped by the loop.
+        """
         pid = None
 
         if os.path.isfile(pid_file):
             pid_file_content = open(pid_file, 'r').read()
-            self.log.debug('PID file content: "%s"' % pid_file_content)
+            self.log.debug('PID file content: "%s"', pid_file_content)
 
             if len(pid_file_content.strip()):
                 pid = int(pid_file_content)
-                self.log.debug('Process id: %i' % pid)
-
-                if psutil.pid_exists(pid):
-                    self.log.debug('Kill process: %i' % pid)
-                    try:
-                        os.kill(pid, signal.SIGTERM)
-                    except OSError:
-                        self.log.warning('Failed to kill process: %i' % pid)
+                self.log.debug('Process id: %i', pid)
+
+                if self.pid_exists(pid):
+                    group_flag = group_flag and self.group_leader(pid)
+                    self.log.debug('Kill process%s: %i', ' group' if group_flag else '', pid)
+
+                    # Escalation is watched by the loop, -daemon stop only signals the daemon
+                    if self.signal_process(pid, sig, group_flag) and sig == signal.SIGTERM and self.loop is not None:
+                        try:
+                            self.watch_kill(pid, psutil.Process(pid), group_flag)
+                        except psutil.Error:
+                            pass
+                elif group_flag and self.group_alive(pid):
+                    self.kill_group(pid)
                 else:
-                    self.log.info('Process not found: %i' % pid)
+                    self.log.info('Process not found: %i', pid)
             else:
                 self.log.warning('PID is empty')
 
             if remove_pid_file:
                 os.remove(pid_file)
         else:
-            self.log.debug('Skip kill, PID file not found: %s' % pid_file)
+            self.log.debug('Skip kill, PID file not found: %s', pid_file)
 
         return pid
 
+    def watch_kill(self, pid, proc, group_flag):
+        if self.loop is not None:
+            self.kills[pid] = (proc, group_flag)
+            self.loop.call_later(self.cfg['kill_timeout_seconds'], self.escalate_kill, pid)
+
+    def kill_group(self, pgid):
+        """Stops the processes left in the group of an exited leader."""
+        self.log.info('Kill leftover processes of group: %i', pgid)
+        if self.signal_process(pgid, signal.SIGTERM, True):
+            self.watch_kill(pgid, None, True)
+
+    @staticmethod
+    def process_alive(proc):
+        if proc is None:
+            return False
+
+        try:
+            return proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+    def escalate_kill(self, pid):
+        kill = self.kills.pop(pid, None)
+        if kill is None:
+            return
+
+        proc, group_flag = kill
+        if self.process_alive(proc) or (group_flag and self.group_alive(pid)):
+            self.log.warning('Process%s %i is alive %s seconds after SIGTERM, send SIGKILL',
+                             ' group' if group_flag else '', pid, self.cfg['kill_timeout_seconds'])
+            self.signal_process(pid, signal.SIGKILL, group_flag)
+
+    def finish_kills(self):
+        """Waits for the signaled processes on exit (the loop does not run anymore), escalates and reaps them."""
+        if not self.kills:
+            return
+
+        kills = dict(self.kills)
+        self.kills.clear()
+        _, alive = psutil.wait_procs([proc for proc, _ in kills.values() if proc is not None],
+                                     timeout=self.cfg['kill_timeout_seconds'])
+
+        for pid, (proc, group_flag) in kills.items():
+            if proc in alive or (group_flag and self.group_alive(pid)):
+                self.log.warning('Process%s %i is alive %s seconds after SIGTERM, send SIGKILL',
+                                 ' group' if group_flag else '', pid, self.cfg['kill_timeout_seconds'])
+                self.signal_process(pid, signal.SIGKILL, group_flag)
+
+        psutil.wait_procs(alive, timeout=1)
+
     def kill_cam_processes(self, cam_index, cam_reset_flag=False, kill_streamer_flag=True, kill_capturer_flag=True):
-        self.log.info('Stop cam: %s' % self.cam_cfg[cam_index]['name'])
+        """Signals the cam processes without waiting for them. Returns their PIDs."""
+        cam = self.cams[cam_index]
+        self.log.info('Stop cam: %s', cam.name)
+
+        cam.cancel_timers()
+        pids = []
+
+        if cam.pipeline is not None:
+            self.log.debug('Stop %s pipeline', cam.name)
+            self.loop.remove_reader(cam.pipeline.fileno())
+            cam.pipeline.stop()
+            cam.pipeline = None
+            self.metrics.streamer_up.set(0, cam=cam.name)
+            self.metrics.capturer_up.set(0, cam=cam.name)
 
         if kill_capturer_flag:
-            self.log.debug('Kill %s capturer' % self.cam_cfg[cam_index]['name'])
-            self.kill_process(self.cam_capturer_pid[cam_index], True)
+            self.log.debug('Kill %s capturer', cam.name)
+            pids.append(self.kill_process(cam.capturer_pid_file, True))
+            cam.capturer = None
+            self.metrics.capturer_up.set(0, cam=cam.name)
 
         if kill_streamer_flag:
-            self.log.debug('Kill %s streamer' % self.cam_cfg[cam_index]['name'])
-            self.kill_process(self.cam_streamer_pid[cam_index], True)
+            self.log.debug('Kill %s streamer', cam.name)
+            pids.append(self.kill_process(cam.streamer_pid_file, True))
+            cam.streamer = None
+            self.metrics.streamer_up.set(0, cam=cam.name)
+
+        pids.append(self.stop_motion_tap(cam))
 
         if cam_reset_flag:
             try:
-                self.cam_cfg[cam_index]['reset_cmd']
+                cam.cfg['reset_cmd']
             except AttributeError:
                 self.log.debug('Cam reset command not found. Skip reset')
             else:
-                self.log.info('Resetting cam: %s' % self.cam_cfg[cam_index]['name'])
-                self.log.debug('Reset command: %s' % self.cam_cfg[cam_index]['reset_cmd'])
-                return_code = subprocess.call(self.cam_cfg[cam_index]['reset_cmd'], shell=True)
-                self.log.info('Reseted with exit code: %s' % return_code)
-
-    def kill_cams_process(self, cam_reset_flag=False):
-        for iterator, _ in enumerate(self.cam_cfg):
-            self.kill_cam_processes(iterator, cam_reset_flag=cam_reset_flag)
-
-    def bg_run(self, cmd, pid_file=None):
-        self.log.debug('Running:\n%s' % cmd)
-
-        subproc = subprocess.Popen(cmd, shell=True,
-                                   stdout=subprocess.DEVNULL,
+                self.log.info('Resetting cam: %s', cam.name)
+                self.log.debug('Reset command: %s', cam.cfg['reset_cmd'])
+                return_code = subprocess.call(cam.cfg['reset_cmd'], shell=True)
+                self.log.info('Reseted with exit code: %s', return_code)
+
+        return [pid for pid in pids if pid is not None]
+
+    def kill_cams_process(self, cam_reset_flag=False, keep_cams=()):
+        for iterator, cam in enumerate(self.cams):
+            if cam not in keep_cams:
+                self.kill_cam_processes(iterator, cam_reset_flag=cam_reset_flag)
+                cam.state = CamRunner.STATE_STOPPED
+
+    def bg_run(self, cmd, pid_file=None, stdout=None):
+        """Runs cmd (a shell command line or an argv list) in its own session, so it leads a process group.
+        stdout: None discards the output.
+        """
+        self.log.debug('Running:\n%s', cmd if isinstance(cmd, str) else ' '.join(map(shlex.quote, cmd)))
+
+        subproc = subprocess.Popen(cmd, shell=isinstance(cmd, str),
+                                   start_new_session=True,
+                                   stdout=subprocess.DEVNULL if stdout is None else stdout,
                                    stdin=subprocess.DEVNULL,
                                    stderr=subprocess.DEVNULL)
 
-        self.log.debug('Started PID: %s' % subproc.pid)
+        self.log.debug('Started PID: %s', subproc.pid)
 
         if pid_file is not None:
             open(pid_file, 'w').write(str(subproc.pid))
@@ -252,95 +964,1087 @@ class Cam:
         s = s.replace('[cams_number]', str(len(self.cam_cfg)))
         return s
 
-    def cleaner(self):
-        self.log.debug('Cleaner started')
-        clean_flag = False
-        store_file_list = None
+    def write_state(self):
+        self.publish_state()
+
+        if self.state_file is None:
+            return
+
+        state = {
+            'pid': os.getpid(),
+            'time': time.time(),
+            'cams': dict((cam.name, cam.snapshot()) for cam in self.cams)
+        }
+
+        try:
+            with open(self.state_file + '.tmp', 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(self.state_file + '.tmp', self.state_file)
+        except OSError as e:
+            self.log.warning('Failed to write state file "%s": %s', self.state_file, e)
+
+    def read_state(self):
+        """Returns the cams snapshots written by the previous daemon run."""
+        try:
+            with open(self.state_file) as f:
+                return json.load(f).get('cams', {})
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, AttributeError) as e:
+            self.log.warning('Failed to read state file "%s": %s', self.state_file, e)
+            return {}
+
+    @staticmethod
+    def process_create_time(pid):
+        try:
+            return psutil.Process(pid).create_time()
+        except psutil.Error:
+            return None
+
+    def adopt_process(self, cam, role, pid_file, cmd, create_time):
+        """Returns an AdoptedProcess of the pid file, if it is the same running process, which matches cmd."""
+        try:
+            pid = int(open(pid_file, 'r').read())
+            proc = psutil.Process(pid)
+
+            if create_time is None or abs(proc.create_time() - create_time) > 1:
+                self.log.info('Cam "%s" %s is not adopted, PID %i is another process', cam.name, role, pid)
+                return None
+
+            cmdline = proc.cmdline()
+        except (OSError, ValueError, psutil.Error) as e:
+            self.log.debug('Cam "%s" %s is not adopted: %s', cam.name, role, e)
+            return None
+
+        if not cmdline_matches(cmd, cmdline):
+            self.log.info('Cam "%s" %s is not adopted, command line does not match: %s',
+                          cam.name, role, ' '.join(cmdline))
+            return None
+
+        process = cam_loop.AdoptedProcess(proc)
+        if process.poll() is not None:
+            return None
+
+        self.log.info('Adopt "%s" %s (PID: %i)', cam.name, role, pid)
+        return process
+
+    def adopt_cams(self, saved_cams):
+        """Takes over the supervision of the processes left running by the previous daemon run.
+
+        A cam is adopted, when its commands are not changed and its streamer is still running. Its capturer is
+        adopted too or started again after a probe. Returns the adopted cams.
+        """
+        adopted_cams = set()
+
+        for cam in self.cams:
+            saved = saved_cams.get(cam.name)
+            if saved is None or saved.get('fingerprint') != cam.fingerprint() or cam.pipeline_description:
+                continue
+
+            try:
+                streamer_cmd = self.command(cam, cam.cfg['cmd'].strip())
+                capturer_cmd = self.command(cam, cam.cap_cmd) if cam.cap_cmd is not False else None
+            except cam_command.CommandError as e:
+                self.log.info('Cam "%s" is not adopted: %s', cam.name, e)
+                continue
+
+            streamer = self.adopt_process(cam, 'streamer', cam.streamer_pid_file, streamer_cmd,
+                                          saved.get('streamer_create_time'))
+            if streamer is None:
+                continue
+
+            cam.streamer = streamer
+            cam.streamer_create_time = saved['streamer_create_time']
+            self.metrics.streamer_up.set(1, cam=cam.name)
+            self.loop.watch_child(cam.streamer, self.on_streamer_exit, cam)
+            adopted_cams.add(cam)
+
+            # The motion tap writes to the previous daemon, a new one is started
+            self.stop_motion_tap(cam)
+
+            if capturer_cmd is not None:
+                capturer = self.adopt_process(cam, 'capturer', cam.capturer_pid_file, capturer_cmd,
+                                              saved.get('capturer_create_time'))
+            else:
+                capturer = None
+
+            if capturer is not None and saved.get('state') == CamRunner.STATE_RUNNING:
+                cam.capturer = capturer
+                cam.capturer_create_time = saved['capturer_create_time']
+                cam.start_time = saved.get('start_time', time.time())
+                self.metrics.capturer_up.set(1, cam=cam.name)
+                self.loop.watch_child(cam.capturer, self.on_capturer_exit, cam)
+                self.enter_running(cam)
+            else:
+                self.kill_process(cam.capturer_pid_file, True)
+                self.start_probing(cam)
+
+        return adopted_cams
+
+    def set_state(self, cam, state):
+        if cam.state != state:
+            self.log.info('Cam "%s" state: %s -> %s', cam.name, cam.state, state)
+            cam.state = state
+            cam.state_time = time.time()
+            self.write_state()
+
+            if cam in self.startup_wave and state != CamRunner.STATE_STARTING:
+                self.on_startup_cam_done(cam)
+
+    def admit_startup_wave(self):
+        """Starts the next wave of cams on a cold start, when the CPU usage allows it."""
+        self.startup_timer = None
+
+        if not self.startup_queue or not self.main_loop_active_flag:
+            return
+
+        cpu_percent = self.startup_cpu_percent
+        if cpu_percent > self.cfg['startup_max_cpu_percent']:
+            self.log.info('Startup: CPU usage %.0f%% is above %s%%, wait before next cams: %i',
+                          cpu_percent, self.cfg['startup_max_cpu_percent'], len(self.startup_queue))
+            self.startup_timer = self.loop.call_later(self.cfg['startup_check_seconds'], self.admit_startup_wave)
+            return
+
+        wave = self.startup_queue[:self.cfg['startup_wave_size']]
+        del self.startup_queue[:len(wave)]
+        self.log.info('Startup: start cams: %s (CPU usage: %.0f%%, cams left: %i)',
+                      ', '.join(cam.name for cam in wave), cpu_percent, len(self.startup_queue))
+
+        self.startup_wave.update(wave)
+        for cam in wave:
+            self.start_streamer(cam)
+
+    def sample_startup_cpu(self):
+        # CPU usage since the previous call, a too short interval would be noisy
+        self.startup_cpu_percent = psutil.cpu_percent()
+
+        if self.startup_queue and self.main_loop_active_flag:
+            self.startup_cpu_timer = self.loop.call_later(self.cfg['startup_check_seconds'], self.sample_startup_cpu)
+        else:
+            self.startup_cpu_timer = None
+
+    def on_startup_cam_done(self, cam):
+        self.startup_wave.discard(cam)
+
+        if cam.state == CamRunner.STATE_RUNNING:
+            cam.recording_seconds = time.time() - self.startup_time
+            self.metrics.startup_seconds.set(cam.recording_seconds, cam=cam.name)
+            self.log.info('Startup: cam "%s" is recording in %.1f seconds', cam.name, cam.recording_seconds)
+        else:
+            self.log.warning('Startup: cam "%s" failed to start (state: %s)', cam.name, cam.state)
+
+        if not self.startup_wave:
+            if self.startup_queue:
+                self.admit_startup_wave()
+            else:
+                recording_cams = [c for c in self.cams if c.recording_seconds is not None]
+                self.log.info('Startup: finished in %.1f seconds, recording cams: %i/%i',
+                              time.time() - self.startup_time, len(recording_cams), len(self.cams))
+
+    @staticmethod
+    def command(cam, cmd):
+        """Returns the argv of cmd in exec mode (raises CommandError), otherwise cmd itself to be run by the shell."""
+        if cam.cfg['exec_mode']:
+            return cam_command.argv(cmd)
+
+        return cmd
+
+    def start_streamer(self, cam):
+        cam.restart_timer = None
+
+        if cam.pipeline_description is not None:
+            self.start_pipeline(cam)
+            return
+
+        try:
+            cmd = self.command(cam, cam.cfg['cmd'].strip())
+        except cam_command.CommandError as e:
+            self.log.error('Cam "%s" streamer command failed: %s', cam.name, e)
+            self.metrics.restarts.inc(cam=cam.name, reason='command')
+            self.on_cam_failure(cam, 'streamer command: %s' % e)
+            return
+
+        self.log.info('Run "%s" streamer in background', cam.name)
+        cam.streamer = self.bg_run(cmd, cam.streamer_pid_file)
+        cam.streamer_create_time = self.process_create_time(cam.streamer.pid)
+        cam.launch_time = time.time()
+        self.metrics.streamer_up.set(1, cam=cam.name)
+        self.loop.watch_child(cam.streamer, self.on_streamer_exit, cam)
+        self.start_probing(cam)
+
+    def start_pipeline(self, cam):
+        """Starts the in-process pipeline of a cam, its bus messages are read by on_pipeline_messages()."""
+        self.log.info('Run "%s" pipeline', cam.name)
+        self.log.debug('Pipeline:\n%s', cam.pipeline_description)
+
+        try:
+            pipeline = cam_gst.Pipeline(cam.name, cam.pipeline_description, cam.segment_location,
+                                        cam.cfg['gst_segment_seconds'])
+            pipeline.start()
+        except cam_gst.PipelineError as e:
+            self.log.error('Cam "%s" pipeline failed: %s', cam.name, e)
+            self.metrics.restarts.inc(cam=cam.name, reason='pipeline_error')
+            self.on_cam_failure(cam, 'pipeline: %s' % e, cam_reset_flag=True)
+            return
+
+        cam.pipeline = pipeline
+        cam.launch_time = time.time()
+        self.metrics.streamer_up.set(1, cam=cam.name)
+        self.loop.add_reader(pipeline.fileno(), self.on_pipeline_messages, cam, pipeline)
+
+        # No HTTP probes: the pipeline reports PLAYING on its bus
+        cam.cancel_timers()
+        cam.start_time = time.time()
+        self.set_state(cam, CamRunner.STATE_STARTING)
+        cam.start_timer = self.loop.call_later(cam.cfg['max_start_seconds'], self.on_start_timeout, cam)
+
+    def on_pipeline_messages(self, cam, pipeline):
+        if pipeline is not cam.pipeline:
+            self.loop.remove_reader(pipeline.fileno())
+            return
+
+        for kind, text in pipeline.read_messages():
+            if kind == cam_gst.Pipeline.KIND_PLAYING and cam.state == CamRunner.STATE_STARTING:
+                self.log.info('Pipeline "%s" is playing', cam.name)
+
+                if cam.launch_time is not None:
+                    self.metrics.start_seconds.observe(time.time() - cam.launch_time, cam=cam.name)
+                    cam.launch_time = None
+
+                cam.cancel_timers()
+                self.enter_running(cam)
+                self.metrics.capturer_up.set(1 if cam.segment_location else 0, cam=cam.name)
+            elif kind == cam_gst.Pipeline.KIND_SEGMENT:
+                self.log.debug('Cam "%s" segment is closed: %s', cam.name, text)
+
+                # With the store index the segment is cataloged on its close event
+                if self.catalog is not None and self.store_index is None:
+                    self.catalog.index(text, os.path.basename(os.path.dirname(text)))
+            elif kind in (cam_gst.Pipeline.KIND_ERROR, cam_gst.Pipeline.KIND_EOS):
+                self.log.warning('Pipeline "%s" is stopped: %s', cam.name, text or 'end of stream')
+                self.metrics.restarts.inc(cam=cam.name, reason='pipeline_%s' % kind)
+                self.on_cam_failure(cam, 'pipeline %s' % (text or 'end of stream'),
+                                    cam_reset_flag=kind == cam_gst.Pipeline.KIND_ERROR)
+                return
+
+    def start_probing(self, cam):
+        cam.cancel_timers()
+        cam.start_time = time.time()
+        self.set_state(cam, CamRunner.STATE_STARTING)
+        cam.probe_timer = self.loop.call_later(0, self.run_probe, cam)
+        cam.start_timer = self.loop.call_later(cam.cfg['max_start_seconds'], self.on_start_timeout, cam)
+
+    def run_probe(self, cam):
+        cam.probe_timer = None
+        cap_url = self.replacer(self.cfg['cap_url'], cam.index)
+        self.log.debug('Getting HTTP status: %s', cap_url)
+
+        probe = self.prober.probe(cap_url, cam.cfg['probe_timeout_seconds'])
+        cam.probe = probe
+        probe.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.on_probe_done, cam, f))
+
+    def on_probe_done(self, cam, probe):
+        if probe is not cam.probe or cam.state != CamRunner.STATE_STARTING:
+            return
+
+        cam.probe = None
+        probe_result = probe.result()
+        self.metrics.probe_seconds.observe(probe_result.latency, cam=cam.name)
+        self.metrics.probes.inc(cam=cam.name, code=probe_result.http_code)
+
+        if probe_result.http_code != 0:
+            self.log.info('Checked "%s", status: %s', cam.name, probe_result.http_code)
+
+            if probe_result.http_code == 200:
+                if cam.launch_time is not None:
+                    self.metrics.start_seconds.observe(time.time() - cam.launch_time, cam=cam.name)
+                    cam.launch_time = None
+
+                cam.cancel_timers()
+                self.start_capturer(cam)
+                return
+        else:
+            self.log.warning('Failed to connect: %s', probe_result.url)
+
+        self.log.info('Attempt "%s": [%i/%i]',
+                      cam.name, time.time() - cam.start_time, cam.cfg['max_start_seconds'],
+                      extra=cam_logging.ANY_NUMBERS)
+        cam.probe_timer = self.loop.call_later(cam.cfg['probe_interval_seconds'], self.run_probe, cam)
+
+    def on_start_timeout(self, cam):
+        cam.start_timer = None
+        self.log.warning('Time outed waiting data from: %s', cam.name)
+        self.log.info('Kill: %s', cam.name)
+        self.metrics.restarts.inc(cam=cam.name, reason='start_timeout')
+        self.on_cam_failure(cam, 'start timeout', cam_reset_flag=True)
+
+    def on_cam_failure(self, cam, reason, cam_reset_flag=False, kill_streamer_flag=True, kill_capturer_flag=True):
+        cam.restarts += 1
+        cam.failures += 1
+        cam.last_reason = reason
+        self.kill_cam_processes(cam.index, cam_reset_flag=cam_reset_flag, kill_streamer_flag=kill_streamer_flag,
+                                kill_capturer_flag=kill_capturer_flag)
+
+        if not self.main_loop_active_flag:
+            return
+
+        now = time.time()
+        cam.restart_times.append(now)
+        while cam.restart_times and now - cam.restart_times[0] > cam.cfg['restart_budget_window_seconds']:
+            cam.restart_times.popleft()
+
+        if cam.half_open_flag or len(cam.restart_times) > cam.cfg['restart_budget']:
+            self.log.warning('Cam "%s" is parked for %i seconds, restarts within %i seconds: %i, last reason: %s',
+                             cam.name, cam.cfg['restart_park_seconds'], cam.cfg['restart_budget_window_seconds'],
+                             len(cam.restart_times), reason)
+            cam.restart_timer = self.loop.call_later(cam.cfg['restart_park_seconds'], self.half_open, cam)
+            self.set_state(cam, CamRunner.STATE_PARKED)
+        else:
+            delay = cam.restart_delay()
+            self.log.info('Restart "%s" in %.1f seconds (failures: %i, reason: %s)',
+                          cam.name, delay, cam.failures, reason, extra=cam_logging.ANY_NUMBERS)
+            cam.restart_timer = self.loop.call_later(delay, self.start_streamer, cam)
+            self.set_state(cam, CamRunner.STATE_BACKOFF)
+
+    def half_open(self, cam):
+        self.log.info('Retry parked cam: %s', cam.name)
+        cam.half_open_flag = True
+        cam.restart_times.clear()
+        self.start_streamer(cam)
+
+    def check_stall(self, cam):
+        cam.stall_timer = None
+
+        if cam.motion_idle_flag:
+            # Idle recording is slow or paused, the frames of the motion tap show that the stream is alive
+            cam.stall_since = None
+            cam.stall_timer = self.loop.call_later(cam.cfg['stall_check_seconds'], self.check_stall, cam)
+        elif cam.cap_dir is not None and (cam.capturer is not None or cam.pipeline is not None):
+            now = time.time()
+            growth = cam.segment_growth()
+
+            if growth is None:
+                self.on_stall_check(cam, None)
+            else:
+                self.on_stall_check(cam, 1.0 * growth / max(now - cam.stall_check_time, 0.001))
+
+            cam.stall_check_time = now
+        elif cam.cfg['stall_http_check']:
+            cap_url = self.replacer(self.cfg['cap_url'], cam.index)
+            cam.stall_probe = self.prober.throughput(cap_url, cam.cfg['probe_timeout_seconds'],
+                                                     cam.cfg['stall_http_sample_seconds'])
+            cam.stall_probe.add_done_callback(
+                lambda f: self.loop.call_soon_threadsafe(self.on_stall_probe_done, cam, f))
+        else:
+            cam.stall_timer = self.loop.call_later(cam.cfg['stall_check_seconds'], self.check_stall, cam)
+
+    def on_stall_probe_done(self, cam, probe):
+        if probe is not cam.stall_probe or cam.state != CamRunner.STATE_RUNNING:
+            return
+
+        cam.stall_probe = None
+        probe_result = probe.result()
+        self.on_stall_check(cam, 1.0 * probe_result.received_bytes / max(probe_result.duration, 0.001))
+
+    def on_stall_check(self, cam, rate):
+        """rate: bytes per second of the data plane or None, when it is not known yet."""
+        if rate is not None:
+            self.metrics.data_rate.set(rate, cam=cam.name)
+
+            if rate < cam.cfg['stall_min_bytes_per_second']:
+                now = time.time()
+
+                if cam.stall_since is None:
+                    cam.stall_since = now
+                    self.log.warning('Cam "%s" data rate is low: %.0f bytes/s', cam.name, rate,
+                                     extra=cam_logging.ANY_NUMBERS)
+                elif now - cam.stall_since >= cam.cfg['stall_seconds']:
+                    self.log.warning('Cam "%s" is stalled for %i seconds, data rate: %.0f bytes/s',
+                                     cam.name, now - cam.stall_since, rate)
+                    self.metrics.restarts.inc(cam=cam.name, reason='stall')
+                    self.on_cam_failure(cam, 'stall', cam_reset_flag=True)
+                    return
+            elif cam.stall_since is not None:
+                self.log.info('Cam "%s" data rate is restored: %.0f bytes/s', cam.name, rate)
+                cam.stall_since = None
+
+        cam.stall_timer = self.loop.call_later(cam.cfg['stall_check_seconds'], self.check_stall, cam)
+
+    def on_cam_stable(self, cam):
+        cam.stable_timer = None
+        cam.failures = 0
+
+        if cam.half_open_flag:
+            self.log.info('Parked cam "%s" is running again', cam.name)
+            cam.half_open_flag = False
+
+    def enter_running(self, cam):
+        self.set_state(cam, CamRunner.STATE_RUNNING)
+        cam.stable_timer = self.loop.call_later(cam.cfg['restart_stable_seconds'], self.on_cam_stable, cam)
+
+        if cam.motion_cmd is not None and cam.motion_tap is None and cam.motion_tap_timer is None:
+            self.start_motion_tap(cam)
+
+        if cam.cfg['stall_check_seconds']:
+            cam.stall_segment = None
+            cam.stall_since = None
+            cam.stall_check_time = time.time()
+            cam.stall_timer = self.loop.call_later(cam.cfg['stall_check_seconds'], self.check_stall, cam)
+
+    def start_capturer(self, cam):
+        cmd = None
+        cap_cmd = cam.idle_cap_cmd if cam.motion_idle_flag else cam.cap_cmd
+
+        if cap_cmd is not False and (cam.capturer is None or cam.capturer.poll() is not None):
+            try:
+                cmd = self.command(cam, cap_cmd)
+            except cam_command.CommandError as e:
+                self.log.error('Cam "%s" capturer command failed: %s', cam.name, e)
+                self.metrics.restarts.inc(cam=cam.name, reason='command')
+                self.on_cam_failure(cam, 'capturer command: %s' % e)
+                return
+
+        self.enter_running(cam)
+
+        if cam.capturer is not None and cam.capturer.poll() is None:
+            self.log.warning('Capturer "%s" is STILL alive', cam.name)
+        elif cmd is not None:
+            self.launch_capturer(cam, cmd)
+        else:
+            self.log.info('Capturer "%s" is turned off', cam.name)
+
+    def launch_capturer(self, cam, cmd):
+        self.log.info('Run "%s" %scapturer in background', cam.name, 'idle ' if cam.motion_idle_flag else '')
+        cam.capturer = self.bg_run(cmd, cam.capturer_pid_file)
+        cam.capturer_create_time = self.process_create_time(cam.capturer.pid)
+        self.metrics.capturer_up.set(1, cam=cam.name)
+        self.loop.watch_child(cam.capturer, self.on_capturer_exit, cam)
+        self.publish_state(cam)
+
+    def on_streamer_exit(self, streamer, cam):
+        if streamer is not cam.streamer:
+            self.log.debug('Streamer "%s" exited (PID: %s)', cam.name, streamer.pid)
+            return
+
+        self.log.warning('Streamer "%s" is dead (exit code: %s)', cam.name, streamer.returncode)
+        if self.group_alive(streamer.pid):
+            self.kill_group(streamer.pid)
+        cam.streamer = None
+        self.metrics.streamer_up.set(0, cam=cam.name)
+        self.metrics.restarts.inc(cam=cam.name, reason='streamer_exit')
+
+        if self.main_loop_active_flag:
+            self.on_cam_failure(cam, 'streamer exit code %s' % streamer.returncode,
+                                kill_streamer_flag=False, kill_capturer_flag=False)
+
+    def on_capturer_exit(self, capturer, cam):
+        if capturer is cam.spool_capturer:
+            cam.spool_capturer = None
+            self.keep_pre_roll(cam)
+
+        if capturer is not cam.capturer:
+            self.log.debug('Capturer "%s" exited (PID: %s)', cam.name, capturer.pid)
+            return
+
+        self.log.warning('Capturer "%s" is dead (exit code: %s)', cam.name, capturer.returncode)
+        if self.group_alive(capturer.pid):
+            self.kill_group(capturer.pid)
+        cam.capturer = None
+        self.metrics.capturer_up.set(0, cam=cam.name)
+        self.metrics.restarts.inc(cam=cam.name, reason='capturer_exit')
+
+        if self.main_loop_active_flag and cam.state == CamRunner.STATE_RUNNING:
+            self.start_probing(cam)
+
+    def sample_resources(self):
+        self.resources_timer = None
+        targets = []
+
+        for cam in self.cams:
+            if cam.streamer is not None:
+                targets.append(((cam.name, 'streamer'), cam.streamer.pid))
+            if cam.capturer is not None:
+                targets.append(((cam.name, 'capturer'), cam.capturer.pid))
+
+        future = self.resource_sampler.submit(targets)
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.on_resources_sampled, f))
+
+    def on_resources_sampled(self, future):
+        if not self.main_loop_active_flag:
+            return
+
+        try:
+            samples = future.result()
+        except Exception as e:
+            self.log.warning('Failed to sample processes resources: %s', e)
+            samples = {}
+
+        for (cam_name, role), sample in samples.items():
+            self.metrics.cpu_percent.set(sample.cpu_percent, cam=cam_name, role=role)
+            self.metrics.rss_bytes.set(sample.rss_bytes, cam=cam_name, role=role)
+            self.metrics.open_fds.set(sample.fds, cam=cam_name, role=role)
+            self.metrics.threads.set(sample.threads, cam=cam_name, role=role)
+
+        for cam in self.cams:
+            if cam.recycle_reason is None and cam.state == CamRunner.STATE_RUNNING:
+                reason = self.resources_breach(cam)
+
+                if reason is not None:
+                    self.log.warning('Cam "%s" is going to be recycled: %s', cam.name, reason)
+                    cam.recycle_reason = reason
+                    cam.recycle_since = time.time()
+                    cam.recycle_segment = self.newest_segment(cam)
+
+            if cam.recycle_reason is not None:
+                self.recycle_at_segment_boundary(cam)
+
+        self.resources_timer = self.loop.call_later(self.cfg['resources_sample_seconds'], self.sample_resources)
+
+    def resources_breach(self, cam):
+        for role in ('streamer', 'capturer'):
+            key = (cam.name, role)
+
+            if cam.cfg['recycle_max_rss_mb'] and self.resource_sampler.breached(
+                    key, 'rss_bytes', cam.cfg['recycle_max_rss_mb'] * 1024 * 1024,
+                    cam.cfg['recycle_max_rss_minutes'] * 60):
+                return '%s RSS is above %s Mb for %s minutes' % (
+                    role, cam.cfg['recycle_max_rss_mb'], cam.cfg['recycle_max_rss_minutes'])
+
+            if cam.cfg['recycle_max_cpu_percent'] and self.resource_sampler.breached(
+                    key, 'cpu_percent', cam.cfg['recycle_max_cpu_percent'], cam.cfg['recycle_max_cpu_minutes'] * 60):
+                return '%s CPU is above %s%% for %s minutes' % (
+                    role, cam.cfg['recycle_max_cpu_percent'], cam.cfg['recycle_max_cpu_minutes'])
+
+            if cam.cfg['recycle_max_fds'] and self.resource_sampler.breached(
+                    key, 'fds', cam.cfg['recycle_max_fds'], self.cfg['resources_sample_seconds']):
+                return '%s open fds are above %s' % (role, cam.cfg['recycle_max_fds'])
+
+        return None
+
+    @staticmethod
+    def newest_segment(cam):
+        try:
+            newest = newest_file(cam.cap_dir)
+        except OSError:
+            return None
+
+        return newest[1] if newest is not None else None
+
+    def recycle_at_segment_boundary(self, cam):
+        boundary_flag = cam.cap_dir is None or cam.capturer is None
+
+        if not boundary_flag:
+            # A new newest segment, the cleaner removes and the pre-roll moves only older files
+            segment = self.newest_segment(cam)
+            boundary_flag = segment is None or segment != cam.recycle_segment
+
+        if boundary_flag:
+            self.log.info('Recycle cam "%s" at a segment boundary', cam.name)
+        elif time.time() - cam.recycle_since > cam.cfg['recycle_max_wait_minutes'] * 60:
+            self.log.info('Recycle cam "%s", no segment boundary within %s minutes',
+                          cam.name, cam.cfg['recycle_max_wait_minutes'])
+        else:
+            return
+
+        self.metrics.restarts.inc(cam=cam.name, reason='recycle')
+        cam.last_reason = 'recycle: %s' % cam.recycle_reason
+        cam.recycle_reason = None
+        self.kill_cam_processes(cam.index)
+        self.resource_sampler.forget((cam.name, 'streamer'))
+        self.resource_sampler.forget((cam.name, 'capturer'))
+        self.start_streamer(cam)
+
+    def start_motion_tap(self, cam):
+        """Starts the motion_cmd process, which writes the raw frames of the detector to its stdout."""
+        cam.motion_tap_timer = None
+
+        if cam.state != CamRunner.STATE_RUNNING or not self.main_loop_active_flag:
+            return
+
+        try:
+            cmd = self.command(cam, cam.motion_cmd)
+        except cam_command.CommandError as e:
+            self.log.error('Cam "%s" motion command failed, record fully: %s', cam.name, e)
+            return
+
+        self.log.info('Run "%s" motion tap in background', cam.name)
+        cam.motion_tap = self.bg_run(cmd, cam.motion_pid_file, stdout=subprocess.PIPE)
+        cam.motion_buffer = bytearray()
+        cam.motion_detector.previous = None
+        cam.motion_time = cam.motion_frame_time = time.time()
+        os.set_blocking(cam.motion_tap.stdout.fileno(), False)
+        self.loop.add_reader(cam.motion_tap.stdout.fileno(), self.on_motion_data, cam, cam.motion_tap)
+        self.loop.watch_child(cam.motion_tap, self.on_motion_tap_exit, cam)
+        cam.motion_timer = self.loop.call_later(cam.cfg['motion_frame_timeout_seconds'], self.on_motion_watchdog, cam)
+
+    def stop_motion_tap(self, cam):
+        """Stops the motion tap, the cam records fully again. Returns the tap PID."""
+        for timer in (cam.motion_timer, cam.motion_tap_timer):
+            if timer is not None:
+                timer.cancel()
+
+        cam.motion_timer = None
+        cam.motion_tap_timer = None
+
+        if cam.motion_tap is not None:
+            self.loop.remove_reader(cam.motion_tap.stdout.fileno())
+            cam.motion_tap.stdout.close()
+            cam.motion_tap = None
+            cam.motion_buffer = None
+
+        if cam.motion_idle_flag:
+            cam.motion_idle_flag = False
+            self.metrics.motion_idle.set(0, cam=cam.name)
+
+        if cam.motion_pid_file is None:
+            return None
+
+        return self.kill_process(cam.motion_pid_file, True)
+
+    def on_motion_tap_exit(self, tap, cam):
+        if tap is not cam.motion_tap:
+            self.log.debug('Motion tap "%s" exited (PID: %s)', cam.name, tap.pid)
+            return
+
+        self.log.warning('Motion tap "%s" is dead (exit code: %s), record fully', cam.name, tap.returncode)
+        self.set_motion_idle(cam, False)
+        self.stop_motion_tap(cam)
+
+        if self.main_loop_active_flag and cam.state == CamRunner.STATE_RUNNING:
+            cam.motion_tap_timer = self.loop.call_later(self.MOTION_TAP_RESTART_SECONDS, self.start_motion_tap, cam)
+
+    def on_motion_watchdog(self, cam):
+        cam.motion_timer = None
+        timeout = cam.cfg['motion_frame_timeout_seconds']
+
+        if time.time() - cam.motion_frame_time < timeout:
+            cam.motion_timer = self.loop.call_later(cam.motion_frame_time + timeout - time.time(),
+                                                    self.on_motion_watchdog, cam)
+            return
+
+        self.log.warning('Motion tap "%s" has sent no frames for %s seconds, record fully', cam.name, timeout)
+        self.set_motion_idle(cam, False)
+        self.stop_motion_tap(cam)
+        cam.motion_tap_timer = self.loop.call_later(self.MOTION_TAP_RESTART_SECONDS, self.start_motion_tap, cam)
+
+    def on_motion_data(self, cam, tap):
+        if tap is not cam.motion_tap:
+            return
+
+        try:
+            data = os.read(tap.stdout.fileno(), self.MOTION_READ_BYTES)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            # The exit is handled by on_motion_tap_exit()
+            self.loop.remove_reader(tap.stdout.fileno())
+            return
+
+        buffer = cam.motion_buffer
+        buffer += data
+        frame_size = cam.motion_detector.frame_size
+        frames = len(buffer) // frame_size
+
+        if frames:
+            # Only the newest frame is compared, if the loop has fallen behind
+            frame = bytes(buffer[(frames - 1) * frame_size:frames * frame_size])
+            del buffer[:frames * frame_size]
+            self.on_motion_frame(cam, frame)
+
+    def on_motion_frame(self, cam, frame):
+        detect_time = time.time()
+        changed_percent = cam.motion_detector.update(frame)
+        now = time.time()
+        self.metrics.motion_detect_seconds.observe(now - detect_time)
+        self.metrics.motion_changed_percent.set(changed_percent, cam=cam.name)
+        cam.motion_frame_time = now
+
+        if cam.motion_detector.motion(changed_percent):
+            cam.motion_time = now
+
+            if cam.motion_idle_flag:
+                self.log.info('Cam "%s" motion (%.1f%% changed), record fully', cam.name, changed_percent)
+                self.set_motion_idle(cam, False)
+        elif not cam.motion_idle_flag and now - cam.motion_time >= cam.cfg['motion_post_roll_seconds']:
+            self.log.info('Cam "%s" no motion for %i seconds, record idle', cam.name, now - cam.motion_time)
+            self.set_motion_idle(cam, True)
+
+        if cam.motion_idle_flag and cam.spool_dir is not None:
+            self.prune_spool(cam, now)
+
+    def set_motion_idle(self, cam, idle_flag):
+        """Switches the capturer between cap_cmd and idle_cap_cmd (False - no capturer)."""
+        if cam.motion_idle_flag == idle_flag:
+            return
+
+        cam.motion_idle_flag = idle_flag
+        self.metrics.motion_idle.set(int(idle_flag), cam=cam.name)
+
+        # Otherwise start_capturer() picks the command
+        if cam.state == CamRunner.STATE_RUNNING:
+            if cam.capturer is not None:
+                if not idle_flag and cam.spool_dir is not None:
+                    # The pre-roll is kept, once the idle capturer has closed its files
+                    cam.spool_capturer = cam.capturer
+
+                self.kill_process(cam.capturer_pid_file, True)
+                cam.capturer = None
+                self.metrics.capturer_up.set(0, cam=cam.name)
+            elif not idle_flag and cam.spool_dir is not None:
+                self.keep_pre_roll(cam)
+
+            cap_cmd = cam.idle_cap_cmd if idle_flag else cam.cap_cmd
+
+            if cap_cmd is not False:
+                try:
+                    cmd = self.command(cam, cap_cmd)
+                except cam_command.CommandError as e:
+                    self.log.error('Cam "%s" capturer command failed: %s', cam.name, e)
+                    self.metrics.restarts.inc(cam=cam.name, reason='command')
+                    self.on_cam_failure(cam, 'capturer command: %s' % e)
+                    return
 
-        if int(self.cfg['cleaner_store_max_gb']) != 0:
-            store_file_list = glob2.glob(os.path.join(self.cfg['cap_dir'], '**'))
-            self.log.debug('Found files: %s' % store_file_list)
+                self.launch_capturer(cam, cmd)
 
-            store_file_total_size_bytes = 0
-            for store_file in store_file_list:
-                store_file_total_size_bytes += os.path.getsize(store_file)
+        self.publish_state(cam)
 
-            store_file_total_size_gigabytes = 1.0 * store_file_total_size_bytes / 1024 / 1024 / 1024
-            self.log.debug('Store files size, Gb: %f' % store_file_total_size_gigabytes)
+    def prune_spool(self, cam, now):
+        """Removes the idle recording files older than motion_pre_roll_seconds from the spool directory."""
+        keep_time = now - cam.cfg['motion_pre_roll_seconds']
 
-            if store_file_total_size_gigabytes > float(self.cfg['cleaner_store_max_gb']):
-                self.log.info('Current store size / Configured max store size, Gb: %.3f/%.3f' %
-                              (store_file_total_size_gigabytes, self.cfg['cleaner_store_max_gb']))
-                clean_flag = True
+        try:
+            with os.scandir(cam.spool_dir) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < keep_time:
+                        os.remove(entry.path)
+        except OSError as e:
+            self.log.warning('Cam "%s" spool cleanup failed: %s', cam.name, e)
 
-        if int(self.cfg['cleaner_store_keep_free_gb']) != 0:
-            store_stat = os.statvfs(self.cfg['cap_dir'])
-            store_free_gb = 1.0 * store_stat.f_bavail * store_stat.f_frsize / 1024 / 1024 / 1024
-            self.log.debug('Store free space, Gb: %f' % store_free_gb)
+    def keep_pre_roll(self, cam):
+        """Moves the idle recording of the last motion_pre_roll_seconds from the spool to the cam store."""
+        self.prune_spool(cam, time.time())
 
-            if store_free_gb < float(self.cfg['cleaner_store_keep_free_gb']):
-                self.log.info('Current store free space / Configured keep store free space, Gb: %.3f/%.3f' %
-                              (store_free_gb, self.cfg['cleaner_store_keep_free_gb']))
-                clean_flag = True
+        if self.spool_executor is None:
+            self.spool_executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='spool')
 
-        if clean_flag:
-            self.log.info('Clean is active')
+        future = self.spool_executor.submit(self.move_files, cam.spool_dir, cam.cap_dir)
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.on_pre_roll_kept, cam, f))
 
-            if store_file_list is None:
-                store_file_list = glob2.glob(os.path.join(self.cfg['cap_dir'], '**'))
+    @staticmethod
+    def move_files(src_dir, dst_dir):
+        """Runs in the spool thread. Returns the number of files moved."""
+        moved = 0
+
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    shutil.move(entry.path, os.path.join(dst_dir, entry.name))
+                    moved += 1
+
+        return moved
+
+    def on_pre_roll_kept(self, cam, future):
+        try:
+            moved = future.result()
+        except OSError as e:
+            self.log.warning('Cam "%s" pre-roll is not kept: %s', cam.name, e)
+        else:
+            if moved:
+                self.log.info('Cam "%s" pre-roll: %i files are kept', cam.name, moved)
+
+    def run_cleaner(self):
+        # No inotify: the segments are seen closed by the rescan of the previous cleaner run
+        if self.store_index.fileno() is None:
+            self.index_closed()
+
+        self.cleaner.trigger()
+        self.cleaner_timer = self.loop.call_later(self.cfg['cleaner_run_every_minutes'] * 60, self.run_cleaner)
+
+    def on_store_index_ready(self):
+        """The cleaner thread has loaded the store index."""
+        if not self.main_loop_active_flag:
+            return
+
+        if self.store_index.fileno() is not None:
+            self.loop.add_reader(self.store_index.fileno(), self.on_store_event)
+
+        if self.catalog is not None:
+            self.catalog_timer = self.loop.call_later(0, self.sync_catalog)
+
+    def on_store_event(self):
+        self.store_index.update()
+        self.index_closed()
+
+    def index_closed(self):
+        if self.catalog is not None:
+            for path in self.store_index.take_closed():
+                self.catalog.index(path, self.store_index.cam_of(path))
+
+    def sync_catalog(self):
+        """Adds the segments closed while the daemon was not running and drops the rows of removed files."""
+        self.catalog_timer = self.loop.call_later(self.cfg['catalog_sync_minutes'] * 60, self.sync_catalog)
+        future = self.catalog.sync(self.store_index.closed_files)
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.on_catalog_synced, f))
+
+    def on_catalog_synced(self, future):
+        try:
+            added, removed = future.result()
+        except Exception as e:
+            self.log.error('Catalog sync failed: %s', e)
+        else:
+            self.log.info('Catalog sync: %i segments added, %i removed', added, removed)
+
+    def cam_owned(self, cam):
+        return self.cluster is None or cam.name in self.cluster_owned
+
+    def start_cluster(self):
+        """Joins the cluster. The first heartbeat is synchronous, so only the owned cams are adopted and started."""
+        node = os.getenv('CLUSTER_NODE') or self.cfg['cluster_node'] or None
+
+        try:
+            self.cluster = cam_cluster.Cluster(self.cfg['cluster_store'], node, self.cfg['cluster_lease_seconds'],
+                                               self.cfg['cluster_vnodes'])
+            renew_time = time.time()
+            view = self.cluster.heartbeat([cam.name for cam in self.cams], ())
+        except Exception as e:
+            self.log.critical('Cluster store "%s" failed: %s. Exit', self.cfg['cluster_store'], e)
+            self.remove_main_pid()
+            sys.exit(1)
 
-            store_file_list_sorted = SortedDict()
-            for store_file in store_file_list:
-                store_file_list_sorted.update({os.path.getmtime(store_file): store_file})
+        self.cluster_renew_time = renew_time
+        self.cluster_nodes = view.nodes
+        self.cluster_owned = view.owned
+        self.log.info('Cluster node "%s", nodes: %s, owned cams: %i of %i',
+                      self.cluster.node, ', '.join(view.nodes), len(view.owned), len(self.cams))
+        self.cluster_timer = self.loop.call_later(self.cfg['cluster_heartbeat_seconds'], self.cluster_tick)
 
-            self.log.debug('Sorted files list (with last modification date): %s' % store_file_list_sorted)
-            self.log.debug('Sorted files list (by last modification date): %s' % store_file_list_sorted.values())
+    def cluster_stopped(self, name):
+        """True, when the processes of a cam stopped for a handover have exited."""
+        kills = self.cluster_stopping.get(name, {})
+
+        for pid, (proc, group_flag) in list(kills.items()):
+            if not self.process_alive(proc) and not (group_flag and self.group_alive(pid)):
+                del kills[pid]
+
+        if kills:
+            return False
+
+        self.cluster_stopping.pop(name, None)
+        return True
+
+    def cluster_tick(self):
+        self.cluster_timer = self.loop.call_later(self.cfg['cluster_heartbeat_seconds'], self.cluster_tick)
+
+        # A blocked store delays the heartbeats, they are not queued
+        if self.cluster_tick_flag:
+            return
+
+        running = [cam.name for cam in self.cams if cam.state != CamRunner.STATE_STOPPED]
+        running.extend(name for name in list(self.cluster_stopping) if not self.cluster_stopped(name))
+
+        self.cluster_tick_flag = True
+        renew_time = time.time()
+        future = self.cluster.tick([cam.name for cam in self.cams], running)
+        future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.on_cluster_tick, f, renew_time))
+
+    def on_cluster_tick(self, future, renew_time):
+        self.cluster_tick_flag = False
+
+        if not self.main_loop_active_flag:
+            return
+
+        try:
+            view = future.result()
+        except Exception as e:
+            self.log.error('Cluster heartbeat failed: %s', e)
+
+            # The leases are about to expire, other nodes could take the cams over
+            if time.time() - self.cluster_renew_time >= \
+                    self.cfg['cluster_lease_seconds'] - self.cfg['cluster_heartbeat_seconds'] and self.cluster_owned:
+                self.log.error('Cluster: leases are not renewed for %.1f seconds, stop cams: %i',
+                               time.time() - self.cluster_renew_time, len(self.cluster_owned))
+                self.cluster_owned = set()
+                self.release_cams()
+            return
+
+        self.cluster_renew_time = renew_time
+
+        if view.nodes != self.cluster_nodes:
+            self.log.info('Cluster nodes: %s', ', '.join(view.nodes))
+            self.cluster_nodes = view.nodes
+
+        acquired = view.owned - self.cluster_owned
+        self.cluster_owned = view.owned
+        self.release_cams()
+
+        start_cams = [cam for cam in self.cams if cam.name in acquired and cam.state == CamRunner.STATE_STOPPED and
+                      cam not in self.startup_queue]
+        if start_cams:
+            self.log.info('Cluster: acquired cams: %s', ', '.join(cam.name for cam in start_cams))
+            self.queue_startup(start_cams)
+
+    def release_cams(self):
+        """Stops the cams, which leases are not held anymore. A lease is released, once the processes have exited."""
+        self.startup_queue = [cam for cam in self.startup_queue if self.cam_owned(cam)]
+
+        for cam in self.cams:
+            if self.cam_owned(cam) or cam.state == CamRunner.STATE_STOPPED:
+                continue
+
+            self.log.info('Cluster: hand cam "%s" over', cam.name)
+            self.startup_wave.discard(cam)
+            pids = self.kill_cam_processes(cam.index)
+            cam.state = CamRunner.STATE_STOPPED
+            self.cluster_stopping[cam.name] = dict((pid, self.kills[pid]) for pid in pids if pid in self.kills)
+
+        self.write_state()
+
+        if not self.startup_wave and self.startup_queue and self.startup_timer is None:
+            self.admit_startup_wave()
+
+    def queue_startup(self, cams):
+        """Cams are started in waves as on a cold start."""
+        self.startup_queue.extend(sorted(cams, key=lambda c: (c.cfg['startup_priority'], c.index)))
+
+        if self.startup_cpu_timer is None:
+            psutil.cpu_percent()
+            self.startup_cpu_timer = self.loop.call_later(self.cfg['startup_check_seconds'], self.sample_startup_cpu)
+
+        if not self.startup_wave and self.startup_timer is None:
+            self.admit_startup_wave()
+
+    def start_control(self):
+        self.control_model = cam_control.ControlModel()
+
+        if self.cleaner is not None:
+            self.control_model.sections['cleaner'] = lambda: {
+                'store_files': len(self.store_index),
+                'runs': self.cleaner.runs_total,
+                'last_run_seconds': self.cleaner.last_run_seconds,
+                'removed_files': self.cleaner.removes_total,
+                'removed_bytes': self.cleaner.removed_bytes_total
+            }
+
+        if self.log_writer is not None:
+            self.control_model.sections['log'] = lambda: {
+                'dropped': self.log_writer.handler.dropped if self.log_writer else 0,
+                'suppressed': self.log_writer.suppressed if self.log_writer else 0
+            }
+
+        self.publish_state()
+        self.control_server = cam_control.ControlServer(self.cfg['control_listen'], self.loop, self.control_model,
+                                                        self.control_cam, self.control_cleaner)
+
+        try:
+            self.control_server.start()
+        except OSError as e:
+            self.log.error('Control API is turned off, failed to listen on "%s": %s', self.cfg['control_listen'], e)
+            self.control_server = None
+
+    def publish_state(self, cam=None):
+        """Updates the control model: a cam or, if cam is None, the daemon and all cams."""
+        if self.control_model is None:
+            return
+
+        if cam is not None:
+            status = cam.status()
+            if self.cluster is not None:
+                status['owned'] = self.cam_owned(cam)
+            self.control_model.set_cam(cam.name, status)
+            return
+
+        daemon_state = {
+            'pid': os.getpid(),
+            'startup_time': self.startup_time,
+            'cams': len(self.cams),
+            'startup_queue': [cam.name for cam in self.startup_queue],
+            'shutdown': not self.main_loop_active_flag
+        }
 
-            removes = 0
-            for file_name in store_file_list_sorted.values():
-                if os.path.isfile(file_name):
-                    file_size = os.path.getsize(file_name)
-                    self.log.info('Remove file: %s' % file_name)
-                    os.remove(file_name)
+        if self.cluster is not None:
+            daemon_state['cluster'] = {'node': self.cluster.node, 'nodes': self.cluster_nodes,
+                                       'owned_cams': len(self.cluster_owned)}
 
-                    if file_size > int(self.cfg['cleaner_force_remove_file_less_bytes']):
-                        removes += 1
-                    else:
-                        self.log.warning('Removed "%s" file with the "%s" bytes size' % (file_name, file_size))
+        self.control_model.set_daemon(daemon_state)
+        cams = {}
 
-                    if removes == int(self.cfg['cleaner_max_removes_per_run']):
-                        self.log.debug('Max removes reached: %s' % self.cfg['cleaner_max_removes_per_run'])
-                        break
+        for cam in self.cams:
+            cams[cam.name] = cam.status()
+            if self.cluster is not None:
+                cams[cam.name]['owned'] = self.cam_owned(cam)
 
-        self.log.debug('Cleaner finished')
+        self.control_model.set_cams(cams)
 
-    def configs_resolver(self, map1, map2, key):
-        self.cam_cfg_resolver_dict[key] = map1[key]
-        return "overwrite"
+    def control_cam(self, name, action):
+        """Control API action of a cam, runs in the loop. Returns the new cam state."""
+        cam = next((cam for cam in self.cams if cam.name == name), None)
 
-    def main(self):
-        self.log.info('Start')
-        self.log.debug('Started: %s' % os.path.abspath(__file__))
-        self.log.debug('Setting SIGTERM, SIGINT, SIGCHLD handlers')
-        signal.signal(signal.SIGTERM, self.exit_handler)
-        signal.signal(signal.SIGINT, self.exit_handler)
-        signal.signal(signal.SIGCHLD, self.exit_child)
+        if cam is None:
+            raise cam_control.ControlError('Cam not found: %s' % name, 404)
+        if not self.main_loop_active_flag:
+            raise cam_control.ControlError('Shutdown is in progress')
+        if action != 'stop' and not self.cam_owned(cam):
+            raise cam_control.ControlError('Cam "%s" is run by another cluster node' % name)
+        if action == 'start' and cam.state in (CamRunner.STATE_STARTING, CamRunner.STATE_RUNNING):
+            raise cam_control.ControlError('Cam "%s" is already %s' % (name, cam.state))
+        if action == 'reset' and cam.cfg.get('reset_cmd', None) is None:
+            raise cam_control.ControlError('Cam "%s" has no reset_cmd' % name)
+
+        self.log.info('Control: %s cam "%s"', action, name)
 
-        # Read cam configs
-        cam_cfg_dir = os.path.join(self.cfg_dir, self.cfg['cam_cfg_mask'])
-        self.log.debug('Configs search path: %s' % cam_cfg_dir)
+        if cam in self.startup_queue:
+            self.startup_queue.remove(cam)
 
-        cam_cfg_list = glob2.glob(os.path.join(self.cfg_dir, self.cfg['cam_cfg_mask']))
+        if action == 'stop':
+            self.kill_cam_processes(cam.index)
+            self.set_state(cam, CamRunner.STATE_STOPPED)
+        else:
+            if action != 'start':
+                cam.restarts += 1
+                cam.last_reason = 'control %s' % action
+                self.metrics.restarts.inc(cam=cam.name, reason='control_%s' % action)
+                self.kill_cam_processes(cam.index, cam_reset_flag=action == 'reset')
+
+            # A cam in backoff or parked is started at once
+            cam.cancel_timers()
+            cam.half_open_flag = False
+            self.start_streamer(cam)
+
+        self.publish_state()
+        return dict(cam.status(), name=name)
+
+    def control_cleaner(self):
+        if self.cleaner is None:
+            raise cam_control.ControlError('Cleaner is turned off')
+
+        self.log.info('Control: run cleaner')
+        self.cleaner.trigger()
+        return {'cleaner': 'triggered'}
+
+    def read_cam_configs(self, cfg):
+        """Returns active cam configs merged with the main config."""
+        cam_cfg = []
+        cam_cfg_dir = os.path.join(self.cfg_dir, cfg['cam_cfg_mask'])
+        self.log.debug('Configs search path: %s', cam_cfg_dir)
+
+        cam_cfg_list = glob2.glob(os.path.join(self.cfg_dir, cfg['cam_cfg_mask']))
         cam_cfg_list.remove(self.cfg_file)
-        self.log.debug('Found configs: %s' % cam_cfg_list)
+        self.log.debug('Found configs: %s', cam_cfg_list)
 
         if len(cam_cfg_list) == 0:
-            self.log.critical('No cam config found. Exit')
-            sys.exit(0)
+            raise ConfigError('No cam config found')
 
         for cur_cam_cfg in cam_cfg_list:
-            self.log.debug('Read cam config: %s' % cur_cam_cfg)
-            tmp_cfg = Config(open(cur_cam_cfg))
+            self.log.debug('Read cam config: %s', cur_cam_cfg)
+
+            try:
+                tmp_cfg = config.Config(open(cur_cam_cfg))
+            except Exception as e:
+                raise ConfigError('Failed to read cam config "%s": %s' % (cur_cam_cfg, e))
+
             cur_cam_cfg_active_flag = True
 
             try:
@@ -351,169 +2055,354 @@ class Cam:
                 cur_cam_cfg_active_flag = tmp_cfg['active']
 
             if cur_cam_cfg_active_flag:
-                self.cam_cfg.append(tmp_cfg)
+                cam_cfg.append(tmp_cfg)
                 self.cam_cfg_resolver_dict.clear()
-                merger = ConfigMerger(resolver=self.configs_resolver)
-                merger.merge(self.cam_cfg[-1], self.cfg)
+                merger = config.ConfigMerger(resolver=self.configs_resolver)
+                merger.merge(cam_cfg[-1], cfg)
 
                 for key in self.cam_cfg_resolver_dict:
-                    self.cam_cfg[-1][key] = self.cam_cfg_resolver_dict[key]
+                    cam_cfg[-1][key] = self.cam_cfg_resolver_dict[key]
 
-                self.log.debug('Loaded settings for: %s' % self.cam_cfg[-1]['name'])
+                self.log.debug('Loaded settings for: %s', cam_cfg[-1]['name'])
             else:
-                self.log.debug('Cam config is skipped due active flag: %s' % cur_cam_cfg)
-        # End Read cam configs
+                self.log.debug('Cam config is skipped due active flag: %s', cur_cam_cfg)
 
-        # Cleaner
-        self.cfg['cleaner_max_removes_per_run'] = self.replacer(str(self.cfg['cleaner_max_removes_per_run']), 0)
-        schedule.every(self.cfg['cleaner_run_every_minutes']).minutes.do(self.cleaner)
-        # End Cleaner
+        return cam_cfg
 
-        # PIDs full path
-        for iterator, cam in enumerate(self.cam_cfg):
+    def create_cam_runner(self, iterator, cam):
+        try:
+            pid_streamer = cam['pid_streamer']
+        except AttributeError:
+            self.log.debug('pid_streamer not found for cam: %s', cam['name'])
             try:
-                pid_streamer = cam['pid_streamer']
+                pid_streamer = self.cfg['pid_streamer']
             except AttributeError:
-                self.log.debug('pid_streamer not found for cam: %s' % cam['name'])
+                raise ConfigError("Can't find pid_streamer in config")
+
+        try:
+            pid_capturer = cam['pid_capturer']
+        except AttributeError:
+            self.log.debug('pid_capturer not found for cam: %s', cam['name'])
+            try:
+                pid_capturer = self.cfg['pid_capturer']
+            except AttributeError:
+                raise ConfigError("Can't find pid_capturer in config")
+
+        try:
+            cap_cmd = cam['cap_cmd']
+        except AttributeError:
+            self.log.debug('Capture command not found in cam config. Using global')
+            try:
+                cap_cmd = self.cfg['cap_cmd']
+            except AttributeError:
+                raise ConfigError('Capture command not found')
+
+        cap_dir_cam = None
+
+        if cap_cmd is not False:
+            try:
+                cap_cmd = cap_cmd + " " + cam['cap_cmd_suffix']
+            except AttributeError:
+                pass
+
+            cap_cmd = self.replacer(cap_cmd, iterator)
+
+            # Create cam cap dir only if cap_cmd is not False
+            cap_dir_cam = self.replacer(self.cfg['cap_dir_cam'], iterator)
+            if not os.path.exists(cap_dir_cam):
                 try:
-                    pid_streamer = self.cfg['pid_streamer']
-                except AttributeError:
-                    self.log.critical("Can't find pid_streamer in config")
-                    sys.exit(1)
+                    os.makedirs(cap_dir_cam)
+                except OSError:
+                    raise ConfigError('Failed to create directory: %s' % cap_dir_cam)
+            # End Create cam cap dir
+
+        description = None
+        segment_location = None
+
+        if cam['engine'] == 'gst':
+            if not cam_gst.gst_available():
+                raise ConfigError('Cam "%s": engine "gst" requires PyGObject with GStreamer 1.0' % cam['name'])
 
             try:
-                pid_capturer = cam['pid_capturer']
+                video = cam['gst_video']
             except AttributeError:
-                self.log.debug('pid_capturer not found for cam: %s' % cam['name'])
+                raise ConfigError('Cam "%s": gst_video not found' % cam['name'])
+
+            if cap_dir_cam is not None:
+                segment_location = self.replacer(cam['gst_segment_location'], iterator)
+
+            description = self.replacer(cam_gst.pipeline_description(video, cam.get('gst_audio', None),
+                                                                     cam['gst_stream_sink'],
+                                                                     segment_location is not None),
+                                        iterator)
+        elif cam['engine'] != 'process':
+            raise ConfigError('Cam "%s": unknown engine "%s"' % (cam['name'], cam['engine']))
+
+        motion_cmd = None
+        motion_pid_file = None
+        detector = None
+        idle_cap_cmd = None
+        spool_dir = None
+
+        if cam['motion_detect']:
+            if cam['engine'] != 'process' or cap_cmd is False:
+                raise ConfigError('Cam "%s": motion_detect needs engine "process" and cap_cmd' % cam['name'])
+            if not cam_motion.numpy_available():
+                raise ConfigError('Cam "%s": motion_detect requires NumPy' % cam['name'])
+
+            try:
+                detector = cam_motion.MotionDetector(int(cam['motion_width']), int(cam['motion_height']),
+                                                     float(cam['motion_threshold']),
+                                                     float(cam['motion_min_area_percent']), list(cam['motion_mask']))
+            except cam_motion.MotionError as e:
+                raise ConfigError('Cam "%s": %s' % (cam['name'], e))
+
+            motion_cmd = self.replacer(cam['motion_cmd'], iterator)
+            motion_pid_file = self.replacer(os.path.join(self.cfg['pid_dir'], cam['pid_motion']), iterator)
+            idle_cap_cmd = cam['motion_idle_cap_cmd']
+            if idle_cap_cmd is not False:
+                idle_cap_cmd = self.replacer(idle_cap_cmd, iterator)
+
+            if cam['motion_spool_dir_cam']:
+                spool_dir = self.replacer(cam['motion_spool_dir_cam'], iterator)
                 try:
-                    pid_capturer = self.cfg['pid_capturer']
-                except AttributeError:
-                    self.log.critical("Can't find pid_capturer in config")
-                    sys.exit(1)
+                    os.makedirs(spool_dir, exist_ok=True)
+                except OSError:
+                    raise ConfigError('Failed to create directory: %s' % spool_dir)
+
+        return CamRunner(iterator, cam,
+                         self.replacer(os.path.join(self.cfg['pid_dir'], pid_streamer), iterator),
+                         self.replacer(os.path.join(self.cfg['pid_dir'], pid_capturer), iterator),
+                         cap_cmd, cap_dir_cam, description, segment_location,
+                         motion_cmd, motion_pid_file, detector, idle_cap_cmd, spool_dir)
+
+    def cam_policies(self):
+        cam_policies = {}
+
+        for iterator, cam in enumerate(self.cam_cfg):
+            cap_dir_cam = self.replacer(self.cfg['cap_dir_cam'], iterator)
+            store_dir = os.path.relpath(cap_dir_cam, self.cfg['cap_dir']).split(os.sep)[0]
+
+            cam_policies[store_dir] = cam_store.CamPolicy(
+                max_bytes=int(float(cam.get('store_max_gb', 0)) * 1024 ** 3),
+                max_age_seconds=float(cam.get('store_max_days', 0)) * 86400,
+                min_keep_seconds=float(cam.get('min_keep_hours', 0)) * 3600)
+
+        return cam_policies
+
+    def reload(self):
+        """Re-reads the configs and starts, stops or restarts only the cams, which effective commands changed."""
+        if not self.main_loop_active_flag or self.shutdown_pending:
+            self.log.info('Shutdown is in progress, skip reload')
+            return
+
+        self.log.info('Reload configs')
+        old_cfg = self.cfg
+        old_cam_cfg = self.cam_cfg
+
+        try:
+            self.cfg, self.cam_cfg = self.load_configs()
+            runners = [self.create_cam_runner(iterator, cam) for iterator, cam in enumerate(self.cam_cfg)]
+        except Exception as e:
+            self.log.error('Reload failed, keep the current configs: %s', e)
+            self.cfg = old_cfg
+            self.cam_cfg = old_cam_cfg
+            return
+
+        old_cams = dict((cam.name, cam) for cam in self.cams)
+        new_names = set(runner.name for runner in runners)
+
+        for cam in self.cams:
+            if cam.name not in new_names:
+                self.log.info('Reload: cam "%s" is removed', cam.name)
+                self.kill_cam_processes(cam.index)
+                cam.state = CamRunner.STATE_STOPPED
+                self.metrics.streamer_up.remove(cam=cam.name)
+                self.metrics.capturer_up.remove(cam=cam.name)
+
+        cams = []
+        start_cams = []
+
+        for runner in runners:
+            cam = old_cams.get(runner.name)
+
+            if cam is None:
+                self.log.info('Reload: cam "%s" is added', runner.name)
+                cam = runner
+                start_cams.append(cam)
+            elif cam.effective() != runner.effective():
+                self.log.info('Reload: cam "%s" is changed', runner.name)
+                self.kill_cam_processes(cam.index)
+                cam.state = CamRunner.STATE_STOPPED
+                cam.update(runner)
+                start_cams.append(cam)
+            else:
+                self.log.debug('Reload: cam "%s" is not changed', runner.name)
+                cam.update(runner)
+
+            cams.append(cam)
+
+        self.cams = cams
+        self.startup_queue = [cam for cam in self.startup_queue if cam in cams and cam not in start_cams]
+        self.startup_wave.intersection_update(cams)
+
+        if self.cleaner is not None:
+            self.cleaner.store_max_bytes = int(float(self.cfg['cleaner_store_max_gb']) * 1024 ** 3)
+            self.cleaner.keep_free_bytes = int(float(self.cfg['cleaner_store_keep_free_gb']) * 1024 ** 3)
+            self.cleaner.cam_policies = self.cam_policies()
+
+        for cam in start_cams:
+            if self.cam_owned(cam):
+                self.start_streamer(cam)
+
+        self.write_state()
+        self.log.info('Reload finished, cams started/restarted: %i, removed: %i, total: %i',
+                      len(start_cams), len(old_cams) - len(new_names & set(old_cams)), len(cams))
+
+    def on_config_event(self):
+        for mask, path in self.config_watch.read_events():
+            if path is not None and path.endswith('.cfg') and self.reload_timer is None:
+                # Editors write a file in a few steps, reload once it is settled
+                self.reload_timer = self.loop.call_later(self.cfg['config_watch_delay_seconds'],
+                                                         self.on_config_changed)
+
+    def on_config_changed(self):
+        self.reload_timer = None
+        self.reload()
 
-            self.cam_streamer_pid.append(self.replacer(os.path.join(self.cfg['pid_dir'], pid_streamer), iterator))
-            self.cam_capturer_pid.append(self.replacer(os.path.join(self.cfg['pid_dir'], pid_capturer), iterator))
-        # End PIDs full path
+    def configs_resolver(self, map1, map2, key):
+        self.cam_cfg_resolver_dict[key] = map1[key]
+        return "overwrite"
 
-        self.kill_cams_process()
+    def main(self):
+        # First of all: the processes of a running daemon are neither adopted nor killed
         self.write_main_pid()
+        self.start_log_writer()
+        self.log.info('Start')
+        self.log.debug('Started: %s', os.path.abspath(__file__))
+        self.loop = cam_loop.EventLoop()
+        self.log.debug('Setting SIGTERM, SIGINT handlers')
+        self.loop.add_signal_handler(signal.SIGTERM, functools.partial(self.exit_handler, signal.SIGTERM, None))
+        self.loop.add_signal_handler(signal.SIGINT, functools.partial(self.exit_handler, signal.SIGINT, None))
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+        self.loop.add_signal_handler(signal.SIGUSR2, functools.partial(self.exit_handler, signal.SIGUSR2, None,
+                                                                       kill_cams_flag=False))
+
+        try:
+            self.cfg, self.cam_cfg = self.load_configs()
+        except ConfigError as e:
+            self.log.critical('%s. Exit', e)
+            self.remove_main_pid()
+            sys.exit(0)
+
+        if self.cfg['catalog_file']:
+            try:
+                self.catalog = cam_catalog.Catalog(self.cfg['catalog_file'], self.cfg['catalog_keyframe_seconds'])
+            except Exception as e:
+                self.log.error('Segment catalog is turned off, failed to open "%s": %s', self.cfg['catalog_file'], e)
 
-        while self.main_loop_active_flag:
+        # Cleaner
+        if self.cfg['cleaner_active']:
+            self.store_index = cam_store.StoreIndex(self.cfg['cap_dir'],
+                                                    self.cfg.get('cleaner_index_mode', cam_store.StoreIndex.MODE_AUTO))
+            self.store_index.start()
+
+            if self.catalog is not None:
+                self.store_index.closed = []
+
+            self.cleaner = cam_store.Cleaner(
+                self.store_index,
+                store_max_bytes=int(float(self.cfg['cleaner_store_max_gb']) * 1024 ** 3),
+                keep_free_bytes=int(float(self.cfg['cleaner_store_keep_free_gb']) * 1024 ** 3),
+                force_remove_file_less_bytes=int(self.cfg['cleaner_force_remove_file_less_bytes']),
+                io_max_bytes_per_second=int(self.cfg['cleaner_io_max_bytes_per_second']),
+                io_max_removes_per_second=float(self.cfg['cleaner_io_max_removes_per_second']),
+                cam_policies=self.cam_policies(),
+                catalog=self.catalog,
+                on_index_ready=lambda: self.loop.call_soon_threadsafe(self.on_store_index_ready))
+            self.cleaner.start()
+            self.cleaner_timer = self.loop.call_later(self.cfg['cleaner_run_every_minutes'] * 60, self.run_cleaner)
+        else:
+            self.log.info('Cleaner is turned off')
+        # End Cleaner
+
+        try:
             for iterator, cam in enumerate(self.cam_cfg):
-                if len(self.cam_streamer) == iterator:
-                    # Create cam cap dir only if cap_cmd is not False
-                    try:
-                        cap_cmd = self.cam_cfg[iterator]['cap_cmd']
-                    except AttributeError:
-                        cap_cmd = None
-                        self.log.debug('Capture command not found')
-
-                    if cap_cmd is not False:
-                        cap_dir_cam = self.replacer(self.cfg['cap_dir_cam'], iterator)
-                        if not os.path.exists(cap_dir_cam):
-                            try:
-                                os.makedirs(cap_dir_cam)
-                            except OSError:
-                                self.log.critical('Failed to create directory: %s' % cap_dir_cam)
-                                sys.exit(1)
-                    # End Create cam cap dir
-
-                    self.cam_streamer_start_flag.append(True)
-
-                    self.cam_streamer.append(None)
-                    self.cam_streamer_start_time.append(0)
-                    self.cam_streamer_poll_flag.append(False)
-
-                    self.cam_capturer.append(None)
-                    self.cam_capturer_start_flag.append(False)
-                    self.cam_capturer_check_flag.append(False)
-
-                # Run streamer
-                if self.cam_streamer_start_flag[iterator]:
-                    self.log.info('Run "%s" streamer in background' % cam['name'])
-                    self.cam_streamer[iterator] = self.bg_run(cam['cmd'].strip(), self.cam_streamer_pid[iterator])
-                    self.cam_streamer_start_time[iterator] = time.time()
-                    self.cam_streamer_poll_flag[iterator] = True
-                    self.cam_streamer_start_flag[iterator] = False
-                # End Run streamer
-
-                # Poll streamer
-                if self.cam_streamer_poll_flag[iterator]:
-                    cap_url = self.cfg['cap_url']
-                    cap_url = self.replacer(cap_url, iterator)
-
-                    self.log.debug('Getting HTTP status: %s' % cap_url)
-                    http_code = 0
-
-                    try:
-                        http_code = requests.head(cap_url, timeout=1).status_code
-                    except requests.exceptions.RequestException:
-                        self.log.warning('Failed to connect: %s' % cap_url)
-
-                    if http_code != 0:
-                        self.log.info('Checked "%s", status: %s' % (cam['name'], http_code))
-
-                        if http_code == 200:
-                            self.cam_capturer_start_flag[iterator] = True
-                            self.cam_streamer_poll_flag[iterator] = False
-
-                    start_time_delta = time.time() - self.cam_streamer_start_time[iterator]
-                    if self.cam_streamer_poll_flag[iterator]:
-                        if start_time_delta > cam['max_start_seconds']:
-                            self.log.warning('Time outed waiting data from: %s' % cam['name'])
-                            self.log.info('Kill: %s' % cam['name'])
-                            self.kill_cam_processes(iterator, cam_reset_flag=True)
-                            self.cam_streamer_start_flag[iterator] = True
-                        else:
-                            self.log.info('Attempt "%s": [%i/%i]' %
-                                          (cam['name'], start_time_delta, cam['max_start_seconds']))
-                # End Poll streamer
-
-                # Run capturer
-                if self.cam_capturer_start_flag[iterator]:
-                    if self.cam_capturer[iterator] is not None and self.cam_capturer[iterator].poll() is None:
-                        self.log.warning('Capturer "%s" is STILL alive' % cam['name'])
-                    else:
-                        cap_cmd = None
-                        try:
-                            cap_cmd = self.cam_cfg[iterator]['cap_cmd']
-                        except AttributeError:
-                            self.log.debug('Capture command not found in cam config. Using global')
-                            try:
-                                cap_cmd = self.cfg['cap_cmd']
-                            except AttributeError:
-                                self.log.critical('Capture command not found. Exit')
-                                self.exit_handler(None, None, log_signal=False, exit_code=1)
-
-                        if cap_cmd is not False:
-                            try:
-                                cap_cmd = cap_cmd + " " + self.cam_cfg[iterator]['cap_cmd_suffix']
-                            except AttributeError:
-                                pass
-
-                            cap_cmd = self.replacer(cap_cmd, iterator)
-
-                            self.log.info('Run "%s" capturer in background' % cam['name'])
-                            self.cam_capturer[iterator] = self.bg_run(cap_cmd, self.cam_capturer_pid[iterator])
-                            self.cam_capturer_check_flag[iterator] = True
-                        else:
-                            self.log.info('Capturer "%s" is turned off' % cam['name'])
-
-                    self.cam_capturer_start_flag[iterator] = False
-                # End Run capturer
-
-            schedule.run_pending()
-            time.sleep(1)
+                self.cams.append(self.create_cam_runner(iterator, cam))
+        except ConfigError as e:
+            self.log.critical('%s. Exit', e)
+            self.remove_main_pid()
+            sys.exit(1)
+
+        self.prober = cam_probe.Prober(int(self.cfg.get('probe_workers', 8)))
+        self.setup_metrics()
+
+        saved_cams = self.read_state()
+        for cam in self.cams:
+            if cam.name in saved_cams:
+                cam.restore(saved_cams[cam.name])
+
+        if self.cfg['cluster_store']:
+            self.start_cluster()
+
+        if self.cfg['adopt_processes']:
+            adopted_cams = self.adopt_cams(dict((name, saved) for name, saved in saved_cams.items()
+                                                if self.cluster is None or name in self.cluster_owned))
+            self.log.info('Adopted cams: %i of %i', len(adopted_cams), len(self.cams))
+        else:
+            adopted_cams = set()
+
+        self.kill_cams_process(keep_cams=adopted_cams)
+
+        if self.cfg['control_listen']:
+            self.start_control()
+
+        # Cold start in waves: cams are admitted by startup_priority, startup_wave_size at once, the next wave starts
+        # when every cam of the previous one has left the starting state and the CPU usage is low enough
+        self.startup_time = time.time()
+        self.startup_queue = sorted([cam for cam in self.cams if cam not in adopted_cams and self.cam_owned(cam)],
+                                    key=lambda c: (c.cfg['startup_priority'], c.index))
+        psutil.cpu_percent()
+        self.startup_cpu_timer = self.loop.call_later(self.cfg['startup_check_seconds'], self.sample_startup_cpu)
+        self.admit_startup_wave()
+
+        if self.cfg['config_watch']:
+            try:
+                self.config_watch = cam_store.Inotify()
+                self.config_watch.add_watch(self.cfg_dir)
+            except OSError as e:
+                self.log.warning('Config watch is unavailable, use SIGHUP to reload: %s', e)
+                self.config_watch = None
+            else:
+                self.loop.add_reader(self.config_watch.fileno(), self.on_config_event)
+
+        if self.cfg['resources_sample_seconds']:
+            self.resource_sampler = cam_resources.ResourceSampler(self.cfg['resources_window_minutes'] * 60)
+            self.resources_timer = self.loop.call_later(self.cfg['resources_sample_seconds'], self.sample_resources)
+
+        while self.main_loop_active_flag or self.shutdown_pending:
+            self.loop.run_once()
+            self.metrics.loop_seconds.observe(self.loop.busy_seconds)
+            if self.loop.lag_seconds is not None:
+                self.metrics.loop_lag_seconds.observe(self.loop.lag_seconds)
 
         self.log.info('Finish')
+        self.stop_log_writer()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-daemon', choices=['start', 'stop', 'restart'],
-                        help='Daemon mode startup options')
+    parser.add_argument('-daemon', choices=['start', 'stop', 'restart', 'status'],
+                        help='Daemon mode startup options. status exits with 3, if the daemon is not running')
     parser.add_argument('-log_level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help='Override config log_level')
+    parser.add_argument('-export', nargs=4, metavar=('CAM', 'START', 'END', 'OUTPUT'),
+                        help='Export recordings of a cam from the segment catalog without re-encoding. '
+                             'START, END: "YYYY-mm-dd HH:MM:SS". OUTPUT: .ts or any ffmpeg format')
+    parser.add_argument('-cluster_status', action='store_true', help='Show the cluster nodes and their cams')
+    parser.add_argument('-control', nargs='+', metavar=('COMMAND', 'CAM'),
+                        help='Control the running daemon: cams (list), state (JSON snapshot), clean (run cleaner), '
+                             'start|stop|restart|reset CAM...')
     args = parser.parse_args()
 
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -524,28 +2413,126 @@ if __name__ == '__main__':
     else:
         c = Cam(CFG_DIR, CFG_FILENAME)
 
+    if args.export:
+        export_cam, export_start, export_end, export_output = args.export
+
+        if not c.cfg['catalog_file'] or not os.path.isfile(c.cfg['catalog_file']):
+            c.log.error('Segment catalog not found: %s', c.cfg['catalog_file'])
+            sys.exit(1)
+
+        try:
+            export_start_time = cam_catalog.parse_time(export_start)
+            export_end_time = cam_catalog.parse_time(export_end)
+            export_time = time.time()
+            export_bytes = cam_catalog.Catalog(c.cfg['catalog_file']).export(export_cam, export_start_time,
+                                                                             export_end_time, export_output)
+        except cam_catalog.CatalogError as e:
+            c.log.error('Export failed: %s', e)
+            sys.exit(1)
+
+        c.log.info('Exported "%s" to %s: %.1f Mb in %.3f seconds',
+                   export_cam, export_output, export_bytes / 1024.0 / 1024.0, time.time() - export_time)
+        sys.exit(0)
+
+    if args.cluster_status:
+        if not c.cfg['cluster_store']:
+            c.log.error('Cluster mode is turned off (cluster_store is empty)')
+            sys.exit(1)
+
+        for node, expires, node_cams in cam_cluster.Cluster(c.cfg['cluster_store'],
+                                                            lease_seconds=c.cfg['cluster_lease_seconds']).status():
+            print('%s (%s): %s' % (node, 'alive' if expires > time.time() else 'dead', ', '.join(node_cams) or '-'))
+        sys.exit(0)
+
+    if args.control:
+        control_command, control_cams = args.control[0], args.control[1:]
+
+        if not c.cfg['control_listen']:
+            c.log.error('Control API is turned off (control_listen is empty)')
+            sys.exit(1)
+
+        if control_command in ('cams', 'state') and not control_cams:
+            control_requests = [('GET', '/' + control_command)]
+        elif control_command == 'clean' and not control_cams:
+            control_requests = [('POST', '/cleaner/run')]
+        elif control_command in cam_control.CAM_ACTIONS and control_cams:
+            control_requests = [('POST', '/cams/%s/%s' % (cam, control_command)) for cam in control_cams]
+        else:
+            parser.error('-control: unknown command or wrong cams: %s' % ' '.join(args.control))
+
+        control_exit_code = 0
+
+        for control_method, control_path in control_requests:
+            try:
+                control_status, control_data = cam_control.request(c.cfg['control_listen'], control_method,
+                                                                   control_path)
+            except (OSError, ValueError) as e:
+                c.log.error('Control API is not available on "%s": %s', c.cfg['control_listen'], e)
+                sys.exit(1)
+
+            if control_status != 200:
+                c.log.error('%s: %s', control_path, control_data.get('error'))
+                control_exit_code = 1
+            elif control_command == 'cams':
+                for cam_status in control_data['cams']:
+                    print('%s: %s (restarts: %i, last reason: %s)' % (cam_status['name'], cam_status['state'],
+                                                                      cam_status['restarts'],
+                                                                      cam_status['last_reason'] or '-'))
+            else:
+                print(json.dumps(control_data, indent=2, sort_keys=True))
+
+        sys.exit(control_exit_code)
+
+    if args.daemon == 'status':
+        main_pid = c.running_pid()
+
+        if main_pid is None:
+            print('Not running')
+            sys.exit(3)
+
+        print('Running, PID: %i' % main_pid)
+
+        try:
+            with open(c.state_file) as f:
+                daemon_state = json.load(f)
+        except (OSError, ValueError) as e:
+            daemon_state = {}
+            c.log.debug('Failed to read state file "%s": %s', c.state_file, e)
+
+        # The state file of a previous run is not shown
+        if daemon_state.get('pid') == main_pid:
+            for cam_name, cam_state in sorted(daemon_state.get('cams', {}).items()):
+                print('%s: %s (restarts: %i, last reason: %s)' % (cam_name, cam_state['state'], cam_state['restarts'],
+                                                                  cam_state['last_reason'] or '-'))
+        sys.exit(0)
+
     if args.daemon:
         if args.daemon == 'stop' or args.daemon == 'restart':
             c.log.debug('[Daemon] Stopping')
-            main_pid = c.kill_process(c.pid_file, False)
-
-            if main_pid:
-                kill_time = time.time()
-                killed_flag = False
 
-                timeout = 20
+            if args.daemon == 'restart' and c.cfg['adopt_processes']:
+                # The running daemon exits leaving the cam processes running, the new one adopts them
+                main_pid = c.kill_process(c.pid_file, False, signal.SIGUSR2, group_flag=False)
+            else:
+                main_pid = c.kill_process(c.pid_file, False, group_flag=False)
 
-                while time.time() - kill_time < timeout:
-                    if not psutil.pid_exists(main_pid):
-                        killed_flag = True
-                        break
+            if main_pid:
+                timeout = c.cfg['shutdown_timeout_seconds'] + 5
+                stop_time = time.time()
 
-                if not killed_flag:
-                    c.log.warning('[Daemon] Time outed waiting process to exit (timeout: "%i" seconds). PID: "%i"' %
-                                  (timeout, main_pid))
+                if cam_loop.wait_pid(main_pid, timeout):
+                    c.log.debug('[Daemon] Stopped in %.3f seconds', time.time() - stop_time)
+                else:
+                    c.log.warning('[Daemon] Time outed waiting process to exit (timeout: "%i" seconds). PID: "%i"',
+                                  timeout, main_pid)
 
         if args.daemon == 'start' or args.daemon == 'restart':
-            c.log.debug('[Daemon] Starting from working directory: %s' % script_dir)
+            # Checked again by the daemon, this one is seen in the terminal
+            if c.running_pid() is not None:
+                c.log.critical('Already running, PID: %i. Exit', c.running_pid())
+                sys.exit(1)
+
+            c.log.debug('[Daemon] Starting from working directory: %s', script_dir)
             with daemon.DaemonContext(working_directory=script_dir, files_preserve=[c.log_handler_file.stream]):
                 c.main()
     else:
@@ -0,0 +1,49 @@
+from cam_cluster import HashRing
+
+CAMS = ['cam%03i' % i for i in range(1000)]
+
+
+def placement(ring):
+    return dict((cam, ring.owner(cam)) for cam in CAMS)
+
+
+def test_empty_ring():
+    assert HashRing([]).owner('cam1') is None
+
+
+def test_single_node():
+    assert set(placement(HashRing(['node1'])).values()) == {'node1'}
+
+
+def test_placement_is_stable():
+    # Independent of the node order and of the process (no hash randomization)
+    assert placement(HashRing(['node1', 'node2', 'node3'])) == placement(HashRing(['node3', 'node1', 'node2']))
+    assert HashRing(['node1', 'node2', 'node3']).owner('cam000') == \
+        HashRing(['node1', 'node2', 'node3']).owner('cam000')
+
+
+def test_balance():
+    owners = list(placement(HashRing(['node1', 'node2', 'node3'])).values())
+
+    for node in ('node1', 'node2', 'node3'):
+        assert 200 < owners.count(node) < 466
+
+
+def test_join_moves_cams_to_new_node_only():
+    before = placement(HashRing(['node1', 'node2', 'node3']))
+    after = placement(HashRing(['node1', 'node2', 'node3', 'node4']))
+    moved = [cam for cam in CAMS if before[cam] != after[cam]]
+
+    assert all(after[cam] == 'node4' for cam in moved)
+    assert 150 < len(moved) < 350
+
+
+def test_leave_moves_cams_of_node_only():
+    before = placement(HashRing(['node1', 'node2', 'node3']))
+    after = placement(HashRing(['node1', 'node3']))
+
+    for cam in CAMS:
+        if before[cam] != 'node2':
+            assert after[cam] == before[cam]
+        else:
+            assert after[cam] in ('node1', 'node3')
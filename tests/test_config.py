@@ -0,0 +1,112 @@
+import os
+import json
+
+import pytest
+
+import cam_config
+from cam_config import ConfigCache, ConfigDict
+
+MAIN = {'cam_cfg_mask': 'cams/*.cfg', 'log_level': 'INFO'}
+CAMS = [{'name': 'cam1', 'active': True}]
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+@pytest.fixture
+def cfg_dir(tmp_path):
+    os.makedirs(str(tmp_path / 'cams'))
+    write(str(tmp_path / 'main.cfg'), "log_level: 'INFO'\n")
+    write(str(tmp_path / 'cams' / 'cam1.cfg'), "name: 'cam1'\n")
+    return tmp_path
+
+
+@pytest.fixture
+def cache(cfg_dir):
+    cache = ConfigCache(str(cfg_dir), 'main.cfg')
+    cache.save(MAIN, CAMS, cache.files_state(MAIN['cam_cfg_mask']))
+    return cache
+
+
+def test_files_state(cfg_dir):
+    cache = ConfigCache(str(cfg_dir), 'main.cfg')
+
+    assert sorted(cache.files_state(MAIN['cam_cfg_mask'])) == \
+        [str(cfg_dir / 'cams' / 'cam1.cfg'), str(cfg_dir / 'main.cfg')]
+
+
+def test_load(cache):
+    main, cams = cache.load()
+
+    assert main == MAIN
+    assert cams == CAMS
+    assert isinstance(main, ConfigDict)
+    assert all(isinstance(cam, ConfigDict) for cam in cams)
+
+    with pytest.raises(AttributeError):
+        main['missing']
+
+
+def test_missing_cache(cfg_dir):
+    assert ConfigCache(str(cfg_dir), 'main.cfg').load() is None
+
+
+def test_stale_on_size(cache, cfg_dir):
+    path = str(cfg_dir / 'cams' / 'cam1.cfg')
+    stat = os.stat(path)
+    write(path, "name: 'cam11'\n")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert cache.load() is None
+
+
+def test_stale_on_mtime(cache, cfg_dir):
+    path = str(cfg_dir / 'main.cfg')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+    assert cache.load() is None
+
+
+def test_stale_on_new_cam(cache, cfg_dir):
+    write(str(cfg_dir / 'cams' / 'cam2.cfg'), "name: 'cam2'\n")
+
+    assert cache.load() is None
+
+
+def test_stale_on_removed_cam(cache, cfg_dir):
+    os.remove(str(cfg_dir / 'cams' / 'cam1.cfg'))
+
+    assert cache.load() is None
+
+
+def test_stale_on_format(cache, monkeypatch):
+    monkeypatch.setattr(cam_config, 'CACHE_FORMAT', cam_config.CACHE_FORMAT + 1)
+
+    assert cache.load() is None
+
+
+def test_corrupted_cache(cache):
+    write(cache.path, '{"format": ')
+
+    assert cache.load() is None
+
+
+def test_save_skips_changed_configs(cfg_dir):
+    cache = ConfigCache(str(cfg_dir), 'main.cfg')
+    state = cache.files_state(MAIN['cam_cfg_mask'])
+    write(str(cfg_dir / 'cams' / 'cam1.cfg'), "name: 'cam1'\nactive: False\n")
+
+    cache.save(MAIN, CAMS, state)
+
+    assert not os.path.exists(cache.path)
+
+
+def test_save_replaces_cache(cache):
+    cache.save(MAIN, [], cache.files_state(MAIN['cam_cfg_mask']))
+
+    with open(cache.path) as f:
+        assert json.load(f)['cams'] == []
+    assert not os.path.exists(cache.path + '.tmp')
@@ -0,0 +1,100 @@
+import logging
+
+import pytest
+
+import cam_logging
+from cam_logging import LogWriter
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_record(msg, args, extra=None):
+    return logging.getLogger('test').makeRecord('test', logging.INFO, __file__, 1, msg, args, None, extra=extra)
+
+
+@pytest.fixture
+def handler():
+    return ListHandler()
+
+
+@pytest.fixture
+def writer(handler):
+    return LogWriter([handler], repeat_burst=2, repeat_window_seconds=60)
+
+
+def test_admit_burst(writer):
+    assert [writer.admit(make_record('Cam "%s" is down', ('cam1',)), 100) for _ in range(4)] == \
+        [True, True, False, False]
+    assert writer.suppressed == 2
+
+    # Another argument is another message
+    assert writer.admit(make_record('Cam "%s" is down', ('cam2',)), 100)
+
+
+def test_admit_numbers_are_compared(writer):
+    # Exit codes and PIDs are not repeats
+    assert all(writer.admit(make_record('Cam "%s" exit code: %i', ('cam1', code)), 100) for code in range(5))
+
+
+def test_admit_any_numbers(writer):
+    def attempt(cam, number):
+        return make_record('Attempt "%s": [%i/%i]', (cam, number, 10), cam_logging.ANY_NUMBERS)
+
+    assert [writer.admit(attempt('cam1', number), 100) for number in range(4)] == [True, True, False, False]
+    # The text arguments are compared still
+    assert writer.admit(attempt('cam2', 0), 100)
+
+
+def test_admit_new_window(writer):
+    for _ in range(3):
+        writer.admit(make_record('Cam "%s" is down', ('cam1',)), 100)
+
+    assert writer.admit(make_record('Cam "%s" is down', ('cam1',)), 160)
+
+
+def test_summarize(writer, handler):
+    first = make_record('Cam "%s" is down', ('cam1',))
+    for now in (100, 101, 102, 103):
+        writer.admit(make_record('Cam "%s" is down', ('cam1',)), now)
+
+    writer.flush(130)
+    assert handler.records == []
+
+    writer.flush(170.25)
+
+    assert len(handler.records) == 1
+    summary = handler.records[0]
+    assert summary.getMessage() == 'Cam "cam1" is down [repeated 2 more times in 70 seconds]'
+    assert summary.levelno == logging.INFO
+    assert summary.name == 'test'
+    # Stamped at the flush time
+    assert summary.created == 170.25
+    assert summary.msecs == pytest.approx(250)
+    assert summary.relativeCreated - first.relativeCreated == pytest.approx((170.25 - first.created) * 1000, abs=1)
+    assert writer.repeats == {}
+
+
+def test_summarize_on_new_window(writer, handler):
+    for now in (100, 101, 102):
+        writer.admit(make_record('Cam "%s" is down', ('cam1',)), now)
+
+    writer.admit(make_record('Cam "%s" is down', ('cam1',)), 165)
+
+    assert [record.getMessage() for record in handler.records] == \
+        ['Cam "cam1" is down [repeated 1 more times in 65 seconds]']
+    assert handler.records[0].created == 165
+
+
+def test_no_summary_without_suppressed(writer, handler):
+    writer.admit(make_record('Cam "%s" is down', ('cam1',)), 100)
+    writer.flush(None)
+
+    assert handler.records == []
+    assert writer.repeats == {}
@@ -0,0 +1,172 @@
+import os
+import time
+
+import pytest
+
+import cam_store
+from cam_store import StoreIndex, Cleaner, CamPolicy
+
+NOW = time.time()
+HOUR = 3600
+
+
+def make_file(store_dir, cam, name, size, age_seconds):
+    cam_dir = os.path.join(store_dir, cam)
+    if not os.path.isdir(cam_dir):
+        os.makedirs(cam_dir)
+
+    path = os.path.join(cam_dir, name)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    mtime = NOW - age_seconds
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def load_index(store_dir):
+    index = StoreIndex(str(store_dir), StoreIndex.MODE_SCAN)
+    index.start()
+    index.load()
+    return index
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Two cams: cam1 has 4 segments of 100 bytes, cam2 has 2 segments of 100 bytes. The newest one is written."""
+    paths = {
+        'cam1': [make_file(str(tmp_path), 'cam1', 'seg%i.ts' % i, 100, (10 - i) * HOUR) for i in range(4)],
+        'cam2': [make_file(str(tmp_path), 'cam2', 'seg%i.ts' % i, 100, (10 - i) * HOUR) for i in range(2)],
+    }
+    return tmp_path, paths
+
+
+def test_index_is_empty_until_loaded(store):
+    store_dir, _ = store
+    index = StoreIndex(str(store_dir), StoreIndex.MODE_SCAN)
+    index.start()
+    index.closed = []
+
+    assert not index.ready.is_set()
+    assert index.cams() == []
+    assert index.take_closed() == []
+
+    index.load()
+
+    assert index.ready.is_set()
+    assert sorted(index.cams()) == ['cam1', 'cam2']
+    assert len(index) == 6
+    assert index.size_bytes() == 600
+    assert index.size_bytes('cam1') == 400
+
+
+def test_newest_segment_is_hot(store):
+    store_dir, paths = store
+    index = load_index(store_dir)
+
+    assert index.hot == {paths['cam1'][-1], paths['cam2'][-1]}
+    assert index.oldest('cam1') == (os.stat(paths['cam1'][0]).st_mtime, paths['cam1'][0])
+
+
+def test_rescan_follows_removes(store):
+    store_dir, paths = store
+    index = load_index(store_dir)
+
+    os.remove(paths['cam1'][0])
+    # A directory modified within DIR_MTIME_SETTLE_SECONDS is listed on every update
+    index.update()
+
+    assert paths['cam1'][0] not in index.files
+    assert index.size_bytes('cam1') == 300
+
+
+def test_clean_store_max_size_takes_from_largest_cam(store):
+    store_dir, paths = store
+    index = load_index(store_dir)
+    cleaner = Cleaner(index, store_max_bytes=400, keep_free_bytes=0)
+
+    cleaner.clean()
+
+    # cam1 uses 400 of its 200 share, cam2 200: both files come from cam1, the oldest first
+    assert cleaner.removes_total == 2
+    assert cleaner.removed_bytes_total == 200
+    assert not os.path.exists(paths['cam1'][0])
+    assert not os.path.exists(paths['cam1'][1])
+    assert all(os.path.exists(path) for path in paths['cam1'][2:] + paths['cam2'])
+    assert index.size_bytes() == 400
+
+
+def test_clean_never_removes_hot_segment(store):
+    store_dir, paths = store
+    index = load_index(store_dir)
+    cleaner = Cleaner(index, store_max_bytes=1, keep_free_bytes=0)
+
+    cleaner.clean()
+
+    assert sorted(index.files) == sorted([paths['cam1'][-1], paths['cam2'][-1]])
+    assert all(os.path.exists(path) for path in index.files)
+
+
+def test_clean_cam_quotas(store):
+    store_dir, paths = store
+    index = load_index(store_dir)
+    policies = {
+        'cam1': CamPolicy(max_age_seconds=8.5 * HOUR),
+        'cam2': CamPolicy(max_bytes=100),
+    }
+    cleaner = Cleaner(index, store_max_bytes=0, keep_free_bytes=0, cam_policies=policies)
+
+    cleaner.clean()
+
+    # cam1: 10 and 9 hours old segments, cam2: the oldest one
+    assert [os.path.exists(path) for path in paths['cam1']] == [False, False, True, True]
+    assert [os.path.exists(path) for path in paths['cam2']] == [False, True]
+
+
+def test_clean_min_keep(store):
+    store_dir, paths = store
+    index = load_index(store_dir)
+    policies = {'cam1': CamPolicy(min_keep_seconds=9.5 * HOUR), 'cam2': CamPolicy(min_keep_seconds=9.5 * HOUR)}
+    cleaner = Cleaner(index, store_max_bytes=100, keep_free_bytes=0, cam_policies=policies)
+
+    cleaner.clean()
+
+    # Only the 10 hours old segments are out of min_keep
+    assert not os.path.exists(paths['cam1'][0])
+    assert not os.path.exists(paths['cam2'][0])
+    assert cleaner.removes_total == 2
+
+
+def test_remove_failure_skips_file(store, monkeypatch):
+    store_dir, paths = store
+    index = load_index(store_dir)
+    cleaner = Cleaner(index, store_max_bytes=500, keep_free_bytes=0)
+    remove = os.remove
+    locked = paths['cam1'][0]
+
+    def failing_remove(path):
+        if path == locked:
+            raise PermissionError(13, 'Permission denied', path)
+        remove(path)
+
+    monkeypatch.setattr(cam_store.os, 'remove', failing_remove)
+    cleaner.clean()
+
+    # The file, which cannot be removed, is dropped from the index and the next one is taken
+    assert os.path.exists(locked)
+    assert locked not in index.files
+    assert not os.path.exists(paths['cam1'][1])
+    assert cleaner.removes_total == 1
+
+
+def test_remove_of_missing_file(store):
+    store_dir, paths = store
+    index = load_index(store_dir)
+    cleaner = Cleaner(index, store_max_bytes=0, keep_free_bytes=0)
+
+    os.remove(paths['cam1'][0])
+
+    assert cleaner.remove(paths['cam1'][0]) == 0
+    assert paths['cam1'][0] not in index.files
+    assert cleaner.removes_total == 0
+    assert cleaner.remove(paths['cam1'][0]) == 0